@@ -0,0 +1,220 @@
+# attachments.py
+"""
+Content-addressed storage for client-encrypted attachments.
+
+Clients encrypt a file locally, hash the ciphertext (SHA-256) and upload
+it in chunks. The server never sees plaintext or keys: the attachment
+key travels inside the E2EE message that references the blob by hash.
+
+  ATTACHMENT_DIR/blobs/ab/abcdef...   finished blobs, named by their hash
+  ATTACHMENT_DIR/uploads/<hash>.part  uploads in progress
+
+Identical ciphertext is stored once: starting an upload for a hash that
+already exists completes immediately. Uploads are resumable: the .part
+file's length is the offset, so after a dropped connection the client
+asks for the offset and continues from there. Uploads not finished within
+ATTACHMENT_UPLOAD_TTL are dropped by purge_stale_uploads(), which the
+server runs from its retention loop. Chunks are streamed from the
+request body to disk in COPY_BLOCK pieces and the finished file is hashed
+in pieces too, so a large attachment never sits in worker memory.
+
+Downloads support Range. When the WSGI server offers wsgi.file_wrapper
+(gunicorn sync/gthread workers) the body goes out with sendfile(); with
+ATTACHMENT_ACCEL_REDIRECT set (e.g. "/_blobs/") the response only carries
+an X-Accel-Redirect header and nginx serves the file itself. Otherwise the
+file is streamed in COPY_BLOCK reads.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+import storage
+
+APP_DIR = os.path.dirname(__file__)
+ATTACHMENT_DIR = os.environ.get("ATTACHMENT_DIR", os.path.join(APP_DIR, "attachments"))
+ATTACHMENT_MAX_BYTES = int(os.environ.get("ATTACHMENT_MAX_BYTES", str(2 * 1024 ** 3)))
+ATTACHMENT_UPLOAD_TTL = float(os.environ.get("ATTACHMENT_UPLOAD_TTL", str(24 * 3600)))
+ATTACHMENT_ACCEL_REDIRECT = os.environ.get("ATTACHMENT_ACCEL_REDIRECT", "")
+COPY_BLOCK = 256 * 1024
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadError(Exception):
+    """status is the HTTP status to answer with; offset is set on offset conflicts."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def ensure_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS attachments (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS attachment_uploads (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+
+
+def valid_hash(sha256):
+    return isinstance(sha256, str) and bool(_HASH_RE.match(sha256))
+
+
+def blob_path(sha256):
+    return os.path.join(ATTACHMENT_DIR, "blobs", sha256[:2], sha256)
+
+
+def _part_path(sha256):
+    return os.path.join(ATTACHMENT_DIR, "uploads", sha256 + ".part")
+
+
+def _part_size(sha256):
+    try:
+        return os.path.getsize(_part_path(sha256))
+    except FileNotFoundError:
+        return 0
+
+
+def blob_size(conn, sha256):
+    """Size of a finished blob, or None."""
+    row = conn.execute("SELECT size FROM attachments WHERE sha256=?", (sha256,)).fetchone()
+    return row[0] if row else None
+
+
+def status(db_path, sha256):
+    """{"status": "complete"|"incomplete", "size": n, "offset": n}, or None if unknown."""
+    with storage.connect(db_path) as conn:
+        size = blob_size(conn, sha256)
+        if size is not None:
+            return {"status": "complete", "size": size, "offset": size}
+        row = conn.execute("SELECT size FROM attachment_uploads WHERE sha256=?", (sha256,)).fetchone()
+    if row is None:
+        return None
+    return {"status": "incomplete", "size": row[0], "offset": _part_size(sha256)}
+
+
+def begin(db_path, sha256, size):
+    """Start (or resume) an upload; returns status() for it."""
+    if not valid_hash(sha256):
+        raise UploadError("sha256 must be 64 lowercase hex digits")
+    if not isinstance(size, int) or size < 1 or size > ATTACHMENT_MAX_BYTES:
+        raise UploadError(f"size must be between 1 and {ATTACHMENT_MAX_BYTES} bytes")
+    with storage.connect(db_path) as conn:
+        existing = blob_size(conn, sha256)
+        if existing is None:
+            row = conn.execute("SELECT size FROM attachment_uploads WHERE sha256=?", (sha256,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO attachment_uploads (sha256, size, created_at) VALUES (?, ?, ?)",
+                             (sha256, size, time.time()))
+            elif row[0] != size:
+                raise UploadError("an upload with this hash and a different size is in progress", 409)
+        elif existing != size:
+            raise UploadError("size does not match the stored blob", 409)
+    return status(db_path, sha256)
+
+
+def append(db_path, sha256, offset, stream, length):
+    """
+    Write `length` bytes from the file-like `stream` at `offset` of the
+    upload. `offset` must equal the bytes already received. Finishes the
+    upload when the last byte arrives. Returns status().
+    """
+    info = status(db_path, sha256)
+    if info is None:
+        raise UploadError("unknown upload", 404)
+    if info["status"] == "complete":
+        return info
+    if offset + length > info["size"]:
+        raise UploadError("chunk runs past the declared size")
+    path = _part_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        try:
+            # one writer per upload; a second client gets the current offset
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError("upload is busy", 409, _part_size(sha256))
+        if f.tell() != offset:
+            raise UploadError("offset mismatch", 409, f.tell())
+        remaining = length
+        while remaining:
+            block = stream.read(min(COPY_BLOCK, remaining))
+            if not block:
+                break  # client went away; what arrived is kept for resume
+            f.write(block)
+            remaining -= len(block)
+        f.flush()
+        received = f.tell()
+        if received == info["size"]:
+            os.fsync(f.fileno())
+            _finish(db_path, sha256, info["size"])
+            return status(db_path, sha256)
+    if remaining:
+        raise UploadError("incomplete chunk", 400, received)
+    return {"status": "incomplete", "size": info["size"], "offset": received}
+
+
+def _finish(db_path, sha256, size):
+    part = _part_path(sha256)
+    digest = hashlib.sha256()
+    with open(part, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BLOCK), b""):
+            digest.update(block)
+    if digest.hexdigest() != sha256:
+        os.unlink(part)
+        with storage.connect(db_path) as conn:
+            conn.execute("DELETE FROM attachment_uploads WHERE sha256=?", (sha256,))
+        raise UploadError("content does not match sha256; upload discarded", 422)
+    dest = blob_path(sha256)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(part, dest)
+    with storage.connect(db_path) as conn:
+        conn.execute("INSERT OR IGNORE INTO attachments (sha256, size, created_at) VALUES (?, ?, ?)",
+                     (sha256, size, time.time()))
+        conn.execute("DELETE FROM attachment_uploads WHERE sha256=?", (sha256,))
+
+
+def iter_range(path, start, length):
+    """Yield `length` bytes of `path` from `start`, COPY_BLOCK at a time."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(COPY_BLOCK, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def purge_stale_uploads(db_path, ttl=ATTACHMENT_UPLOAD_TTL):
+    """Drop uploads not finished within `ttl` seconds; returns how many."""
+    with storage.connect(db_path) as conn:
+        stale = [r[0] for r in conn.execute(
+            "SELECT sha256 FROM attachment_uploads WHERE created_at < ?", (time.time() - ttl,))]
+        conn.execute("DELETE FROM attachment_uploads WHERE sha256 IN (SELECT value FROM json_each(?))",
+                     (json.dumps(stale),))
+    for sha256 in stale:
+        try:
+            os.unlink(_part_path(sha256))
+        except FileNotFoundError:
+            pass
+    return len(stale)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "messages.db"
+    print(f"{purge_stale_uploads(path)} stale uploads removed")
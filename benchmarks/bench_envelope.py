@@ -0,0 +1,115 @@
+# benchmarks/bench_envelope.py
+"""
+Throughput of decrypter's hybrid RSA + AES-GCM envelope.
+
+    python benchmarks/bench_envelope.py              # 1, 16 and 256 MB
+    python benchmarks/bench_envelope.py 64 1024      # custom sizes (MB)
+
+For each size, encrypts a stream to a temporary file and decrypts it back
+to a sink, reporting MB/s for both directions. For comparison it also
+times the legacy per-message RSA-OAEP path (446-byte blocks) and shows
+what the parsed-key cache saves per load_private_key() call. Uses
+keys/owner_*.pem when present, otherwise a fresh 4096-bit key.
+"""
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if not os.environ.get("FERNET_KEY"):
+    from cryptography.fernet import Fernet
+    os.environ["FERNET_KEY"] = Fernet.generate_key().decode()
+
+import decrypter  # noqa: E402
+
+BLOCK = 1024 * 1024
+
+
+class Source:
+    """Readable stream of `size` pseudo-random bytes without holding them."""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.block = os.urandom(BLOCK)
+
+    def read(self, n=-1):
+        n = self.remaining if n < 0 else min(n, self.remaining)
+        self.remaining -= n
+        if n <= len(self.block):
+            return self.block[:n]
+        return (self.block * (n // len(self.block) + 1))[:n]
+
+
+class Sink:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def keys():
+    private_path = os.path.join(ROOT, "keys", "owner_private.pem")
+    if os.path.exists(private_path):
+        return (decrypter.load_public_key(os.path.join(ROOT, "keys", "owner_public.pem")),
+                decrypter.load_private_key(private_path), private_path)
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    return private_key.public_key(), private_key, None
+
+
+def bench_envelope(public_key, private_key, mb):
+    size = mb * 1024 * 1024
+    with tempfile.TemporaryFile() as tmp:
+        start = time.perf_counter()
+        decrypter.encrypt_stream(Source(size), tmp, public_key)
+        enc = time.perf_counter() - start
+        tmp.seek(0)
+        sink = Sink()
+        start = time.perf_counter()
+        decrypter.decrypt_stream(tmp, sink, private_key)
+        dec = time.perf_counter() - start
+    assert sink.size == size
+    print(f"{mb:>8} MB  encrypt {mb / enc:>8.1f} MB/s   decrypt {mb / dec:>8.1f} MB/s")
+
+
+def bench_raw_rsa(public_key, private_key, blocks=50):
+    message = "x" * 446
+    start = time.perf_counter()
+    sealed = [decrypter.encrypt_with_rsa(message, public_key) for _ in range(blocks)]
+    enc = time.perf_counter() - start
+    start = time.perf_counter()
+    for c in sealed:
+        decrypter.decrypt_with_rsa(c, private_key)
+    dec = time.perf_counter() - start
+    mb = blocks * 446 / 1e6 / 1.048576
+    print(f"raw RSA-OAEP (446-byte messages): encrypt {mb / enc:.3f} MB/s   decrypt {mb / dec:.3f} MB/s")
+
+
+def bench_key_cache(path, loads=50):
+    decrypter._key_cache.clear()
+    start = time.perf_counter()
+    decrypter.load_private_key(path)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(loads):
+        decrypter.load_private_key(path)
+    warm = (time.perf_counter() - start) / loads
+    print(f"load_private_key: first {cold * 1000:.2f} ms, cached {warm * 1000:.3f} ms")
+
+
+def main(sizes):
+    public_key, private_key, private_path = keys()
+    print(f"RSA {private_key.key_size}-bit, chunk {decrypter.ENVELOPE_CHUNK // 1024} KiB")
+    for mb in sizes:
+        bench_envelope(public_key, private_key, mb)
+    bench_raw_rsa(public_key, private_key)
+    if private_path:
+        bench_key_cache(private_path)
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1, 16, 256])
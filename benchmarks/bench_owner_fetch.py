@@ -0,0 +1,75 @@
+# benchmarks/bench_owner_fetch.py
+"""
+Compare server.fetch_messages' buffered JSON path with the streaming NDJSON
+path (?format=ndjson) for one large mailbox.
+
+    python benchmarks/bench_owner_fetch.py            # 10k and 100k messages
+    python benchmarks/bench_owner_fetch.py 50000      # custom sizes
+
+Reports wall time, messages/s and peak Python heap (tracemalloc) for each
+path. Uses a throwaway database; FERNET_KEY is generated if unset.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MESSAGE_SIZE = 200
+
+
+def setup(db_path):
+    if not os.environ.get("FERNET_KEY"):
+        from cryptography.fernet import Fernet
+        os.environ["FERNET_KEY"] = Fernet.generate_key().decode()
+    os.environ["DB_PATH"] = db_path
+    import server
+    return server
+
+
+def fill(server, n):
+    import storage
+    from decrypter import encrypt_to_raw
+    body = b"x" * MESSAGE_SIZE
+    with storage.connect(server.DB_PATH) as conn:
+        conn.execute("DELETE FROM messages")
+        conn.executemany(
+            "INSERT INTO messages (sender, receiver, ciphertext) VALUES (?, ?, ?)",
+            (("alice", "owner", encrypt_to_raw(body)) for _ in range(n)))
+
+
+def measure(client, url):
+    tracemalloc.start()
+    start = time.perf_counter()
+    resp = client.get(url, buffered=False)
+    size = 0
+    for chunk in resp.response:
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    resp.close()
+    return elapsed, peak, size
+
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        server = setup(os.path.join(tmp, "bench.db"))
+        client = server.app.test_client()
+        token = server.OWNER_TOKEN
+        print(f"decrypt workers: {server.DECRYPT_WORKERS}, batch: {server.DECRYPT_BATCH}")
+        print(f"{'messages':>9} {'path':>8} {'seconds':>8} {'msg/s':>9} {'peak MB':>8} {'body MB':>8}")
+        for n in sizes:
+            fill(server, n)
+            for name, url in (("buffered", f"/api/messages/owner?token={token}"),
+                              ("ndjson", f"/api/messages/owner?token={token}&format=ndjson")):
+                elapsed, peak, size = measure(client, url)
+                print(f"{n:>9} {name:>8} {elapsed:>8.2f} {n / elapsed:>9.0f} "
+                      f"{peak / 1e6:>8.1f} {size / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,110 @@
+# benchmarks/bench_segmentlog.py
+"""
+Compare the two server_e2ee message stores: the SQLite messages table and
+the append-only segment log (MESSAGE_STORE=log, see segmentlog.py).
+
+    python benchmarks/bench_segmentlog.py              # 20k messages, 500 receivers
+    python benchmarks/bench_segmentlog.py 100000 2000  # custom messages, receivers
+
+Reports append rate for single-message and 64-message batches (one
+transaction / one append each, as store_messages() does), and p50/p99
+latency of 100-message history pages at random cursors. Both stores use
+their default durability (WAL synchronous=NORMAL, no fdatasync). Uses
+throwaway files.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrations  # noqa: E402
+import segmentlog  # noqa: E402
+import storage  # noqa: E402
+
+MESSAGE_SIZE = 200
+PAGE = 100
+READS = 2000
+INSERT_SQL = ("INSERT INTO messages (sender, receiver, group_id, ephemeral, iv, ciphertext, timestamp, "
+              "attachment) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+HISTORY_SQL = ("SELECT id, sender, ephemeral, iv, ciphertext, timestamp, group_id, attachment FROM messages "
+               "WHERE receiver=? AND id>? ORDER BY id ASC LIMIT ?")
+
+
+def make_rows(n, receivers):
+    rng = random.Random(1)
+    body = os.urandom(MESSAGE_SIZE)
+    return [(f"user{rng.randrange(receivers)}", f"user{rng.randrange(receivers)}", None,
+             os.urandom(32), os.urandom(12), body, "2024-01-01T00:00:00", None) for _ in range(n)]
+
+
+class SQLiteStore:
+    name = "sqlite"
+
+    def __init__(self, tmp):
+        self.path = os.path.join(tmp, "bench.db")
+        migrations.migrate(self.path, migrations.SHARD_MIGRATIONS, report=None)
+
+    def append(self, rows):
+        with storage.connect(self.path) as conn:
+            conn.executemany(INSERT_SQL, rows)
+
+    def page(self, receiver, since_id):
+        with storage.connect(self.path) as conn:
+            return conn.execute(HISTORY_SQL, (receiver, since_id, PAGE)).fetchall()
+
+
+class LogStore:
+    name = "log"
+
+    def __init__(self, tmp):
+        self.log = segmentlog.MessageLog(os.path.join(tmp, "log"))
+
+    def append(self, rows):
+        self.log.append(rows)
+
+    def page(self, receiver, since_id):
+        return self.log.rows(receiver, since_id, PAGE)
+
+
+def bench_append(store, rows, batch):
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        store.append(rows[i:i + batch])
+    return len(rows) / (time.perf_counter() - start)
+
+
+def bench_reads(store, receivers, last_id):
+    rng = random.Random(2)
+    times = []
+    for _ in range(READS):
+        receiver, since_id = f"user{rng.randrange(receivers)}", rng.randrange(last_id // 2)
+        start = time.perf_counter()
+        rows = store.page(receiver, since_id)
+        for r in rows:
+            len(r[4])  # touch the ciphertext, as the encoders do
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def main(n, receivers):
+    rows = make_rows(n, receivers)
+    print(f"{n} messages of {MESSAGE_SIZE} bytes to {receivers} receivers")
+    print(f"{'store':>7} {'append/s (1)':>13} {'append/s (64)':>14} {'page p50 ms':>12} {'page p99 ms':>12}")
+    for cls in (SQLiteStore, LogStore):
+        with tempfile.TemporaryDirectory() as tmp:
+            single = bench_append(cls(tmp), rows[:n // 10], 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            store = cls(tmp)
+            batched = bench_append(store, rows, 64)
+            p50, p99 = bench_reads(store, receivers, n)
+        print(f"{cls.name:>7} {single:>13.0f} {batched:>14.0f} {p50 * 1000:>12.3f} {p99 * 1000:>12.3f}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if args else 20000, args[1] if len(args) > 1 else 500)
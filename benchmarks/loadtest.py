@@ -0,0 +1,533 @@
+# benchmarks/loadtest.py
+"""
+Load test and latency benchmark for the chat servers.
+
+Starts server_e2ee:app (or server:app with --app owner) on a scratch
+database, drives N Socket.IO receivers and M senders, and reports:
+
+  - send -> push latency percentiles (p50/p95/p99, ms)
+  - sustained delivered messages/s
+  - database growth (bytes, including the WAL)
+  - server RSS per connected socket
+
+Scenarios (--scenario, repeatable; default all that apply to the app):
+  one_to_one       sender i -> receiver i
+  hot_receiver     every sender -> receiver 0
+  reconnect_storm  all receivers drop, messages queue up, all reconnect at
+                   once with last_seen_id and drain their backlog
+  history_sync     mailboxes are pre-filled, receivers page through
+                   /api/messages/<user> (e2ee app only)
+
+    python benchmarks/loadtest.py --receivers 50 --senders 50 --messages 40
+    python benchmarks/loadtest.py --output run.json
+    python benchmarks/loadtest.py --baseline run.json --tolerance 15
+
+--baseline compares the new run with a previous --output file and exits
+with status 1 if latency or throughput regressed by more than --tolerance
+percent. Needs the client extras: pip install "python-socketio[client]"
+requests websocket-client. With --workers > 1 the server runs under
+gunicorn with the gevent websocket worker and FANOUT_BACKEND=unix.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("one_to_one", "hot_receiver", "reconnect_storm", "history_sync")
+OWNER_SCENARIOS = ("one_to_one", "hot_receiver")
+
+# Ciphertext sizes: mostly short chat messages with a long tail, roughly
+# what AES-GCM over typical text produces (bytes, before base64).
+SIZE_MEDIAN = 180
+SIZE_SIGMA = 0.9
+SIZE_MAX = 16 * 1024
+
+STAMP = struct.Struct(">d")
+
+
+# -------------------------
+# Server process
+# -------------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_bytes(pid):
+    """RSS of pid plus its direct children (gunicorn workers)."""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class Server:
+    def __init__(self, app, workers, workdir, extra_env=None):
+        self.app = app
+        self.workers = workers
+        self.workdir = workdir
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.db_path = os.path.join(workdir, "messages.db")
+        # every client connects from localhost, so per-IP/per-sender limits
+        # are off unless --env turns them back on
+        self.env = dict(os.environ, DB_PATH=self.db_path, FANOUT_DIR=os.path.join(workdir, "fanout"),
+                        PYTHONPATH=ROOT, RATE_LIMIT_PER_SENDER="0", RATE_LIMIT_PER_IP="0")
+        self.env.update(extra_env or {})
+        if workers > 1:
+            self.env["FANOUT_BACKEND"] = "unix"
+        if app == "owner" and not self.env.get("FERNET_KEY"):
+            from cryptography.fernet import Fernet
+            self.env["FERNET_KEY"] = Fernet.generate_key().decode()
+        self.proc = None
+
+    def start(self):
+        module = "server_e2ee" if self.app == "e2ee" else "server"
+        if self.workers > 1:
+            cmd = ["gunicorn", "-k", "geventwebsocket.gunicorn.workers.GeventWebSocketWorker",
+                   "-w", str(self.workers), "--bind", f"127.0.0.1:{self.port}", f"{module}:app"]
+        else:
+            cmd = [sys.executable, "-c",
+                   "from gevent import monkey; monkey.patch_all()\n"
+                   f"import {module} as m\n"
+                   f"m.socketio.run(m.app, host='127.0.0.1', port={self.port}, debug=False)"]
+        self.proc = subprocess.Popen(cmd, cwd=self.workdir, env=self.env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                requests.get(self.url + "/", timeout=1)
+                return self
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def rss(self):
+        return _rss_bytes(self.proc.pid)
+
+    def db_bytes(self):
+        total = 0
+        for suffix in ("", "-wal"):
+            try:
+                total += os.path.getsize(self.db_path + suffix)
+            except OSError:
+                pass
+        return total
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+# -------------------------
+# Clients
+# -------------------------
+def _ciphertext(rng):
+    size = int(min(max(rng.lognormvariate(0, SIZE_SIGMA) * SIZE_MEDIAN, 16), SIZE_MAX))
+    return STAMP.pack(time.time()) + rng.randbytes(size - STAMP.size)
+
+
+def _latency_ms(payload_ct):
+    raw = base64.b64decode(payload_ct) if isinstance(payload_ct, str) else payload_ct
+    return (time.time() - STAMP.unpack_from(raw)[0]) * 1000.0
+
+
+class Receiver:
+    def __init__(self, server, username, app):
+        self.server = server
+        self.username = username
+        self.app = app
+        self.latencies = []
+        self.last_id = 0
+        self.last_at = 0.0
+        self.backlog_done = threading.Event()
+        self.sio = socketio.Client(reconnection=False)
+        self.lock = threading.Lock()
+        if app == "e2ee":
+            self.sio.on("message", self._on_message)
+            self.sio.on("backlog", self._on_backlog)
+        else:
+            self.sio.on("receive_message", self._on_owner_message)
+
+    def _record(self, ms, msg_id=None):
+        with self.lock:
+            self.latencies.append(ms)
+            self.last_at = time.time()
+            if msg_id:
+                self.last_id = max(self.last_id, msg_id)
+
+    def _on_message(self, data):
+        self._record(_latency_ms(data["ciphertext"]), data["id"])
+
+    def _on_owner_message(self, data):
+        self._record((time.time() - float(data["message"].split(":", 1)[0])) * 1000.0)
+
+    def _on_backlog(self, data):
+        for m in data["messages"]:
+            self._record(_latency_ms(m["ciphertext"]), m["id"])
+        if not data["has_more"]:
+            self.backlog_done.set()
+        return "ok"
+
+    def connect(self, last_seen_id=None):
+        self.sio.connect(self.server.url, transports=["websocket"], wait_timeout=30)
+        if self.app == "e2ee":
+            ident = {"username": self.username}
+            if last_seen_id is not None:
+                ident["last_seen_id"] = last_seen_id
+            self.sio.emit("identify", ident)
+        else:
+            self.sio.emit("join", {"username": self.username})
+
+    def received(self):
+        with self.lock:
+            return len(self.latencies)
+
+    def disconnect(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def _send_loop(server, app, transport, sender, targets, count, rng, rate, errors, finished):
+    session = requests.Session()
+    sio = None
+    if transport == "socket" or app == "owner":
+        sio = socketio.Client(reconnection=False)
+        sio.connect(server.url, transports=["websocket"], wait_timeout=30)
+    interval = 1.0 / rate if rate else 0
+    try:
+        for i in range(count):
+            receiver = targets[i % len(targets)]
+            if app == "owner":
+                # call() waits for the handler, so nothing is lost on disconnect
+                sio.call("send_message", {"sender": sender, "receiver": receiver,
+                                          "message": f"{time.time()}:" + "x" * SIZE_MEDIAN}, timeout=30)
+            else:
+                msg = {"sender": sender, "receiver": receiver,
+                       "ephemeral": base64.b64encode(rng.randbytes(65)).decode(),
+                       "iv": base64.b64encode(rng.randbytes(12)).decode(),
+                       "ciphertext": base64.b64encode(_ciphertext(rng)).decode()}
+                if sio is not None:
+                    ack = sio.call("send", msg, timeout=30)
+                    ok = ack and ack.get("status") == "stored"
+                else:
+                    ok = session.post(server.url + "/api/send", json=msg, timeout=30).status_code == 201
+                if not ok:
+                    errors.append(1)
+            if interval:
+                time.sleep(interval)
+        finished.append(time.time())
+    finally:
+        # python-socketio's disconnect() can block for seconds; it happens
+        # after the finish time is recorded so it doesn't skew results
+        if sio is not None:
+            sio.disconnect()
+
+
+def _run_senders(server, args, assignments, rng_seed):
+    """
+    assignments: list of (sender, targets). Returns (start, send_seconds,
+    errors); send_seconds runs until the last sender finished sending.
+    """
+    errors = []
+    finished = []
+    threads = [threading.Thread(target=_send_loop,
+                                args=(server, args.app, args.transport, sender, targets,
+                                      args.messages, random.Random(rng_seed + i), args.rate,
+                                      errors, finished))
+               for i, (sender, targets) in enumerate(assignments)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return start, (max(finished) if finished else time.time()) - start, len(errors)
+
+
+def _wait_for(receivers, expected, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if sum(r.received() for r in receivers) >= expected:
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(p / 100.0 * len(values)))], 2)
+    return {"p50": pct(50), "p95": pct(95), "p99": pct(99), "max": round(values[-1], 2)}
+
+
+def _connect_all(server, args, names):
+    receivers = [Receiver(server, n, args.app) for n in names]
+    threads = [threading.Thread(target=r.connect) for r in receivers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time.sleep(0.3)  # let identify land before the first send
+    return receivers
+
+
+# -------------------------
+# Scenarios
+# -------------------------
+def _push_scenario(server, args, hot):
+    rss_before = server.rss()
+    db_before = server.db_bytes()
+    receivers = _connect_all(server, args, [f"recv{i}" for i in range(args.receivers)])
+    rss_connected = server.rss()
+    if hot:
+        assignments = [(f"send{i}", ["recv0"]) for i in range(args.senders)]
+    else:
+        assignments = [(f"send{i}", [f"recv{i % args.receivers}"]) for i in range(args.senders)]
+    expected = args.senders * args.messages
+    start, send_elapsed, errors = _run_senders(server, args, assignments, 1)
+    complete = _wait_for(receivers, expected, args.timeout)
+    elapsed = max(r.last_at for r in receivers) - start
+    latencies = [ms for r in receivers for ms in r.latencies]
+    for r in receivers:
+        r.disconnect()
+    return {
+        "delivered": len(latencies),
+        "expected": expected,
+        "complete": complete,
+        "send_errors": errors,
+        "latency_ms": _percentiles(latencies),
+        "messages_per_s": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        "send_seconds": round(send_elapsed, 3),
+        "db_growth_bytes": server.db_bytes() - db_before,
+        "rss_per_connection_bytes": int((rss_connected - rss_before) / max(args.receivers, 1)),
+    }
+
+
+def scenario_one_to_one(server, args):
+    return _push_scenario(server, args, hot=False)
+
+
+def scenario_hot_receiver(server, args):
+    return _push_scenario(server, args, hot=True)
+
+
+def scenario_reconnect_storm(server, args):
+    names = [f"storm{i}" for i in range(args.receivers)]
+    receivers = _connect_all(server, args, names)
+    for r in receivers:
+        r.disconnect()
+    # queue messages while everyone is offline
+    assignments = [(f"send{i}", [names[i % len(names)]]) for i in range(args.senders)]
+    _run_senders(server, args, assignments, 2)
+    fresh = [Receiver(server, n, args.app) for n in names]
+    times = []
+    lock = threading.Lock()
+
+    def reconnect(r):
+        t0 = time.time()
+        r.connect(last_seen_id=0)
+        if r.backlog_done.wait(args.timeout):
+            with lock:
+                times.append((time.time() - t0) * 1000.0)
+    start = time.time()
+    threads = [threading.Thread(target=reconnect, args=(r,)) for r in fresh]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    storm = time.time() - start
+    drained = sum(r.received() for r in fresh)
+    for r in fresh:
+        r.disconnect()
+    return {
+        "reconnected": len(times),
+        "receivers": len(fresh),
+        "backlog_messages": drained,
+        "reconnect_ms": _percentiles(times),
+        "storm_seconds": round(storm, 3),
+        "messages_per_s": round(drained / storm, 1) if storm else None,
+    }
+
+
+def scenario_history_sync(server, args):
+    names = [f"hist{i}" for i in range(args.receivers)]
+    assignments = [(f"send{i}", names) for i in range(args.senders)]
+    _run_senders(server, args, assignments, 3)
+    times = []
+    total = [0]
+    lock = threading.Lock()
+
+    def sync(name):
+        session = requests.Session()
+        cursor = 0
+        got = 0
+        t0 = time.time()
+        while True:
+            page = session.get(f"{server.url}/api/messages/{name}",
+                               params={"since_id": cursor, "limit": args.page_size}, timeout=30).json()
+            got += len(page["messages"])
+            cursor = page["next_cursor"]
+            if not page["has_more"]:
+                break
+        with lock:
+            times.append((time.time() - t0) * 1000.0)
+            total[0] += got
+    start = time.time()
+    threads = [threading.Thread(target=sync, args=(n,)) for n in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return {
+        "messages": total[0],
+        "sync_ms": _percentiles(times),
+        "messages_per_s": round(total[0] / elapsed, 1) if elapsed else None,
+    }
+
+
+# -------------------------
+# Baseline comparison
+# -------------------------
+# metric path -> True if higher is better
+COMPARED = {
+    ("latency_ms", "p50"): False,
+    ("latency_ms", "p95"): False,
+    ("latency_ms", "p99"): False,
+    ("reconnect_ms", "p95"): False,
+    ("sync_ms", "p95"): False,
+    ("messages_per_s",): True,
+}
+
+
+def _lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(current, baseline, tolerance):
+    """Returns a list of regression descriptions (empty if none)."""
+    regressions = []
+    for scenario, result in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if base is None:
+            continue
+        for path, higher_is_better in COMPARED.items():
+            new, old = _lookup(result, path), _lookup(base, path)
+            if new is None or old is None or old == 0:
+                continue
+            change = (new - old) / old * 100.0
+            worse = -change if higher_is_better else change
+            if worse > tolerance:
+                regressions.append(f"{scenario} {'.'.join(path)}: {old} -> {new} ({change:+.1f}%)")
+    return regressions
+
+
+# -------------------------
+# Main
+# -------------------------
+RUNNERS = {
+    "one_to_one": scenario_one_to_one,
+    "hot_receiver": scenario_hot_receiver,
+    "reconnect_storm": scenario_reconnect_storm,
+    "history_sync": scenario_history_sync,
+}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--app", choices=("e2ee", "owner"), default="e2ee")
+    p.add_argument("--scenario", action="append", choices=SCENARIOS)
+    p.add_argument("--receivers", type=int, default=20)
+    p.add_argument("--senders", type=int, default=20)
+    p.add_argument("--messages", type=int, default=25, help="messages per sender")
+    p.add_argument("--rate", type=float, default=0, help="messages/s per sender (0 = as fast as possible)")
+    p.add_argument("--transport", choices=("http", "socket"), default="http")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--page-size", type=int, default=500)
+    p.add_argument("--timeout", type=float, default=60)
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                   help="extra server environment, e.g. GROUP_COMMIT=1")
+    p.add_argument("--output", help="write results as JSON here")
+    p.add_argument("--baseline", help="previous --output file to compare against")
+    p.add_argument("--tolerance", type=float, default=10.0, help="allowed regression in percent")
+    args = p.parse_args(argv)
+
+    allowed = SCENARIOS if args.app == "e2ee" else OWNER_SCENARIOS
+    scenarios = args.scenario or list(allowed)
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    results = {"config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+               "scenarios": {}}
+
+    for name in scenarios:
+        if name not in allowed:
+            print(f"skipping {name}: not supported for --app {args.app}", file=sys.stderr)
+            continue
+        # fresh server and database per scenario so results don't bleed
+        workdir = tempfile.mkdtemp(prefix="e2ee-loadtest-")
+        server = Server(args.app, args.workers, workdir, extra_env)
+        try:
+            server.start()
+            results["scenarios"][name] = RUNNERS[name](server, args)
+        finally:
+            server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{name}: {json.dumps(results['scenarios'][name])}", file=sys.stderr)
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
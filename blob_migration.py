@@ -0,0 +1,104 @@
+# blob_migration.py
+"""
+Online migration of legacy text-encoded ciphertext rows to raw BLOBs.
+
+Two kinds of legacy rows share the messages table:
+  - server_e2ee rows (ephemeral IS NOT NULL): base64 ephemeral/iv/ciphertext
+  - server.py rows (ephemeral IS NULL): hex of a Fernet token, which is
+    itself urlsafe base64; stored as the decoded token bytes instead
+
+Rows are rewritten in small id-ordered batches, one short transaction per
+batch, so the servers keep serving while it runs. Readers handle both
+forms, so a half-migrated table is fine. Safe to run repeatedly or from
+several processes; a lock file keeps concurrent workers from duplicating
+the work. Run by hand with: python blob_migration.py [messages.db]
+"""
+import base64
+import binascii
+import os
+import sys
+import time
+
+import storage
+
+BATCH_SIZE = int(os.environ.get("BLOB_MIGRATION_BATCH", "500"))
+PAUSE_SECONDS = float(os.environ.get("BLOB_MIGRATION_PAUSE", "0.05"))
+
+SELECT_LEGACY_SQL = (
+    "SELECT id, ephemeral, iv, ciphertext FROM messages "
+    "WHERE id > ? AND typeof(ciphertext) = 'text' ORDER BY id LIMIT ?"
+)
+# databases created by server.py/database_setup.py have no ephemeral/iv columns
+SELECT_LEGACY_OWNER_SQL = (
+    "SELECT id, NULL, NULL, ciphertext FROM messages "
+    "WHERE id > ? AND typeof(ciphertext) = 'text' ORDER BY id LIMIT ?"
+)
+UPDATE_E2EE_SQL = (
+    "UPDATE messages SET ephemeral=?, iv=?, ciphertext=? "
+    "WHERE id=? AND typeof(ciphertext) = 'text'"
+)
+UPDATE_OWNER_SQL = "UPDATE messages SET ciphertext=? WHERE id=? AND typeof(ciphertext) = 'text'"
+
+
+def _b64(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return base64.b64decode(value, validate=True)
+
+
+def _convert(row):
+    """Returns (sql, params) for one legacy row, or None if it can't be decoded."""
+    msg_id, eph, iv, ct = row
+    try:
+        if eph is not None:
+            return UPDATE_E2EE_SQL, (_b64(eph), _b64(iv), _b64(ct), msg_id)
+        token = bytes.fromhex(ct)
+        return UPDATE_OWNER_SQL, (base64.urlsafe_b64decode(token), msg_id)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def migrate(db_path, batch_size=BATCH_SIZE, pause=PAUSE_SECONDS):
+    """Convert every legacy row; returns (converted, skipped)."""
+    last_id = 0
+    converted = skipped = 0
+    with storage.connect(db_path) as conn:
+        columns = storage.table_columns(conn, "messages")
+    select_sql = SELECT_LEGACY_SQL if "ephemeral" in columns else SELECT_LEGACY_OWNER_SQL
+    while True:
+        with storage.connect(db_path) as conn:
+            rows = conn.execute(select_sql, (last_id, batch_size)).fetchall()
+            if not rows:
+                return converted, skipped
+            for row in rows:
+                update = _convert(row)
+                if update is None:
+                    skipped += 1  # undecodable legacy data stays as text
+                    continue
+                converted += conn.execute(*update).rowcount
+            last_id = rows[-1][0]
+        time.sleep(pause)  # let request handlers take the write lock
+
+
+def start(db_path, spawn):
+    """
+    Run migrate() in the background via spawn(fn) (e.g.
+    socketio.start_background_task). Only one process per database runs it.
+    """
+    def run():
+        lock = storage.try_process_lock(db_path, "blob-migration")
+        if lock is None:
+            return  # another worker is migrating
+        try:
+            converted, skipped = migrate(db_path)
+            if converted or skipped:
+                print(f"blob migration: {converted} rows converted, {skipped} skipped")
+        finally:
+            lock.close()
+    spawn(run)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "messages.db"
+    converted, skipped = migrate(path, pause=0)
+    print(f"{converted} rows converted, {skipped} skipped")
@@ -0,0 +1,161 @@
+# cache.py
+"""
+Small in-process caches shared by the servers.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Bounded LRU map with an optional per-entry TTL (seconds).
+
+    Each worker has its own copy, so entries written elsewhere become
+    visible here after at most `ttl` seconds; callers that change the
+    underlying data in this worker should call invalidate().
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RecentMessages:
+    """
+    Per-receiver ring of the newest `per_receiver` messages, under one byte
+    budget shared by every receiver; whole rings are dropped least recently
+    used first.
+
+    A ring holds every message for its receiver with id > its floor (the
+    id before the first one it saw, or the last one it dropped), so a read
+    from at or above the floor can be answered from memory. That only holds
+    while this process performs every write for those receivers: callers
+    bracket each write with begin() and end(), and a ring is not read while
+    a write to it is in flight.
+    """
+
+    def __init__(self, per_receiver=50, max_bytes=64 * 1024 * 1024):
+        self.per_receiver = per_receiver
+        self.max_bytes = max_bytes
+        self._rings = OrderedDict()  # receiver -> [floor, [(id, group_id, value, size), ...]]
+        self._pending = {}  # receiver -> writes in flight
+        self._unknown = set()  # receivers with a write of unknown outcome; never cached again
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, receivers):
+        with self._lock:
+            for r in receivers:
+                self._pending[r] = self._pending.get(r, 0) + 1
+
+    def end(self, receivers, entries=None):
+        """
+        Finish a write begun with begin(receivers). entries are the stored
+        (receiver, id, group_id, value, size); None means the write failed,
+        which may still have committed, so those receivers stop being cached.
+        """
+        with self._lock:
+            for r in receivers:
+                n = self._pending.pop(r) - 1
+                if n:
+                    self._pending[r] = n
+            if entries is None:
+                self._unknown.update(receivers)
+                for r in receivers:
+                    self._drop(r)
+                return
+            for receiver, msg_id, group_id, value, size in entries:
+                if receiver not in self._unknown:
+                    self._add(receiver, msg_id, group_id, value, size)
+            while self.bytes > self.max_bytes and self._rings:
+                self._drop(next(iter(self._rings)))
+
+    def _add(self, receiver, msg_id, group_id, value, size):
+        ring = self._rings.get(receiver)
+        if ring is None:
+            ring = self._rings[receiver] = [msg_id - 1, []]
+        self._rings.move_to_end(receiver)
+        floor, items = ring
+        if msg_id <= floor:
+            return  # a late write below the floor; reads from the floor don't need it
+        i = len(items)
+        while i and items[i - 1][0] > msg_id:
+            i -= 1  # writes can finish out of id order
+        items.insert(i, (msg_id, group_id, value, size))
+        self.bytes += size
+        while len(items) > self.per_receiver:
+            dropped = items.pop(0)
+            ring[0] = dropped[0]
+            self.bytes -= dropped[3]
+
+    def _drop(self, receiver):
+        ring = self._rings.pop(receiver, None)
+        if ring is not None:
+            self.bytes -= sum(item[3] for item in ring[1])
+
+    def page(self, receiver, since_id, count, group_id=None):
+        """
+        Values of up to `count` of receiver's messages with id > since_id
+        (only those in group_id, if given), oldest first; None if the ring
+        can't answer.
+        """
+        with self._lock:
+            ring = self._rings.get(receiver)
+            if ring is None or since_id < ring[0] or self._pending.get(receiver):
+                self.misses += 1
+                return None
+            self._rings.move_to_end(receiver)
+            self.hits += 1
+            out = []
+            for msg_id, g, value, _ in ring[1]:
+                if msg_id > since_id and (group_id is None or g == group_id):
+                    out.append(value)
+                    if len(out) == count:
+                        break
+            return out
+
+    def __len__(self):
+        return len(self._rings)
@@ -0,0 +1,151 @@
+# conversations.py
+"""
+Per-user conversation summaries for the inbox list.
+
+One row per (username, conversation): the newest message id, its sender
+and timestamp, the user's read pointer and how many messages from others
+arrived after it. A direct conversation is keyed by the peer's name (with
+group_id 0), a group conversation by its group_id (with peer '').
+
+record() runs inside the transaction that inserts the messages, so the
+summary can never disagree with what was committed, and listing the inbox
+reads this table only: O(conversations), not O(messages). Both sides are
+updated: the receiver's unread count goes up, and the sender's own row
+moves its read pointer to the message just sent.
+
+Existing databases are backfilled from the messages table the first time
+the table is created.
+"""
+import storage
+
+BACKFILL_BATCH = 1000
+NO_CURSOR = 2 ** 63 - 1
+
+UPSERT_SQL = (
+    "INSERT INTO conversations (username, peer, group_id, last_id, last_sender, last_timestamp, unread, read_id) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (username, peer, group_id) DO UPDATE SET "
+    "last_id=excluded.last_id, last_sender=excluded.last_sender, last_timestamp=excluded.last_timestamp, "
+    # the user's own message reads everything before it
+    "unread=CASE WHEN excluded.read_id > 0 THEN excluded.unread ELSE unread + excluded.unread END, "
+    "read_id=max(read_id, excluded.read_id)"
+)
+LIST_SQL = ("SELECT peer, group_id, last_id, last_sender, last_timestamp, unread, read_id FROM conversations "
+            "WHERE username=? AND last_id<? ORDER BY last_id DESC LIMIT ?")
+# unread left after a partial read; both use the messages indexes from id > read_id
+COUNT_DIRECT_SQL = ("SELECT COUNT(*) FROM messages "
+                    "WHERE receiver=? AND id>? AND id<=? AND sender=? AND group_id IS NULL")
+COUNT_GROUP_SQL = ("SELECT COUNT(*) FROM messages "
+                   "WHERE group_id=? AND receiver=? AND id>? AND id<=? AND sender!=?")
+
+
+def ensure_schema(conn):
+    new = not storage.table_columns(conn, "conversations")
+    if new and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")  # one worker creates and backfills
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS conversations (
+        username TEXT NOT NULL,
+        peer TEXT NOT NULL,
+        group_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        last_sender TEXT,
+        last_timestamp TEXT,
+        unread INTEGER NOT NULL DEFAULT 0,
+        read_id INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (username, peer, group_id)
+    ) WITHOUT ROWID
+    """)
+    # inbox order: WHERE username=? AND last_id<? ORDER BY last_id DESC
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (username, last_id)")
+    if new and conn.execute("SELECT 1 FROM conversations LIMIT 1").fetchone() is None:
+        _backfill(conn)
+
+
+def _backfill(conn):
+    c = conn.execute("SELECT sender, receiver, group_id, timestamp, id FROM messages ORDER BY id")
+    while True:
+        rows = c.fetchmany(BACKFILL_BATCH)
+        if not rows:
+            break
+        record(conn, [r[:4] for r in rows], [r[4] for r in rows])
+
+
+def _summaries(rows, ids, receivers=True):
+    # {(username, peer, group_id): [last_id, last_sender, last_timestamp, unread, read_id]}
+    out = {}
+
+    def touch(key, msg_id, sender, timestamp, unread, read_id):
+        s = out.setdefault(key, [0, None, None, 0, 0])
+        s[0], s[1], s[2] = msg_id, sender, timestamp
+        if read_id:
+            s[3], s[4] = 0, read_id
+        s[3] += unread
+
+    for (sender, receiver, group_id, timestamp), msg_id in zip(rows, ids):
+        group_id = group_id or 0
+        own = sender == receiver
+        if receivers or own:
+            touch((receiver, "" if group_id else sender, group_id), msg_id, sender, timestamp,
+                  0 if own else 1, msg_id if own else 0)
+        if not own:
+            touch((sender, "" if group_id else receiver, group_id), msg_id, sender, timestamp, 0, msg_id)
+    return out
+
+
+def record(conn, rows, ids, keep=None, receivers=True):
+    """
+    Fold newly inserted messages into the summaries. rows are
+    (sender, receiver, group_id, timestamp) in id order; ids their ids.
+    keep(username), if given, picks the users whose rows live in `conn`.
+    receivers=False updates only the senders' side of each conversation.
+    """
+    conn.executemany(UPSERT_SQL, [key + tuple(s) for key, s in _summaries(rows, ids, receivers).items()
+                                  if keep is None or keep(key[0])])
+
+
+def _conversation(peer, group_id, last_id, last_sender, last_timestamp, unread, read_id):
+    return {"peer": peer or None, "group_id": group_id or None, "last_id": last_id,
+            "last_sender": last_sender, "last_timestamp": last_timestamp,
+            "unread": unread, "read_id": read_id}
+
+
+def list_page(conn, username, before=None, limit=50):
+    """
+    Up to `limit` conversations, most recent first, with last_id < before.
+    Returns (conversations, has_more).
+    """
+    rows = conn.execute(LIST_SQL, (username, NO_CURSOR if before is None else before, limit + 1)).fetchall()
+    return [_conversation(*r) for r in rows[:limit]], len(rows) > limit
+
+
+def mark_read(conn, username, peer=None, group_id=None, up_to=None, count=None):
+    """
+    Move the read pointer of one conversation to up_to (default: its newest
+    message) and recompute unread. Pointers never move back. Returns the
+    updated conversation, or None if there is no such conversation.
+    count(sql, params) runs the unread recount when the messages live in
+    other files (sharding.py segments); by default it runs on `conn`.
+    """
+    key = (username, "" if group_id else peer, group_id or 0)
+    row = conn.execute("SELECT last_id, read_id, unread FROM conversations "
+                       "WHERE username=? AND peer=? AND group_id=?", key).fetchone()
+    if row is None:
+        return None
+    last_id, read_id, unread = row
+    up_to = last_id if up_to is None else min(up_to, last_id)
+    if up_to > read_id:
+        read_id = up_to
+        if up_to == last_id:
+            unread = 0
+        else:
+            count = count or (lambda sql, params: conn.execute(sql, params).fetchone()[0])
+            if group_id:
+                unread = count(COUNT_GROUP_SQL, (group_id, username, up_to, last_id, username))
+            else:
+                unread = count(COUNT_DIRECT_SQL, (username, up_to, last_id, peer))
+        conn.execute("UPDATE conversations SET read_id=?, unread=? WHERE username=? AND peer=? AND group_id=?",
+                     (read_id, unread) + key)
+    r = conn.execute("SELECT peer, group_id, last_id, last_sender, last_timestamp, unread, read_id "
+                     "FROM conversations WHERE username=? AND peer=? AND group_id=?", key).fetchone()
+    return _conversation(*r)
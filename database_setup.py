@@ -1,19 +1,9 @@
-import sqlite3
+import sys
 
-conn = sqlite3.connect("messages.db")
-c = conn.cursor()
+import migrations
 
-c.execute("""
-CREATE TABLE IF NOT EXISTS messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    sender TEXT,
-    receiver TEXT,
-    ciphertext TEXT,
-    timestamp TEXT
-)
-""")
-
-conn.commit()
-conn.close()
+# same as `python migrations.py [messages.db]`
+path = sys.argv[1] if len(sys.argv) > 1 else "messages.db"
+migrations.migrate(path)
 
 print("Database initialized.")
@@ -1,27 +1,94 @@
 import os
 import base64
+import hashlib
+import io
+import struct
+import threading
 from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
-FERNET_KEY = os.environ.get("FERNET_KEY").encode()  # must be set in env
-cipher = Fernet(FERNET_KEY)
+# At-rest keys. FERNET_KEYS is a comma-separated list, newest first: the
+# first key encrypts, all of them decrypt. FERNET_KEY alone (one key) still
+# works. To rotate, put a new key in front and restart; rows are re-encrypted
+# in the background (key_rotation.py) and the old key can be dropped once
+# that finishes.
+FERNET_KEYS = [k.strip().encode() for k in
+               (os.environ.get("FERNET_KEYS") or os.environ.get("FERNET_KEY") or "").split(",") if k.strip()]
+if not FERNET_KEYS:
+    raise RuntimeError("FERNET_KEY or FERNET_KEYS must be set")
+
+def key_id_for(key: bytes) -> str:
+    """Short stable id stored next to each row; derived from the key, so it needs no config."""
+    return hashlib.sha256(key).hexdigest()[:8]
+
+ciphers = {key_id_for(k): Fernet(k) for k in FERNET_KEYS}  # key id -> Fernet
+PRIMARY_KEY_ID = key_id_for(FERNET_KEYS[0])
+FERNET_KEY = FERNET_KEYS[0]
+cipher = ciphers[PRIMARY_KEY_ID]
+_any_cipher = MultiFernet([Fernet(k) for k in FERNET_KEYS])  # rows without a key id
+
+def _cipher_for(key_id):
+    if key_id is None:
+        return _any_cipher
+    try:
+        return ciphers[key_id]
+    except KeyError:
+        raise InvalidToken(f"key {key_id} is not in FERNET_KEYS")
 
 def encrypt_bytes(data: bytes) -> bytes:
     return cipher.encrypt(data)
 
-def decrypt_bytes(data: bytes) -> bytes:
-    return cipher.decrypt(data)
+def decrypt_bytes(data: bytes, key_id=None) -> bytes:
+    return _cipher_for(key_id).decrypt(data)
 
-def load_private_key(path="keys/owner_private.pem"):
+# Fernet tokens are urlsafe base64 of a binary token. For storage we keep the
+# binary form (3/4 the size) and only re-encode it when decrypting.
+def encrypt_to_raw(data: bytes) -> bytes:
+    """Encrypt with the primary key; store PRIMARY_KEY_ID with the result."""
+    return base64.urlsafe_b64decode(cipher.encrypt(data))
+
+def decrypt_from_raw(raw: bytes, key_id=None) -> bytes:
+    """key_id picks the key directly; None tries every key (rows from before key ids)."""
+    return _cipher_for(key_id).decrypt(base64.urlsafe_b64encode(raw))
+
+def reencrypt_raw(raw: bytes, key_id=None) -> bytes:
+    """Re-encrypt a stored token under the primary key, keeping its timestamp."""
+    token = base64.urlsafe_b64encode(raw)
+    old = _cipher_for(key_id)
+    plain = old.decrypt(token)
+    return base64.urlsafe_b64decode(cipher.encrypt_at_time(plain, old.extract_timestamp(token)))
+
+# Parsed keys, per process. PEM parsing (and RSA key validation) costs
+# milliseconds, so each file is parsed once and re-read only if it changes.
+_key_cache = {}  # (abspath, kind) -> (mtime_ns, key)
+_key_lock = threading.Lock()
+
+def _load_key(path, kind, loader):
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with _key_lock:
+        cached = _key_cache.get((path, kind))
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
     with open(path, "rb") as f:
-        return load_pem_private_key(f.read(), password=None)
+        key = loader(f.read())
+    with _key_lock:
+        _key_cache[(path, kind)] = (mtime, key)
+    return key
+
+def load_private_key(path="keys/owner_private.pem"):
+    return _load_key(path, "private", lambda pem: load_pem_private_key(pem, password=None))
 
 def load_public_key(path="keys/owner_public.pem"):
-    with open(path, "rb") as f:
-        return load_pem_public_key(f.read())
+    return _load_key(path, "public", load_pem_public_key)
 
+# Raw RSA-OAEP: one private-key operation per message and at most
+# key_bytes - 66 bytes (446 for the 4096-bit owner key) of plaintext.
+# Prefer the envelope functions below for anything new.
 def encrypt_with_rsa(message: str, public_key):
     return public_key.encrypt(
         message.encode(),
@@ -33,3 +100,114 @@ def decrypt_with_rsa(ciphertext: bytes, private_key):
         ciphertext,
         padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
     ).decode()
+
+
+# ----------------- HYBRID ENVELOPE -----------------
+# RSA-OAEP wraps a fresh 256-bit AES key per envelope; the payload is
+# AES-256-GCM in fixed-size chunks, so any size streams in constant memory
+# and costs one RSA operation per envelope rather than per 446 bytes.
+#
+#   header = "E2H1" u32(chunk_size) u16(len) wrapped_key nonce_prefix(7)
+#   body   = chunk*   each chunk_size + 16 bytes (GCM tag), the last shorter
+#
+# Chunk i uses nonce = prefix | u32(i) | u8(is_last) with the header as
+# associated data, so reordered, truncated or re-headed streams fail to
+# decrypt (STREAM construction).
+
+ENVELOPE_MAGIC = b"E2H1"
+ENVELOPE_CHUNK = 64 * 1024
+_TAG = 16
+_OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+_HEAD = struct.Struct(">4sIH")
+_NONCE_TAIL = struct.Struct(">IB")
+
+class EnvelopeError(ValueError):
+    pass
+
+def _read_full(src, n):
+    parts = []
+    while n:
+        block = src.read(n)
+        if not block:
+            break
+        parts.append(block)
+        n -= len(block)
+    return b"".join(parts)
+
+def encrypt_stream(src, dst, public_key=None, chunk_size=ENVELOPE_CHUNK):
+    """
+    Encrypt everything readable from `src` into `dst` (binary file-like
+    objects). Returns the number of bytes written.
+    """
+    public_key = public_key or load_public_key()
+    data_key = AESGCM.generate_key(bit_length=256)
+    wrapped = public_key.encrypt(data_key, _OAEP)
+    prefix = os.urandom(7)
+    header = _HEAD.pack(ENVELOPE_MAGIC, chunk_size, len(wrapped)) + wrapped + prefix
+    dst.write(header)
+    written = len(header)
+    aead = AESGCM(data_key)
+    index = 0
+    chunk = _read_full(src, chunk_size)
+    while True:
+        # read one chunk ahead: the last chunk is sealed with is_last=1
+        following = _read_full(src, chunk_size) if len(chunk) == chunk_size else b""
+        last = not following
+        sealed = aead.encrypt(prefix + _NONCE_TAIL.pack(index, last), chunk, header)
+        dst.write(sealed)
+        written += len(sealed)
+        if last:
+            return written
+        chunk = following
+        index += 1
+
+def _unwrap(wrapped, private_key):
+    try:
+        return private_key.decrypt(wrapped, _OAEP)
+    except ValueError:
+        raise EnvelopeError("data key does not decrypt with this private key")
+
+def decrypt_stream(src, dst, private_key=None):
+    """
+    Decrypt an envelope from `src` into `dst`. Returns the plaintext size.
+    Raises EnvelopeError on a bad header, tampering or truncation; `dst` may
+    already hold some plaintext by then, so discard it on error.
+    """
+    head = _read_full(src, _HEAD.size)
+    if len(head) != _HEAD.size:
+        raise EnvelopeError("truncated header")
+    magic, chunk_size, wrapped_len = _HEAD.unpack(head)
+    if magic != ENVELOPE_MAGIC or not chunk_size:
+        raise EnvelopeError("not an envelope")
+    rest = _read_full(src, wrapped_len + 7)
+    if len(rest) != wrapped_len + 7:
+        raise EnvelopeError("truncated header")
+    header = head + rest
+    wrapped, prefix = rest[:wrapped_len], rest[wrapped_len:]
+    aead = AESGCM(_unwrap(wrapped, private_key or load_private_key()))
+    size = 0
+    index = 0
+    sealed = _read_full(src, chunk_size + _TAG)
+    while True:
+        following = _read_full(src, chunk_size + _TAG) if len(sealed) == chunk_size + _TAG else b""
+        last = not following
+        try:
+            plain = aead.decrypt(prefix + _NONCE_TAIL.pack(index, last), sealed, header)
+        except InvalidTag:
+            raise EnvelopeError("chunk %d failed authentication (tampered or truncated)" % index)
+        dst.write(plain)
+        size += len(plain)
+        if last:
+            return size
+        sealed = following
+        index += 1
+
+def encrypt_envelope(data: bytes, public_key=None) -> bytes:
+    out = io.BytesIO()
+    encrypt_stream(io.BytesIO(data), out, public_key)
+    return out.getvalue()
+
+def decrypt_envelope(data: bytes, private_key=None) -> bytes:
+    out = io.BytesIO()
+    decrypt_stream(io.BytesIO(data), out, private_key)
+    return out.getvalue()
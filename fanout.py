@@ -0,0 +1,242 @@
+# fanout.py
+"""
+Presence and message fan-out backends for the Socket.IO server.
+
+A backend tracks which usernames are connected to *this* worker and
+delivers published events to them. The server only talks to the backend
+interface (identify / disconnect / publish / publish_many), so the
+deployment can choose:
+
+  local - single process; presence and delivery stay in this worker.
+  unix  - several worker processes on one host. publish() delivers locally
+          and broadcasts the event as a datagram to every other worker's
+          Unix-domain socket, and each worker delivers to its own sockets.
+          No external broker is needed.
+
+Pick one with FANOUT_BACKEND (default "local").
+"""
+import base64
+import errno
+import json
+import os
+import socket
+import threading
+import time
+
+from presence import PresenceRegistry
+
+FANOUT_BACKEND = os.environ.get("FANOUT_BACKEND", "local")
+FANOUT_DIR = os.environ.get("FANOUT_DIR", "/tmp/e2ee-chat-fanout")
+# Unix datagrams are limited by the socket buffers; size them for the
+# largest event payload we expect to broadcast.
+FANOUT_SOCKET_BUFFER = int(os.environ.get("FANOUT_SOCKET_BUFFER", str(4 * 1024 * 1024)))
+PEER_REFRESH_SECONDS = 1.0
+
+
+def _pack(username, event, payload):
+    # payload values may be raw bytes (ciphertext); tag them for JSON
+    packed = {k: ({"$b": base64.b64encode(v).decode("ascii")} if isinstance(v, bytes) else v)
+              for k, v in payload.items()}
+    return {"to": username, "event": event, "payload": packed}
+
+
+def _unpack(msg):
+    msg["payload"] = {k: (base64.b64decode(v["$b"]) if isinstance(v, dict) and "$b" in v else v)
+                      for k, v in msg["payload"].items()}
+    return msg
+
+
+def _encode(username, event, payload):
+    return json.dumps(_pack(username, event, payload)).encode()
+
+
+def _encode_many(events):
+    return json.dumps({"batch": [_pack(*e) for e in events]}).encode()
+
+
+def _decode(data):
+    """Returns the list of events carried by one datagram."""
+    msg = json.loads(data)
+    if "batch" in msg:
+        return [_unpack(m) for m in msg["batch"]]
+    return [_unpack(msg)]
+
+
+class LocalFanout:
+    """In-process presence; fine for a single worker."""
+
+    def __init__(self, deliver):
+        """deliver(sid, event, payload) pushes one event to one local socket."""
+        self.deliver = deliver
+        self.connected = PresenceRegistry()
+
+    def identify(self, username, sid):
+        self.connected.add(username, sid)
+
+    def disconnect(self, sid):
+        """Forget `sid`; returns the usernames that went offline (no sessions left)."""
+        username, offline = self.connected.remove(sid)
+        return [username] if offline else []
+
+    def is_local(self, username):
+        return self.connected.is_online(username)
+
+    def deliver_local(self, username, event, payload):
+        """Push to every session of `username` on this worker; returns True if any was pushed."""
+        sids = self.connected.sessions(username)
+        for sid in sids:
+            self.deliver(sid, event, payload)
+        return bool(sids)
+
+    def publish(self, username, event, payload):
+        """Deliver `event` to `username` wherever it is connected."""
+        return self.deliver_local(username, event, payload)
+
+    def publish_many(self, events):
+        """
+        publish() for a list of (username, event, payload) in one pass.
+        Returns one "pushed on this worker" flag per event.
+        """
+        return [self.deliver_local(*e) for e in events]
+
+
+class UnixSocketFanout(LocalFanout):
+    """
+    Multi-process fan-out over Unix-domain datagram sockets.
+
+    Every worker that has at least one identified client binds
+    FANOUT_DIR/<pid>.sock and runs a receive loop. Publishing broadcasts to
+    all peer sockets in the directory; stale sockets left by dead workers
+    are removed on the first failed send.
+    """
+
+    def __init__(self, deliver, directory=FANOUT_DIR, spawn=None):
+        """
+        spawn(fn) starts a background task; pass socketio.start_background_task
+        so the receive loop is a greenlet under gevent/eventlet.
+        """
+        super().__init__(deliver)
+        self.directory = directory
+        self.spawn = spawn or (lambda fn: threading.Thread(target=fn, daemon=True).start())
+        self._pid = None
+        self._listener = None
+        self._sender = None
+        self._peers = []
+        self._peers_at = 0.0
+        self._lock = threading.Lock()
+
+    def _path_for(self, pid):
+        return os.path.join(self.directory, f"{pid}.sock")
+
+    def _ensure_sender(self):
+        if self._sender is None or self._pid != os.getpid():
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, FANOUT_SOCKET_BUFFER)
+            s.setblocking(False)  # never stall a request on a slow peer
+            self._sender = s
+            if self._pid != os.getpid():
+                # forked child: the parent's listener and presence are not ours
+                self._listener = None
+                self.connected = PresenceRegistry()
+                self._pid = os.getpid()
+        return self._sender
+
+    def _ensure_listening(self):
+        self._ensure_sender()
+        if self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path_for(os.getpid())
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, FANOUT_SOCKET_BUFFER)
+            s.bind(path)
+            self._listener = s
+            self._peers_at = 0.0
+        self.spawn(self._recv_loop)
+
+    def _recv_loop(self):
+        listener = self._listener
+        while True:
+            try:
+                data = listener.recv(FANOUT_SOCKET_BUFFER)
+            except OSError:
+                return
+            try:
+                events = _decode(data)
+            except ValueError:
+                continue
+            for msg in events:
+                self.deliver_local(msg["to"], msg["event"], msg["payload"])
+
+    def _peer_paths(self):
+        now = time.monotonic()
+        if now - self._peers_at > PEER_REFRESH_SECONDS:
+            own = f"{os.getpid()}.sock"
+            try:
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                names = []
+            self._peers = [os.path.join(self.directory, n) for n in names
+                           if n.endswith(".sock") and n != own]
+            self._peers_at = now
+        return self._peers
+
+    def identify(self, username, sid):
+        self._ensure_listening()
+        super().identify(username, sid)
+
+    def publish(self, username, event, payload):
+        self._ensure_sender()
+        pushed = self.deliver_local(username, event, payload)
+        self._broadcast(_encode(username, event, payload))
+        return pushed
+
+    def publish_many(self, events):
+        # one datagram per peer for the whole list (e.g. a group send)
+        # instead of one per event
+        self._ensure_sender()
+        pushed = [self.deliver_local(*e) for e in events]
+        if len(events) == 1:
+            self._broadcast(_encode(*events[0]))
+            return pushed
+        data = _encode_many(events)
+        if len(data) > FANOUT_SOCKET_BUFFER // 2:
+            for e in events:
+                self._broadcast(_encode(*e))
+        else:
+            self._broadcast(data)
+        return pushed
+
+    def _broadcast(self, data):
+        sender = self._ensure_sender()
+        for path in self._peer_paths():
+            try:
+                sender.sendto(data, path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # worker is gone; clean up so later publishes skip it
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                self._peers_at = 0.0
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                    raise
+                # peer's receive buffer is full; it will pick the message up
+                # from history on its next sync
+
+
+def create(deliver, backend=FANOUT_BACKEND, spawn=None):
+    """Build the backend named by `backend` ("local" or "unix")."""
+    if backend == "local":
+        return LocalFanout(deliver)
+    if backend == "unix":
+        return UnixSocketFanout(deliver, spawn=spawn)
+    raise ValueError(f"unknown FANOUT_BACKEND {backend!r}")
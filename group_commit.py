@@ -0,0 +1,121 @@
+# group_commit.py
+"""
+Write-behind pipeline that turns many small INSERT+COMMITs into one
+transaction per batch.
+
+Handlers submit a row and wait on the returned Future. A single writer
+drains the bounded queue, applies up to `max_batch` rows (or whatever
+arrived within `max_delay` seconds) in one transaction, commits once, and
+only then resolves each Future with its result. The caller therefore sees
+exactly the same result as a synchronous insert, but the fsync cost is
+shared by the whole batch.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import metrics
+import storage
+
+batch_sizes = metrics.Histogram("group_commit_batch_size", "Rows per group-commit transaction",
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+batch_seconds = metrics.Histogram("group_commit_batch_duration_seconds",
+                                  "Apply + commit time per group-commit batch")
+
+
+class QueueFull(Exception):
+    """Raised by submit() when the write queue stays full past its timeout."""
+
+
+class CommitTimeout(Exception):
+    """
+    Raised by wait() when an item's batch has not committed in time. The
+    writer still holds the item, so it may be committed afterwards.
+    """
+
+
+def wait(fut, timeout):
+    """The result of a Future from submit(); raises CommitTimeout after `timeout` seconds."""
+    try:
+        return fut.result(timeout=timeout)
+    except FutureTimeout:
+        raise CommitTimeout("write not committed in time")
+
+
+class GroupCommitWriter:
+    def __init__(self, db_path, apply, max_batch=256, max_delay=0.005, queue_size=10000):
+        """
+        apply(conn, items) -> list of results, one per item, in order.
+        It runs inside the batch transaction; raising rolls back the batch
+        and fails every Future in it.
+        """
+        self.db_path = db_path
+        self.apply = apply
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # The writer thread (greenlet under gevent/eventlet) is started lazily
+        # in each worker; a thread started before fork would not survive it.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            t = threading.Thread(target=self._run, args=(self._queue,), name="group-commit", daemon=True)
+            t.start()
+            self._pid = os.getpid()
+
+    def submit(self, item, timeout=1.0):
+        """Queue one item for the next batch and return a Future for its result."""
+        self._ensure_started()
+        fut = Future()
+        try:
+            self._queue.put((item, fut), timeout=timeout)
+        except queue.Full:
+            raise QueueFull("write queue is full")
+        return fut
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _collect(self, q):
+        batch = [q.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # pick up anything else already waiting without extending the deadline
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, q):
+        while True:
+            batch = self._collect(q)
+            items = [item for item, _ in batch]
+            batch_sizes.observe(len(items))
+            try:
+                with batch_seconds.time(), storage.connect(self.db_path) as conn:
+                    results = self.apply(conn, items)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), result in zip(batch, results):
+                fut.set_result(result)
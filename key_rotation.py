@@ -0,0 +1,146 @@
+# key_rotation.py
+"""
+Background re-encryption of server.py's stored messages after a key
+rotation (see FERNET_KEYS in decrypter.py).
+
+Rows whose key_id is not the primary key (or NULL: written before key
+ids) are re-encrypted in small id-ordered batches. Each batch is read and
+decrypted outside any write transaction, then written back in one short
+transaction whose UPDATEs only apply if the row still has the key it was
+read with, so live traffic and a second worker can't be clobbered.
+Progress is saved in the key_rotation table after every batch; a restart
+resumes from the saved cursor as long as the primary key is unchanged.
+
+Legacy hex TEXT ciphertext is converted to raw bytes on the way, the same
+as blob_migration. Rows written by server_e2ee (ephemeral IS NOT NULL)
+are end-to-end encrypted by clients and are never touched.
+
+Run by hand with: python key_rotation.py [messages.db]
+"""
+import base64
+import binascii
+import os
+import sys
+import time
+
+import storage
+import decrypter
+import migrations
+
+KEY_ROTATION_BATCH = int(os.environ.get("KEY_ROTATION_BATCH", "200"))
+KEY_ROTATION_PAUSE = float(os.environ.get("KEY_ROTATION_PAUSE", "0.1"))
+REPORT_EVERY_BATCHES = 50
+
+PENDING_WHERE = "id > ? AND (key_id IS NULL OR key_id != ?){owner_only}"
+SELECT_SQL = "SELECT id, ciphertext, key_id FROM messages WHERE " + PENDING_WHERE + " ORDER BY id LIMIT ?"
+COUNT_SQL = "SELECT COUNT(*) FROM messages WHERE " + PENDING_WHERE
+UPDATE_SQL = "UPDATE messages SET ciphertext=?, key_id=? WHERE id=? AND key_id IS ?"
+
+
+def _reencrypt(ciphertext, key_id):
+    """New raw token under the primary key, or None if it can't be decrypted."""
+    try:
+        if isinstance(ciphertext, str):
+            # legacy hex of the urlsafe-base64 Fernet token
+            ciphertext = base64.urlsafe_b64decode(bytes.fromhex(ciphertext))
+        return decrypter.reencrypt_raw(bytes(ciphertext), key_id)
+    except (decrypter.InvalidToken, binascii.Error, ValueError):
+        return None
+
+
+def progress(db_path):
+    """
+    {"primary_key_id", "last_id", "converted", "failed", "remaining",
+     "started_at", "finished_at"} for the current primary key, or None if
+    no rotation has run for it.
+    """
+    primary = decrypter.PRIMARY_KEY_ID
+    with storage.connect(db_path) as conn:
+        row = conn.execute("SELECT last_id, converted, failed, started_at, finished_at FROM key_rotation "
+                           "WHERE primary_key_id=?", (primary,)).fetchone()
+        if row is None:
+            return None
+        remaining = conn.execute(COUNT_SQL.format(owner_only=_owner_filter(conn)),
+                                 (row[0], primary)).fetchone()[0]
+    return {"primary_key_id": primary, "last_id": row[0], "converted": row[1], "failed": row[2],
+            "remaining": remaining, "started_at": row[3], "finished_at": row[4]}
+
+
+def _owner_filter(conn):
+    return " AND ephemeral IS NULL" if "ephemeral" in storage.table_columns(conn, "messages") else ""
+
+
+last_progress = None  # {"last_id", "converted", "failed"} while this process rotates
+
+
+def rotate(db_path, batch_size=KEY_ROTATION_BATCH, pause=KEY_ROTATION_PAUSE, sleep=time.sleep, report=print):
+    """Re-encrypt every row not on the primary key; returns progress()."""
+    global last_progress
+    primary = decrypter.PRIMARY_KEY_ID
+    migrations.ensure(db_path)  # key_id column and key_rotation table
+    with storage.connect(db_path) as conn:
+        select_sql = SELECT_SQL.format(owner_only=_owner_filter(conn))
+        conn.execute("INSERT OR IGNORE INTO key_rotation (primary_key_id, started_at) VALUES (?, ?)",
+                     (primary, time.time()))
+        last_id, converted, failed = conn.execute(
+            "SELECT last_id, converted, failed FROM key_rotation WHERE primary_key_id=?", (primary,)).fetchone()
+    batches = 0
+    while True:
+        with storage.connect(db_path) as conn:
+            rows = conn.execute(select_sql, (last_id, primary, batch_size)).fetchall()
+        if not rows:
+            break
+        # decrypt/encrypt outside the write lock
+        updates = []
+        for msg_id, ciphertext, key_id in rows:
+            new = _reencrypt(ciphertext, key_id)
+            if new is None:
+                failed += 1  # no configured key opens it; left as is
+            else:
+                updates.append((new, primary, msg_id, key_id))
+        last_id = rows[-1][0]
+        with storage.connect(db_path) as conn:
+            for u in updates:
+                converted += conn.execute(UPDATE_SQL, u).rowcount
+            conn.execute("UPDATE key_rotation SET last_id=?, converted=?, failed=? WHERE primary_key_id=?",
+                         (last_id, converted, failed, primary))
+        last_progress = {"last_id": last_id, "converted": converted, "failed": failed}
+        batches += 1
+        if report and batches % REPORT_EVERY_BATCHES == 0:
+            report(f"key rotation: {converted} rows re-encrypted, at id {last_id}")
+        sleep(pause)  # let request handlers take the write lock
+    with storage.connect(db_path) as conn:
+        conn.execute("UPDATE key_rotation SET finished_at=? WHERE primary_key_id=? AND finished_at IS NULL",
+                     (time.time(), primary))
+    return progress(db_path)
+
+
+def start(db_path, spawn, sleep=time.sleep):
+    """
+    Run rotate() in the background via spawn(fn) unless it already finished
+    for the current primary key. Only one process per database runs it.
+    """
+    def run():
+        lock = storage.try_process_lock(db_path, "key-rotation")
+        if lock is None:
+            return  # another worker is rotating
+        try:
+            result = rotate(db_path, sleep=sleep)
+            if result["converted"] or result["failed"]:
+                print(f"key rotation to {result['primary_key_id']}: {result['converted']} rows re-encrypted, "
+                      f"{result['failed']} undecryptable")
+        except Exception as e:
+            print(f"key rotation: stopped: {e}")  # resumes from the saved cursor on restart
+        finally:
+            lock.close()
+
+    with storage.connect(db_path) as conn:
+        done = conn.execute("SELECT 1 FROM key_rotation WHERE primary_key_id=? AND finished_at IS NOT NULL",
+                            (decrypter.PRIMARY_KEY_ID,)).fetchone()
+    if done is None:
+        spawn(run)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "messages.db"
+    print(rotate(path, pause=0))
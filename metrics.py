@@ -0,0 +1,245 @@
+# metrics.py
+"""
+In-process metrics with a Prometheus text-format exposition (/metrics).
+
+Counters, gauges and histograms live in this worker's memory; recording a
+value is a dict lookup, a bisect and a few additions under a lock (about a
+microsecond), so the instrumentation stays on under full load. Gauges can
+take a callback that is only evaluated when /metrics is scraped, which is
+how queue depths and session counts are exposed without extra bookkeeping.
+
+Every metric carries a fixed list of label names; keep label values to a
+small known set (route templates, event names, stages), never usernames.
+
+Values are per process. Under gunicorn each scrape is answered by whichever
+worker takes it, so scrape workers individually (or run one worker) when
+exact totals matter.
+
+Set METRICS_TOKEN to require "Authorization: Bearer <token>" on /metrics.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# seconds; spans sub-millisecond handlers up to slow history pages
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _num(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self):
+        """Yields (suffix, labelnames, labelvalues, value)."""
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield "", self.labelnames, labels, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_label_str(names, values)} {_num(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        """fn() -> current total, read at scrape time (for counters kept elsewhere)."""
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        if self.fn is not None:
+            yield "", (), (), self.fn()
+            return
+        yield from super()._samples()
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        """
+        fn() is called at scrape time instead of using set()/inc(); it returns
+        a number, or {labelvalues tuple: number} for labelled gauges, or None
+        to skip the sample.
+        """
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self):
+        if self.fn is None:
+            yield from super()._samples()
+            return
+        value = self.fn()
+        if value is None:
+            return
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                yield "", self.labelnames, labels, v
+        else:
+            yield "", (), (), value
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per-bucket counts (not cumulative), then sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def time(self, *labels):
+        """with hist.time("label"): ...  observes the block's duration."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        names = self.labelnames + ("le",)
+        for labels, state in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                total += count
+                yield "_bucket", names, labels + (_num(bound),), total
+            yield "_sum", self.labelnames, labels, state[-1]
+            yield "_count", self.labelnames, labels, total
+
+
+def render():
+    return "\n".join(m.render() for m in _registry) + "\n"
+
+
+# -------------------------
+# Flask / Socket.IO glue
+# -------------------------
+http_seconds = Histogram("http_request_duration_seconds",
+                         "Time to produce the response (streamed bodies excluded)",
+                         ("method", "route"))
+http_responses = Counter("http_responses_total", "HTTP responses by route and status",
+                         ("method", "route", "status"))
+event_seconds = Histogram("socketio_event_duration_seconds", "Socket.IO handler duration", ("event",))
+event_errors = Counter("socketio_event_errors_total", "Socket.IO handlers that raised", ("event",))
+emits = Counter("socketio_emits_total", "Events emitted to client sessions", ("event",))
+
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        route = _route()
+        http_seconds.observe(time.perf_counter() - start, request.method, route)
+        http_responses.inc(request.method, route, response.status_code)
+    return response
+
+
+def init_app(app):
+    """Time every request and serve the registry at /metrics."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+
+def metrics_view():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+def timed_event(event):
+    """Decorator for Socket.IO handlers; place it under @socketio.on(...)."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                event_errors.inc(event)
+                raise
+            finally:
+                event_seconds.observe(time.perf_counter() - start, event)
+        return wrapper
+    return decorate
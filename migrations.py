@@ -0,0 +1,193 @@
+# migrations.py
+"""
+Versioned schema for the chat databases, tracked in PRAGMA user_version.
+
+server.py, server_e2ee.py and database_setup.py used to create their own,
+conflicting messages tables at import time, in every worker. Step 1 brings
+a database made by any of them to the one schema below (adding whatever
+columns it lacks), so both servers can share a messages.db.
+
+Each step runs once, in one transaction together with its version bump,
+so a failed step leaves the database at the previous version. Deploy with
+
+    python migrations.py [messages.db]
+
+before starting the servers; a worker then only reads user_version
+(ensure()). With SCHEMA_AUTO_MIGRATE=1 (the default) a worker that finds
+an older database migrates it itself, under a file lock so only one does
+while the others wait.
+
+Shard files (sharding.py) have their own, shorter list: only the messages
+table and what hangs off it.
+"""
+import fcntl
+import os
+import sys
+
+import storage
+import retention
+import conversations
+import attachments
+import prekeys
+
+SCHEMA_AUTO_MIGRATE = os.environ.get("SCHEMA_AUTO_MIGRATE", "1") == "1"
+
+# the messages table as of version 1 (later steps add to it): every column
+# either server reads or writes; ephemeral/iv are NULL for server.py's
+# owner-mode rows, key_id NULL for server_e2ee's
+MESSAGE_COLUMNS = (
+    ("sender", "TEXT"),
+    ("receiver", "TEXT"),
+    ("ephemeral", "BLOB"),
+    ("iv", "BLOB"),
+    ("ciphertext", "BLOB"),
+    ("timestamp", "TEXT DEFAULT CURRENT_TIMESTAMP"),  # present in every older schema
+    ("group_id", "INTEGER"),
+    ("attachment", "TEXT"),
+    ("delivered_at", "REAL"),
+    ("key_id", "TEXT"),
+)
+
+
+def _messages(conn):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        {", ".join(f"{name} {decl}" for name, decl in MESSAGE_COLUMNS)}
+    )
+    """)
+    columns = storage.table_columns(conn, "messages")
+    for name, decl in MESSAGE_COLUMNS:
+        if name not in columns:
+            conn.execute(f"ALTER TABLE messages ADD COLUMN {name} {decl}")
+    # per-receiver cursor reads: WHERE receiver=? AND id>? ORDER BY id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages (receiver, id)")
+    # a member's group history: WHERE group_id=? AND receiver=? AND id>? ORDER BY id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_group ON messages (group_id, receiver, id) "
+                 "WHERE group_id IS NOT NULL")
+    retention.ensure_schema(conn)
+    conversations.ensure_schema(conn)
+
+
+def _users_and_groups(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        pubkey TEXT NOT NULL,
+        created_at TEXT DEFAULT (datetime('now'))
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chat_groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        created_by TEXT NOT NULL,
+        created_at TEXT DEFAULT (datetime('now'))
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS group_members (
+        group_id INTEGER NOT NULL REFERENCES chat_groups(id) ON DELETE CASCADE,
+        username TEXT NOT NULL,
+        PRIMARY KEY (group_id, username)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_members_username ON group_members (username)")
+
+
+def _key_rotation(conn):
+    # progress of key_rotation.py (kept here: that module needs FERNET_KEY)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS key_rotation (
+        primary_key_id TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        converted INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        started_at REAL NOT NULL,
+        finished_at REAL
+    )
+    """)
+
+
+def _shared_schema(conn):
+    _messages(conn)
+    _users_and_groups(conn)
+    attachments.ensure_schema(conn)
+    _key_rotation(conn)
+
+
+def _sender_index(conn):
+    # admin queries by sender: WHERE sender=? AND id<? ORDER BY id DESC
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender, id)")
+
+
+def _client_ids(conn):
+    # idempotent server_e2ee sends: a retried (sender, client_id) to the same receiver is refused
+    if "client_id" not in storage.table_columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN client_id TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id ON messages (sender, client_id, receiver) "
+                 "WHERE client_id IS NOT NULL")
+
+
+# (version, description, step); versions are consecutive from 1
+MIGRATIONS = [
+    (1, "shared messages table, users, groups, attachments, delivery, conversations, key rotation",
+     _shared_schema),
+    (2, "messages sender index", _sender_index),
+    (3, "messages client_id unique index", _client_ids),
+    (4, "one-time prekeys", prekeys.ensure_schema),
+    (5, "claimed prekey ids", prekeys.ensure_claims_schema),
+]
+SHARD_MIGRATIONS = [
+    (1, "messages table, delivery, conversations", _messages),
+    (2, "messages sender index", _sender_index),
+    (3, "messages client_id unique index", _client_ids),
+]
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path, steps=MIGRATIONS, report=print):
+    """Apply every step above the database's version; returns the versions applied."""
+    applied = []
+    with open(f"{path}.migrate.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+        with storage.connect(path) as conn:
+            current = version(conn)
+            for number, description, step in steps:
+                if number <= current:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                step(conn)
+                conn.execute(f"PRAGMA user_version={number}")
+                conn.commit()
+                applied.append(number)
+                if report:
+                    report(f"{os.path.basename(path)}: schema version {number}: {description}")
+    return applied
+
+
+def ensure(path, steps=MIGRATIONS):
+    """
+    Worker startup check: return if the database is current, else migrate
+    it (SCHEMA_AUTO_MIGRATE) or refuse to start.
+    """
+    latest = steps[-1][0]
+    with storage.connect(path) as conn:
+        current = version(conn)
+    if current == latest:
+        return
+    if current > latest:
+        raise RuntimeError(f"{path} has schema version {current}, newer than this code ({latest})")
+    if not SCHEMA_AUTO_MIGRATE:
+        raise RuntimeError(f"{path} has schema version {current}, this code needs {latest}: "
+                           f"run python migrations.py {path}")
+    migrate(path, steps)
+
+
+if __name__ == "__main__":
+    db = sys.argv[1] if len(sys.argv) > 1 else "messages.db"
+    done = migrate(db)
+    print(f"{db}: schema version {MIGRATIONS[-1][0]}" + ("" if done else " (already current)"))
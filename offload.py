@@ -0,0 +1,49 @@
+# offload.py
+"""
+Run CPU-bound work (decryption) on real OS threads from any worker type.
+
+Under the gevent/eventlet workers, threading is monkey-patched, so a plain
+concurrent.futures pool would just run greenlets on one core. This picks
+the async framework's native thread pool instead: the calling greenlet
+waits cooperatively while the work runs in parallel on OS threads (the
+cryptography primitives release the GIL).
+"""
+import os
+import threading
+
+
+class ThreadOffload:
+    def __init__(self, async_mode, max_workers):
+        self.async_mode = async_mode
+        self.max_workers = max_workers
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        if self._pid == os.getpid():
+            return self._pool
+        with self._lock:
+            if self._pid != os.getpid():
+                if self.async_mode == "gevent":
+                    from gevent.threadpool import ThreadPool
+                    self._pool = ThreadPool(self.max_workers)
+                elif self.async_mode == "eventlet":
+                    import eventlet
+                    self._pool = eventlet.GreenPool(self.max_workers)
+                else:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+        return self._pool
+
+    def map(self, fn, items):
+        """[fn(item) for item in items], spread over the pool; order is kept."""
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        pool = self._get_pool()
+        if self.async_mode == "eventlet":
+            from eventlet import tpool
+            return list(pool.imap(lambda item: tpool.execute(fn, item), items))
+        return list(pool.map(fn, items))
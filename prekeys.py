@@ -0,0 +1,132 @@
+# prekeys.py
+"""
+One-time prekeys for the key directory.
+
+Besides its identity key (users.pubkey) a user uploads batches of one-time
+public keys, each under an id of its own choosing so it can find the
+matching private key later. A sender claims one key per recipient before
+starting a session: claim() deletes and returns the lowest-id key of every
+requested user in a single DELETE ... RETURNING statement, so no key is
+handed out twice, whichever worker the senders hit. A user whose pool is
+empty gets no prekey and the sender falls back to the identity key alone.
+
+A claimed key must never come back: a trigger records each user's highest
+claimed key_id, and uploads skip ids at or below it, so a retried upload
+cannot re-add a key that was handed out meanwhile. Clients therefore
+number their prekeys in increasing order.
+
+Pools hold at most PREKEY_MAX_PER_USER keys. A claim that leaves fewer
+than PREKEY_LOW_WATERMARK (or takes the last one) is reported to the
+caller, which tells the owner to upload more.
+"""
+import json
+import os
+
+PREKEY_MAX_PER_USER = int(os.environ.get("PREKEY_MAX_PER_USER", "1000"))
+PREKEY_LOW_WATERMARK = int(os.environ.get("PREKEY_LOW_WATERMARK", "20"))
+PREKEY_UPLOAD_MAX = 500  # keys per upload request
+PREKEY_MAX_LENGTH = 256  # characters of one (base64) public key
+
+# one primary-key seek per user for its lowest key_id, one more to delete it
+CLAIM_SQL = (
+    "DELETE FROM prekeys WHERE (username, key_id) IN ("
+    "SELECT u.value, (SELECT key_id FROM prekeys WHERE username=u.value ORDER BY key_id LIMIT 1) "
+    "FROM json_each(?) AS u) RETURNING username, key_id, pubkey"
+)
+# keys left per user, counted no further than the watermark
+REMAINING_SQL = (
+    "SELECT u.value, (SELECT COUNT(*) FROM (SELECT 1 FROM prekeys WHERE username=u.value LIMIT ?)) "
+    "FROM json_each(?) AS u"
+)
+
+
+def ensure_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS prekeys (
+        username TEXT NOT NULL,
+        key_id INTEGER NOT NULL,
+        pubkey TEXT NOT NULL,
+        PRIMARY KEY (username, key_id)
+    ) WITHOUT ROWID
+    """)
+
+
+def ensure_claims_schema(conn):
+    # highest key_id ever claimed (deleted) per user
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS prekey_claims (
+        username TEXT PRIMARY KEY,
+        key_id INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS prekeys_claimed AFTER DELETE ON prekeys BEGIN
+        INSERT INTO prekey_claims (username, key_id) VALUES (old.username, old.key_id)
+        ON CONFLICT (username) DO UPDATE SET key_id=max(key_id, excluded.key_id);
+    END
+    """)
+
+
+def parse(data):
+    """
+    [(key_id, pubkey), ...] from an upload's [{"id": 1, "key": "<base64>"}, ...];
+    raises ValueError if malformed.
+    """
+    if not isinstance(data, list) or not data:
+        raise ValueError("prekeys must be a non-empty list")
+    if len(data) > PREKEY_UPLOAD_MAX:
+        raise ValueError(f"at most {PREKEY_UPLOAD_MAX} prekeys per upload")
+    keys = []
+    for k in data:
+        key_id = k.get("id") if isinstance(k, dict) else None
+        pubkey = k.get("key") if isinstance(k, dict) else None
+        if not isinstance(key_id, int) or isinstance(key_id, bool) or not 0 <= key_id < 2 ** 63:
+            raise ValueError("prekey id must be a non-negative integer")
+        if not isinstance(pubkey, str) or not 0 < len(pubkey) <= PREKEY_MAX_LENGTH:
+            raise ValueError(f"prekey key must be a string of 1 to {PREKEY_MAX_LENGTH} characters")
+        keys.append((key_id, pubkey))
+    if len({key_id for key_id, _ in keys}) != len(keys):
+        raise ValueError("prekey ids must be unique")
+    return keys
+
+
+def count(conn, username):
+    return conn.execute("SELECT COUNT(*) FROM prekeys WHERE username=?", (username,)).fetchone()[0]
+
+
+def upload(conn, username, keys):
+    """
+    Add parsed keys to username's pool. An id already in the pool keeps its
+    key and an id at or below the highest claimed one is skipped, so a
+    retried upload is harmless. Returns (stored, skipped, available); raises
+    ValueError if the pool would exceed PREKEY_MAX_PER_USER, and the
+    caller's transaction must then be rolled back.
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")  # no claim between the check and the insert
+    row = conn.execute("SELECT key_id FROM prekey_claims WHERE username=?", (username,)).fetchone()
+    fresh = [(username, key_id, pubkey) for key_id, pubkey in keys if row is None or key_id > row[0]]
+    stored = 0
+    if fresh:
+        stored = conn.executemany("INSERT OR IGNORE INTO prekeys (username, key_id, pubkey) VALUES (?, ?, ?)",
+                                  fresh).rowcount
+    available = count(conn, username)
+    if available > PREKEY_MAX_PER_USER:
+        raise ValueError(f"at most {PREKEY_MAX_PER_USER} prekeys per user ({available - stored} stored)")
+    return stored, len(keys) - stored, available
+
+
+def claim(conn, usernames):
+    """
+    Take one prekey from each user's pool. Returns ({username: (key_id,
+    pubkey)} for the users that had one, {username: keys left} for the
+    users whose pool just went below the watermark or ran out).
+    """
+    claimed = {u: (key_id, pubkey) for u, key_id, pubkey in conn.execute(CLAIM_SQL, (json.dumps(usernames),))}
+    low = {}
+    if claimed:
+        for u, left in conn.execute(REMAINING_SQL, (PREKEY_LOW_WATERMARK, json.dumps(list(claimed)))):
+            # one key per claim, so each crossing is seen exactly once
+            if left == PREKEY_LOW_WATERMARK - 1 or left == 0:
+                low[u] = left
+    return claimed, low
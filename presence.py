@@ -0,0 +1,94 @@
+# presence.py
+"""
+Bidirectional username <-> Socket.IO sid index for one worker.
+
+Every operation is O(1) in the number of connected sockets (O(devices)
+for a user's own sessions), so a reconnect storm no longer rescans the
+whole map on each disconnect. A user may hold several sessions (phone,
+laptop, ...) and every one of them receives pushes.
+
+Memory: a user with a single session costs one dict slot holding the sid
+string itself; only users with a second device are upgraded to a small
+set. Usernames are interned so both indexes share one string object.
+Index overhead is about 120 bytes per connection on top of the sid and
+username strings, i.e. ~12 MB at 100k sockets.
+"""
+import sys
+
+
+class PresenceRegistry:
+    __slots__ = ("_by_user", "_by_sid")
+
+    def __init__(self):
+        self._by_user = {}  # username -> sid (str) or set of sids
+        self._by_sid = {}   # sid -> username
+
+    def add(self, username, sid):
+        """Attach `sid` to `username`; a sid that re-identifies moves to the new user."""
+        previous = self._by_sid.get(sid)
+        if previous == username:
+            return
+        if previous is not None:
+            self._detach(previous, sid)
+        username = sys.intern(username)
+        self._by_sid[sid] = username
+        current = self._by_user.get(username)
+        if current is None:
+            self._by_user[username] = sid
+        elif isinstance(current, set):
+            current.add(sid)
+        else:
+            self._by_user[username] = {current, sid}
+
+    def remove(self, sid):
+        """
+        Drop `sid`. Returns (username, went_offline) where went_offline is True
+        when that was the user's last session; (None, False) for unknown sids.
+        """
+        username = self._by_sid.pop(sid, None)
+        if username is None:
+            return None, False
+        return username, self._detach(username, sid)
+
+    def _detach(self, username, sid):
+        current = self._by_user.get(username)
+        if current is None:
+            return False
+        if isinstance(current, set):
+            current.discard(sid)
+            if len(current) == 1:
+                # back to the compact single-session form
+                self._by_user[username] = next(iter(current))
+            elif not current:
+                del self._by_user[username]
+                return True
+            return False
+        if current == sid:
+            del self._by_user[username]
+            return True
+        return False
+
+    def sessions(self, username):
+        """All sids for `username` (empty tuple when offline)."""
+        current = self._by_user.get(username)
+        if current is None:
+            return ()
+        if isinstance(current, set):
+            return tuple(current)
+        return (current,)
+
+    def user_for(self, sid):
+        return self._by_sid.get(sid)
+
+    def is_online(self, username):
+        return username in self._by_user
+
+    def user_count(self):
+        return len(self._by_user)
+
+    def session_count(self):
+        return len(self._by_sid)
+
+    def clear(self):
+        self._by_user.clear()
+        self._by_sid.clear()
@@ -0,0 +1,110 @@
+# ratelimit.py
+"""
+Flow control for the chat server: inbound token buckets and outbound
+queue limits.
+
+TokenBucketLimiter throttles senders. Each key (a sender name, a client
+IP) gets `burst` tokens that refill at `rate` per second; a send takes one
+token per stored message. State is per worker and bounded: the least
+recently seen keys are forgotten once `maxsize` is reached, which only
+ever makes the limiter more lenient.
+
+OutboundLimiter bounds what a worker buffers for one slow connection.
+Engine.IO keeps an unbounded packet queue per socket, drained as fast as
+the client reads; before pushing to a sid we look at that queue and, when
+it is past `max_queue`, either drop the push ("drop") or disconnect the
+session ("disconnect"). Dropping is safe for stored messages: the client
+gets them back from history or the backlog stream (identify with
+last_seen_id) once it catches up.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, maxsize=100000):
+        """rate: tokens per second (0 disables); burst: bucket size."""
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, cost=1, now=None):
+        """
+        Take `cost` tokens for `key`. Returns 0 when allowed, otherwise the
+        number of seconds until it would be (nothing is taken then). A cost
+        larger than the bucket needs a full bucket and leaves it in debt, so
+        big batches still average out to `rate`.
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic() if now is None else now
+        need = min(cost, self.burst)
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= need:
+                tokens -= cost
+            else:
+                wait = (need - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def refund(self, key, cost=1):
+        """Give back tokens taken by acquire() for a send that did not happen."""
+        if not self.rate:
+            return
+        with self._lock:
+            entry = self._buckets.get(key)
+            if entry is not None:
+                self._buckets[key] = (min(self.burst, entry[0] + cost), entry[1])
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class OutboundLimiter:
+    POLICIES = ("drop", "disconnect")
+
+    def __init__(self, socketio, max_queue, policy="drop", namespace="/"):
+        """max_queue: Engine.IO packets buffered per socket (0 disables)."""
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown outbound policy {policy!r}")
+        self.socketio = socketio
+        self.max_queue = max_queue
+        self.policy = policy
+        self.namespace = namespace
+        self._closing = set()  # sids with a disconnect already scheduled
+
+    def _eio_socket(self, sid):
+        server = self.socketio.server
+        eio_sid = server.manager.eio_sid_from_sid(sid, self.namespace)
+        return server.eio.sockets.get(eio_sid) if eio_sid is not None else None
+
+    def depth(self, sid):
+        sock = self._eio_socket(sid)
+        return sock.queue.qsize() if sock is not None else 0
+
+    def admit(self, sid):
+        """True if a push to `sid` may be queued; False means skip it."""
+        if not self.max_queue or self.depth(sid) < self.max_queue:
+            return True
+        if self.policy == "disconnect" and sid not in self._closing:
+            self._closing.add(sid)
+            self.socketio.start_background_task(self._disconnect, sid)
+        return False
+
+    def _disconnect(self, sid):
+        try:
+            self.socketio.server.disconnect(sid, namespace=self.namespace)
+        finally:
+            self._closing.discard(sid)
+
+    def depths(self):
+        """Queue length of every Engine.IO socket on this worker."""
+        return [s.queue.qsize() for s in list(self.socketio.server.eio.sockets.values())]
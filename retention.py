@@ -0,0 +1,179 @@
+# retention.py
+"""
+Retention for delivered messages.
+
+Receivers ack messages (socket "ack" event or POST /api/messages/ack),
+which stamps messages.delivered_at. A background compactor then:
+
+  1. deletes rows acked more than RETENTION_GRACE_SECONDS ago, in batches
+     of RETENTION_DELETE_BATCH rows, one short transaction each, so writers
+     never wait long for the lock;
+  2. runs PRAGMA incremental_vacuum a few pages at a time so freed pages
+     go back to the filesystem;
+  3. reports how many rows were removed and how many bytes the file shrank.
+
+Incremental vacuum only works when the database has auto_vacuum=INCREMENTAL.
+New database files get it from storage.open_connection(). Converting an existing file needs one
+full VACUUM, which rewrites the whole file under an exclusive lock, so it is
+a manual step:  python retention.py --enable-incremental-vacuum messages.db
+Until then the compactor still deletes rows, and SQLite reuses the free pages.
+"""
+import json
+import os
+import sys
+import time
+
+import storage
+
+RETENTION_GRACE_SECONDS = float(os.environ.get("RETENTION_GRACE_SECONDS", str(7 * 24 * 3600)))
+RETENTION_INTERVAL_SECONDS = float(os.environ.get("RETENTION_INTERVAL_SECONDS", "300"))
+RETENTION_DELETE_BATCH = int(os.environ.get("RETENTION_DELETE_BATCH", "500"))
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", "256"))
+RETENTION_PAUSE_SECONDS = 0.02
+
+DELETE_EXPIRED_SQL = (
+    "DELETE FROM messages WHERE id IN ("
+    "SELECT id FROM messages WHERE delivered_at IS NOT NULL AND delivered_at < ? LIMIT ?)"
+)
+
+
+def ensure_schema(conn):
+    """Add the delivery column/index to an existing messages table."""
+    if "delivered_at" not in storage.table_columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN delivered_at REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_delivered_at "
+                 "ON messages (delivered_at) WHERE delivered_at IS NOT NULL")
+
+
+def mark_delivered(conn, receiver, ids=(), up_to=None, now=None):
+    """
+    Stamp delivered_at on `receiver`'s messages listed in `ids` and/or with
+    id <= up_to. Already-acked rows keep their first timestamp. Returns the
+    number of rows newly marked.
+    """
+    now = now or time.time()
+    marked = 0
+    if ids:
+        marked += conn.execute(
+            "UPDATE messages SET delivered_at=? WHERE receiver=? AND delivered_at IS NULL "
+            "AND id IN (SELECT value FROM json_each(?))",
+            (now, receiver, json.dumps(list(ids)))).rowcount
+    if up_to is not None:
+        marked += conn.execute(
+            "UPDATE messages SET delivered_at=? WHERE receiver=? AND id<=? AND delivered_at IS NULL",
+            (now, receiver, up_to)).rowcount
+    return marked
+
+
+def _file_pages(conn):
+    return conn.execute("PRAGMA page_count").fetchone()[0]
+
+
+def compact(db_path, grace=RETENTION_GRACE_SECONDS, batch=RETENTION_DELETE_BATCH,
+            vacuum_pages=RETENTION_VACUUM_PAGES, pause=RETENTION_PAUSE_SECONDS):
+    """
+    One compaction pass. Returns {"deleted": rows, "reclaimed_bytes": n,
+    "freelist_pages": pages still free, "seconds": duration}.
+    """
+    start = time.monotonic()
+    cutoff = time.time() - grace
+    with storage.connect(db_path) as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        pages_before = _file_pages(conn)
+
+    deleted = 0
+    while True:
+        with storage.connect(db_path) as conn:
+            n = conn.execute(DELETE_EXPIRED_SQL, (cutoff, batch)).rowcount
+        deleted += n
+        if n < batch:
+            break
+        time.sleep(pause)
+
+    if incremental:
+        free = None
+        while True:
+            with storage.connect(db_path) as conn:
+                before, free = free, conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free or free == before:
+                    break  # done, or a reader is pinning the pages
+                # executescript steps the pragma to completion; execute() would
+                # stop after the first page
+                conn.executescript(f"PRAGMA incremental_vacuum({vacuum_pages});")
+            time.sleep(pause)
+
+    with storage.connect(db_path) as conn:
+        pages_after = _file_pages(conn)
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {
+        "deleted": deleted,
+        "reclaimed_bytes": max(pages_before - pages_after, 0) * page_size,
+        "freelist_pages": freelist,
+        "seconds": round(time.monotonic() - start, 3),
+    }
+
+
+last_report = None
+
+
+def compact_all(paths, **kwargs):
+    """compact() each database in `paths`; returns the summed report."""
+    total = {"deleted": 0, "reclaimed_bytes": 0, "freelist_pages": 0, "seconds": 0}
+    for path in paths:
+        for key, value in compact(path, **kwargs).items():
+            total[key] += value
+    total["seconds"] = round(total["seconds"], 3)
+    return total
+
+
+def start(db_path, spawn, sleep=time.sleep, interval=RETENTION_INTERVAL_SECONDS, paths=None, after=None):
+    """
+    Run compact() every `interval` seconds in the background via spawn(fn).
+    Only one process per database runs the loop; pass socketio.sleep as
+    `sleep` so the wait is cooperative. paths(), if given, lists every file
+    to compact on each pass (message shards); the lock stays on db_path.
+    after(), if given, runs at the end of each pass for other periodic
+    cleanup (stale attachment uploads).
+    """
+    def run():
+        global last_report
+        lock = storage.try_process_lock(db_path, "retention")
+        if lock is None:
+            return  # another worker owns compaction
+        while True:
+            sleep(interval)
+            try:
+                last_report = compact_all(paths() if paths else [db_path])
+                if last_report["deleted"] or last_report["reclaimed_bytes"]:
+                    print(f"retention: deleted {last_report['deleted']} rows, "
+                          f"reclaimed {last_report['reclaimed_bytes']} bytes")
+            except Exception as e:
+                print(f"retention: compaction failed: {e}")
+            if after is not None:
+                try:
+                    after()
+                except Exception as e:
+                    print(f"retention: cleanup failed: {e}")
+    spawn(run)
+
+
+def enable_incremental_vacuum(db_path):
+    conn = storage.open_connection(db_path)
+    try:
+        conn.isolation_level = None
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--enable-incremental-vacuum":
+        path = args[1] if len(args) > 1 else "messages.db"
+        print("incremental vacuum enabled" if enable_incremental_vacuum(path) else "failed")
+    else:
+        path = args[0] if args else "messages.db"
+        print(compact(path, pause=0))
@@ -0,0 +1,707 @@
+# segmentlog.py
+"""
+Append-only segment log: an alternative to the SQLite messages table for
+server_e2ee (MESSAGE_STORE=log).
+
+  MESSAGE_LOG_DIR/00000001.seg ...   segments, oldest first
+  MESSAGE_LOG_DIR/acks.log           delivery acks
+  MESSAGE_LOG_DIR/index.ckpt         index checkpoint
+  MESSAGE_LOG_DIR/manifest           compaction generation
+
+Segments are preallocated (sparse) files of SEGMENT_LOG_BYTES. A record is
+an 8-byte header (payload length, crc32) plus the payload, padded to 8
+bytes; a zero header marks the end of what has been written. An append
+writes the batch with its first header zeroed, then that header, so
+readers in other workers see all of it or none of it. Appends take a file
+lock, so ids stay strictly increasing across workers.
+
+Every worker keeps an in-memory index: per receiver, an array of ids and
+an array of (segment << 32 | offset) locators, 16 bytes a message; group
+messages are indexed per (receiver, group) as well. A history read
+bisects the ids and decodes records straight out of a read-only mmap of
+the segment; ciphertext comes back as a memoryview of the mapping, which
+the encoders base64 or frame without an intermediate copy. Before each
+read a worker indexes whatever the others appended (two stat() calls when
+nothing changed). At startup the index comes from the checkpoint and only
+the records after it are scanned.
+
+One worker runs maintenance: it writes the checkpoint every
+SEGMENT_LOG_CHECKPOINT_INTERVAL seconds and compacts retired (full)
+segments, rewriting each without the messages acked more than
+RETENTION_GRACE_SECONDS ago, like retention.py does for SQLite. The other
+workers see the new generation in the manifest and reload their index.
+
+SQLite rows can be copied in (ids and acks kept) with
+  python segmentlog.py import messages.db MESSAGE_LOG_DIR
+"""
+import base64
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+
+import retention
+import storage
+
+SEGMENT_LOG_BYTES = int(os.environ.get("SEGMENT_LOG_BYTES", str(64 * 1024 * 1024)))
+# fdatasync every append; off matches SQLite's synchronous=NORMAL in WAL mode
+SEGMENT_LOG_FSYNC = os.environ.get("SEGMENT_LOG_FSYNC", "0") == "1"
+SEGMENT_LOG_CHECKPOINT_INTERVAL = float(os.environ.get("SEGMENT_LOG_CHECKPOINT_INTERVAL", "60"))
+SEGMENT_LOG_COMPACT_INTERVAL = float(os.environ.get("SEGMENT_LOG_COMPACT_INTERVAL",
+                                                    str(retention.RETENTION_INTERVAL_SECONDS)))
+IMPORT_BATCH = 1000
+
+_HEADER = struct.Struct(">II")    # payload length, crc32
+# id, group_id (-1 for direct), then the field lengths: sender, receiver,
+# timestamp, attachment, ephemeral, iv, ciphertext; the fields follow in order
+_FIXED = struct.Struct(">QqHHHHIII")
+_ACK = struct.Struct(">dqI")      # acked_at, up_to (-1 for none), id count
+_U16 = struct.Struct(">H")
+_U64 = struct.Struct(">Q")
+_CKPT = struct.Struct("=4sQIIQI")  # magic, generation, segment, offset, last_id, keys
+_CKPT_KEY = struct.Struct("=qI")  # group_id (-1: receiver index), entries
+_CKPT_MAGIC = b"SLI" + sys.byteorder[0].encode()  # arrays are stored in native order
+_OFFSET_MASK = 0xFFFFFFFF
+
+
+def _contains(ids, msg_id):
+    i = bisect_left(ids, msg_id)
+    return i < len(ids) and ids[i] == msg_id
+
+
+class _Stale(Exception):
+    """A segment was compacted under us; reload the index."""
+
+
+def _encode(msg_id, row):
+    sender, receiver, group_id, ephemeral, iv, ciphertext, timestamp, attachment = row[:8]
+    fields = [text.encode("utf-8") for text in (sender, receiver, timestamp, attachment or "")]
+    fields += [ephemeral, iv, ciphertext]
+    payload = b"".join([_FIXED.pack(msg_id, -1 if group_id is None else group_id,
+                                    *(len(f) for f in fields))] + fields)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)), payload + b"\0" * (-len(payload) % 8)
+
+
+def _record_size(length):
+    return _HEADER.size + length + (-length % 8)
+
+
+def _texts(view, pos, count):
+    out = []
+    for _ in range(count):
+        (n,) = _U16.unpack_from(view, pos)
+        out.append(str(view[pos + 2:pos + 2 + n], "utf-8"))
+        pos += 2 + n
+    return out, pos
+
+
+def _decode(view, offset):
+    """Record -> (row in HISTORY_SQL column order, receiver). Blobs are memoryviews."""
+    pos = offset + _HEADER.size
+    msg_id, group_id, *lengths = _FIXED.unpack_from(view, pos)
+    # field boundaries: sender, receiver, timestamp, attachment, ephemeral, iv, ciphertext
+    b0 = pos + _FIXED.size
+    b1 = b0 + lengths[0]
+    b2 = b1 + lengths[1]
+    b3 = b2 + lengths[2]
+    b4 = b3 + lengths[3]
+    b5 = b4 + lengths[4]
+    b6 = b5 + lengths[5]
+    row = (msg_id, str(view[b0:b1], "utf-8"), view[b4:b5], view[b5:b6], view[b6:b6 + lengths[6]],
+           str(view[b2:b3], "utf-8"), None if group_id < 0 else group_id, str(view[b3:b4], "utf-8") or None)
+    return row, str(view[b1:b2], "utf-8")
+
+
+def _scan(view, offset):
+    """
+    Yield (offset, next_offset, id, group_id, receiver) for each complete
+    record from `offset` on.
+    """
+    size = len(view)
+    while offset + _HEADER.size <= size:
+        length, crc = _HEADER.unpack_from(view, offset)
+        end = offset + _HEADER.size + length
+        if length == 0 or end > size or zlib.crc32(view[offset + _HEADER.size:end]) != crc:
+            return  # end of the written part (or a torn write the next append overwrites)
+        msg_id, group_id, sender_len, receiver_len = _FIXED.unpack_from(view, offset + _HEADER.size)[:4]
+        pos = offset + _HEADER.size + _FIXED.size + sender_len
+        receiver = str(view[pos:pos + receiver_len], "utf-8")
+        next_offset = offset + _record_size(length)
+        yield offset, next_offset, msg_id, group_id, receiver
+        offset = next_offset
+
+
+class MessageLog:
+    def __init__(self, directory, segment_bytes=SEGMENT_LOG_BYTES, fsync=SEGMENT_LOG_FSYNC):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.RLock()  # greenlets/threads of this worker
+        self._files = {}  # (pid, name) -> open lock file; flock is per open file
+        self._fds = {}  # (pid, segment) -> write fd
+        self._generation = None
+        self._reset()
+
+    def _reset(self):
+        self._ids = {}  # receiver or (receiver, group_id) -> array of ids
+        self._locs = {}  # same keys -> array of segment << 32 | offset
+        self._maps = {}  # segment -> memoryview of its mmap
+        self._segment = 1  # indexed up to (segment, offset)
+        self._offset = 0
+        self.last_id = 0
+        self._marks = {}  # receiver -> ([up_to, ...], [acked_at, ...]), up_to increasing
+        self._acked = {}  # receiver -> {id: acked_at} for ids above the watermark
+        self._acks_offset = 0
+
+    # -- files and locks --
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segment_path(self, segment):
+        return self._path(f"{segment:08d}.seg")
+
+    @contextmanager
+    def _flock(self, name, mode=fcntl.LOCK_EX):
+        key = (os.getpid(), name)
+        f = self._files.get(key)
+        if f is None:
+            f = self._files[key] = open(self._path(name), "a")
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_generation(self):
+        try:
+            with open(self._path("manifest")) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _view(self, segment):
+        view = self._maps.get(segment)
+        if view is None:
+            path = self._segment_path(segment)
+            # "swap" is held exclusively while compaction replaces segments
+            with self._flock("swap.lock", fcntl.LOCK_SH):
+                if self._read_generation() != self._generation:
+                    raise _Stale()
+                try:
+                    with open(path, "rb") as f:
+                        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                except (FileNotFoundError, ValueError):
+                    return None  # not created yet (ValueError: empty file)
+            self._maps[segment] = view
+        return view
+
+    # -- index --
+    def _add(self, key, msg_id, loc):
+        ids = self._ids.get(key)
+        if ids is None:
+            ids = self._ids[key] = array("Q")
+            self._locs[key] = array("Q")
+        ids.append(msg_id)
+        self._locs[key].append(loc)
+
+    def _index(self, segment, offset, msg_id, group_id, receiver):
+        loc = segment << 32 | offset
+        self._add(receiver, msg_id, loc)
+        if group_id >= 0:
+            self._add((receiver, group_id), msg_id, loc)
+        self.last_id = msg_id
+
+    def _scan_tail(self):
+        while True:
+            view = self._view(self._segment)
+            if view is None:
+                return
+            for offset, next_offset, msg_id, group_id, receiver in _scan(view, self._offset):
+                self._index(self._segment, offset, msg_id, group_id, receiver)
+                self._offset = next_offset
+            if not os.path.exists(self._segment_path(self._segment + 1)):
+                return
+            self._segment += 1
+            self._offset = 0
+
+    def _reload(self, generation):
+        self._reset()
+        self._generation = generation
+        self._load_checkpoint()
+
+    def _refresh(self):
+        """Index everything appended since the last call (any worker)."""
+        self._retry(self._scan_tail)
+
+    def _retry(self, fn, *args):
+        # fn reads segments; start over on a fresh index if one was compacted
+        while True:
+            generation = self._read_generation()
+            if generation != self._generation:
+                self._reload(generation)
+            try:
+                return fn(*args)
+            except _Stale:
+                continue
+
+    # -- appends --
+    def _new_segment(self, segment):
+        tmp = self._segment_path(segment) + ".tmp"
+        fd = os.open(tmp, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.segment_bytes)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self._segment_path(segment))
+
+    def _fd(self, segment):
+        key = (os.getpid(), segment)
+        fd = self._fds.get(key)
+        if fd is None:
+            for old in [k for k in self._fds if k[1] < segment]:
+                os.close(self._fds.pop(old))  # retired segments are not written again
+            fd = self._fds[key] = os.open(self._segment_path(segment), os.O_RDWR)
+        return fd
+
+    def _write(self, segment, offset, records):
+        # every header but the first goes out with the batch; the first one
+        # last, so a reader sees the whole batch or none of it
+        fd = self._fd(segment)
+        first_header = records[0][0]
+        os.pwrite(fd, b"".join([bytes(_HEADER.size), records[0][1]] +
+                               [part for record in records[1:] for part in record]), offset)
+        os.pwrite(fd, first_header, offset)
+        if self.fsync:
+            os.fdatasync(fd)
+
+    def _commit(self, batch):
+        # write records at (self._segment, self._offset), then index them and
+        # move the offset past them; a failed write leaves both where they were
+        if not batch:
+            return
+        try:
+            self._write(self._segment, self._offset, [(header, payload) for header, payload, *_ in batch])
+        except BaseException:
+            self._clear(self._segment, self._offset, sum(_HEADER.size + len(r[1]) for r in batch))
+            raise
+        offset = self._offset
+        for header, payload, msg_id, group_id, receiver in batch:
+            self._index(self._segment, offset, msg_id, group_id, receiver)
+            offset += _HEADER.size + len(payload)
+        self._offset = offset
+
+    def _clear(self, segment, offset, length):
+        # zero a failed write so the next append starts from a clean end of log
+        try:
+            os.pwrite(self._fd(segment), bytes(length), offset)
+        except OSError:
+            pass  # the first header goes out last, so the batch is unreadable anyway
+
+    def append(self, rows, ids=None):
+        """
+        Append (sender, receiver, group_id, ephemeral, iv, ciphertext,
+        timestamp, attachment, ...) rows (later fields are not stored);
+        returns their ids. `ids` (increasing, above every stored id) keeps
+        existing ids when importing. If it raises, no row of the batch is
+        stored, except those already written to a segment it had filled.
+        """
+        with self._lock, self._flock("lock"):
+            self._refresh()
+            if ids is None:
+                ids = list(range(self.last_id + 1, self.last_id + 1 + len(rows)))
+            elif ids and ids[0] <= self.last_id:
+                raise ValueError("ids must be above the last stored id")
+            # encode and size-check the whole batch before touching any state
+            records = []
+            for msg_id, row in zip(ids, rows):
+                header, payload = _encode(msg_id, row)
+                if _HEADER.size + len(payload) > self.segment_bytes:
+                    raise ValueError("message is larger than a log segment")
+                records.append((header, payload, msg_id, -1 if row[2] is None else row[2], row[1]))
+            if self._view(self._segment) is None:
+                self._new_segment(self._segment)
+            batch = []  # records for the current segment, from self._offset
+            end = self._offset
+            for record in records:
+                size = _HEADER.size + len(record[1])
+                if end + size > len(self._view(self._segment)):
+                    self._commit(batch)
+                    self._new_segment(self._segment + 1)
+                    self._segment += 1
+                    self._offset = end = 0
+                    batch = []
+                batch.append(record)
+                end += size
+            self._commit(batch)
+        return ids
+
+    # -- reads --
+    def _row(self, loc):
+        return _decode(self._view(loc >> 32), loc & _OFFSET_MASK)[0]
+
+    def rows(self, receiver, since_id, count, group_id=None):
+        """Up to `count` of receiver's rows with id > since_id, oldest first."""
+        with self._lock:
+            return self._retry(self._rows, receiver if group_id is None else (receiver, group_id),
+                               since_id, count)
+
+    def _rows(self, key, since_id, count):
+        self._scan_tail()
+        ids = self._ids.get(key)
+        if ids is None:
+            return []
+        locs = self._locs[key]
+        start = bisect_right(ids, since_id)
+        return [self._row(locs[i]) for i in range(start, min(start + count, len(ids)))]
+
+    def count(self, receiver, after, up_to, sender=None, group_id=None):
+        """
+        receiver's messages with after < id <= up_to: from `sender` (direct
+        messages), or in group `group_id` from anyone but the receiver.
+        """
+        rows = self.rows(receiver, after, 1 << 30, group_id)
+        if group_id is None:
+            return sum(1 for r in rows if r[0] <= up_to and r[1] == sender and r[6] is None)
+        return sum(1 for r in rows if r[0] <= up_to and r[1] != receiver)
+
+    # -- delivery acks --
+    def _apply_ack(self, receiver, acked_at, up_to, ids):
+        ups, times = self._marks.setdefault(receiver, ([], []))
+        if up_to >= 0 and (not ups or up_to > ups[-1]):
+            ups.append(up_to)
+            times.append(acked_at)
+        top = ups[-1] if ups else 0
+        acked = self._acked.setdefault(receiver, {})
+        for msg_id in ids:
+            if msg_id > top:
+                acked.setdefault(msg_id, acked_at)
+        for msg_id in [i for i in acked if i <= top]:
+            del acked[msg_id]
+
+    def _scan_acks(self):
+        try:
+            with open(self._path("acks.log"), "rb") as f:
+                f.seek(self._acks_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        view = memoryview(data)
+        pos = 0
+        while pos + _HEADER.size <= len(view):
+            length, crc = _HEADER.unpack_from(view, pos)
+            end = pos + _HEADER.size + length
+            if end > len(view) or zlib.crc32(view[pos + _HEADER.size:end]) != crc:
+                break
+            acked_at, up_to, n = _ACK.unpack_from(view, pos + _HEADER.size)
+            (receiver,), p = _texts(view, pos + _HEADER.size + _ACK.size, 1)
+            ids = [_U64.unpack_from(view, p + 8 * i)[0] for i in range(n)]
+            self._apply_ack(receiver, acked_at, up_to, ids)
+            pos = end
+        self._acks_offset += pos
+
+    @staticmethod
+    def _ack_record(receiver, acked_at, up_to, ids):
+        name = receiver.encode("utf-8")
+        payload = b"".join([_ACK.pack(acked_at, -1 if up_to is None else up_to, len(ids)),
+                            _U16.pack(len(name)), name] + [_U64.pack(i) for i in ids])
+        return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def mark_delivered(self, receiver, ids=(), up_to=None, now=None):
+        """Same contract as retention.mark_delivered: returns how many messages were newly acked."""
+        now = now or time.time()
+        with self._lock, self._flock("lock"):
+            self._refresh()
+            self._scan_acks()
+            stored = self._ids.get(receiver, array("Q"))
+            ups = self._marks.get(receiver, ([], []))[0]
+            top = ups[-1] if ups else 0
+            acked = self._acked.get(receiver, {})
+            newly = 0
+            # like the SQL version, up_to only covers messages stored by now
+            if up_to is not None:
+                up_to = min(up_to, stored[-1] if stored else 0)
+            if up_to is not None and up_to > top:
+                newly += bisect_right(stored, up_to) - bisect_right(stored, top)
+                newly -= sum(1 for i in acked if i <= up_to)
+                top = up_to
+            else:
+                up_to = None
+            fresh = sorted(i for i in set(ids) if i > top and i not in acked and _contains(stored, i))
+            newly += len(fresh)
+            if up_to is None and not fresh:
+                return newly
+            with open(self._path("acks.log"), "ab") as f:
+                f.write(self._ack_record(receiver, now, up_to, fresh))
+            self._scan_acks()
+        return newly
+
+    def _acked_at(self, receiver, msg_id):
+        ups, times = self._marks.get(receiver, ([], []))
+        i = bisect_left(ups, msg_id)
+        at = times[i] if i < len(ups) else None
+        explicit = self._acked.get(receiver, {}).get(msg_id)
+        if explicit is not None and (at is None or explicit < at):
+            at = explicit
+        return at
+
+    # -- maintenance --
+    def checkpoint(self):
+        """Write the index to index.ckpt so restarts only scan newer records."""
+        with self._lock:
+            self._refresh()
+            self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        parts = [_CKPT.pack(_CKPT_MAGIC, self._generation, self._segment, self._offset,
+                            self.last_id, len(self._ids))]
+        for key, ids in self._ids.items():
+            receiver, group_id = (key, -1) if isinstance(key, str) else key
+            name = receiver.encode("utf-8")
+            parts += [_CKPT_KEY.pack(group_id, len(ids)), _U16.pack(len(name)), name,
+                      ids.tobytes(), self._locs[key].tobytes()]
+        tmp = self._path("index.ckpt.tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"".join(parts))
+        os.replace(tmp, self._path("index.ckpt"))
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._path("index.ckpt"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) < _CKPT.size:
+            return
+        magic, generation, segment, offset, last_id, keys = _CKPT.unpack_from(data, 0)
+        if magic != _CKPT_MAGIC or generation != self._generation:
+            return  # stale or foreign: scan the segments instead
+        view = memoryview(data)
+        pos = _CKPT.size
+        for _ in range(keys):
+            group_id, n = _CKPT_KEY.unpack_from(view, pos)
+            (receiver,), pos = _texts(view, pos + _CKPT_KEY.size, 1)
+            key = receiver if group_id < 0 else (receiver, group_id)
+            ids, locs = array("Q"), array("Q")
+            ids.frombytes(view[pos:pos + 8 * n])
+            locs.frombytes(view[pos + 8 * n:pos + 16 * n])
+            self._ids[key], self._locs[key] = ids, locs
+            pos += 16 * n
+        self._segment, self._offset, self.last_id = segment, offset, last_id
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    def compact(self, grace=retention.RETENTION_GRACE_SECONDS):
+        """
+        Rewrite retired segments without messages acked before now - grace.
+        Returns {"deleted": n, "reclaimed_bytes": n, "segments": rewritten}.
+        """
+        cutoff = time.time() - grace
+        with self._lock, self._flock("lock"):
+            self._refresh()
+            self._scan_acks()
+            retired = [s for s in self._segments() if s < self._segment]
+        deleted = reclaimed = 0
+        rewritten = {}  # segment -> {old offset: new offset or None}
+        for segment in retired:
+            view = self._view(segment)
+            moves, kept, out_offset = {}, [], 0
+            for offset, next_offset, msg_id, _, receiver in _scan(view, 0):
+                acked_at = self._acked_at(receiver, msg_id)
+                if acked_at is not None and acked_at < cutoff:
+                    moves[offset] = None
+                    continue
+                record = view[offset:next_offset]
+                moves[offset] = out_offset
+                kept.append(record)
+                out_offset += len(record)
+            if not any(v is None for v in moves.values()):
+                continue
+            tmp = self._segment_path(segment) + ".compact"
+            with open(tmp, "wb") as f:
+                for record in kept:
+                    f.write(record)
+                f.write(bytes(_HEADER.size))
+                f.flush()
+                os.fsync(f.fileno())
+            deleted += sum(1 for v in moves.values() if v is None)
+            reclaimed += os.path.getsize(self._segment_path(segment)) - out_offset - _HEADER.size
+            rewritten[segment] = moves
+        if not rewritten:
+            return {"deleted": 0, "reclaimed_bytes": 0, "segments": 0}
+
+        with self._lock, self._flock("lock"):
+            self._refresh()
+            self._scan_acks()
+            self._swap(rewritten)
+        return {"deleted": deleted, "reclaimed_bytes": max(reclaimed, 0), "segments": len(rewritten)}
+
+    def _swap(self, rewritten):
+        with self._flock("swap.lock"):
+            for segment in rewritten:
+                os.replace(self._segment_path(segment) + ".compact", self._segment_path(segment))
+                self._maps.pop(segment, None)
+            self._relocate(rewritten)
+            self._rewrite_acks()
+            # checkpoint first: a worker that sees the new generation loads it
+            self._generation = self._read_generation() + 1
+            self._write_checkpoint()
+            tmp = self._path("manifest.tmp")
+            with open(tmp, "w") as f:
+                f.write(str(self._generation))
+            os.replace(tmp, self._path("manifest"))
+
+    def _relocate(self, rewritten):
+        # point the index at the compacted segments and drop purged ids
+        for key in list(self._ids):
+            ids, locs = self._ids[key], self._locs[key]
+            if not any((loc >> 32) in rewritten for loc in locs):
+                continue
+            new_ids, new_locs = array("Q"), array("Q")
+            for msg_id, loc in zip(ids, locs):
+                moves = rewritten.get(loc >> 32)
+                if moves is not None:
+                    offset = moves[loc & _OFFSET_MASK]
+                    if offset is None:
+                        continue
+                    loc = (loc >> 32) << 32 | offset
+                new_ids.append(msg_id)
+                new_locs.append(loc)
+            if new_ids:
+                self._ids[key], self._locs[key] = new_ids, new_locs
+            else:
+                del self._ids[key], self._locs[key]
+
+    def _rewrite_acks(self):
+        # keep only what still says something about a stored message
+        records = []
+        for receiver, (ups, times) in self._marks.items():
+            stored = self._ids.get(receiver)
+            first = stored[0] if stored else None
+            for up_to, acked_at in zip(ups, times):
+                if first is not None and up_to >= first or up_to == ups[-1]:
+                    records.append(self._ack_record(receiver, acked_at, up_to, []))
+        for receiver, acked in self._acked.items():
+            stored = self._ids.get(receiver, array("Q"))
+            by_time = {}
+            for msg_id, acked_at in acked.items():
+                i = bisect_left(stored, msg_id)
+                if i < len(stored) and stored[i] == msg_id:
+                    by_time.setdefault(acked_at, []).append(msg_id)
+            for acked_at, ids in by_time.items():
+                records.append(self._ack_record(receiver, acked_at, None, sorted(ids)))
+        tmp = self._path("acks.log.tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"".join(records))
+        os.replace(tmp, self._path("acks.log"))
+        self._marks, self._acked, self._acks_offset = {}, {}, 0
+        self._scan_acks()
+
+    def start(self, spawn, sleep=time.sleep):
+        """Checkpoint and compact in the background via spawn(fn), in one worker."""
+        def run():
+            lock = storage.try_process_lock(self._path("log"), "maintenance")
+            if lock is None:
+                return  # another worker maintains the log
+            next_compaction = time.time() + SEGMENT_LOG_COMPACT_INTERVAL
+            while True:
+                sleep(SEGMENT_LOG_CHECKPOINT_INTERVAL)
+                try:
+                    if time.time() >= next_compaction:
+                        next_compaction = time.time() + SEGMENT_LOG_COMPACT_INTERVAL
+                        report = self.compact()
+                        if report["deleted"]:
+                            print(f"segment log: compacted {report['segments']} segments, "
+                                  f"deleted {report['deleted']} messages")
+                    self.checkpoint()
+                except Exception as e:
+                    print(f"segment log: maintenance failed: {e}")
+        spawn(run)
+
+    # -- admin --
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            receivers = [k for k in self._ids if isinstance(k, str)]
+            segments = self._segments()
+            return {"segments": len(segments), "active_segment": self._segment,
+                    "bytes": sum(os.stat(self._segment_path(s)).st_blocks * 512 for s in segments),
+                    "receivers": len(receivers), "messages": sum(len(self._ids[k]) for k in receivers),
+                    "last_id": self.last_id, "generation": self._generation}
+
+    def recent(self, sender=None, receiver=None, before_id=None, limit=100):
+        """Newest message metadata, like sharding.recent_messages()."""
+        with self._lock:
+            self._scan_acks()
+            return self._retry(self._recent, sender, receiver, before_id, limit)
+
+    def _recent(self, sender, receiver, before_id, limit):
+        self._scan_tail()
+        if receiver is not None:
+            ids, locs = self._ids.get(receiver, array("Q")), self._locs.get(receiver, array("Q"))
+            candidates = (locs[i] for i in range(bisect_left(ids, before_id or 1 << 63) - 1, -1, -1))
+        else:
+            candidates = (segment << 32 | offset
+                          for segment in reversed(self._segments())
+                          for offset in reversed([r[0] for r in _scan(self._view(segment), 0)]))
+        out = []
+        for loc in candidates:
+            row, to = _decode(self._view(loc >> 32), loc & _OFFSET_MASK)
+            if before_id is not None and row[0] >= before_id or sender is not None and row[1] != sender:
+                continue
+            out.append({"id": row[0], "sender": row[1], "receiver": to, "group_id": row[6],
+                        "timestamp": row[5], "attachment": row[7],
+                        "delivered_at": self._acked_at(to, row[0]), "size": len(row[4])})
+            if len(out) == limit:
+                break
+        return out
+
+
+def import_sqlite(db_path, directory):
+    """Copy server_e2ee rows and their acks from SQLite into a new log; returns rows copied."""
+    log = MessageLog(directory)
+    if os.path.exists(log._segment_path(1)):
+        raise SystemExit(f"{directory} already has a log")
+    conn = storage.open_connection(db_path)
+    copied = 0
+    try:
+        columns = storage.table_columns(conn, "messages")
+        group = "group_id" if "group_id" in columns else "NULL"
+        attachment = "attachment" if "attachment" in columns else "NULL"
+        delivered = "delivered_at" if "delivered_at" in columns else "NULL"
+        c = conn.execute(f"SELECT id, sender, receiver, {group}, ephemeral, iv, ciphertext, timestamp, "
+                         f"{attachment}, {delivered} FROM messages WHERE ephemeral IS NOT NULL ORDER BY id")
+        while True:
+            rows = c.fetchmany(IMPORT_BATCH)
+            if not rows:
+                break
+            # legacy base64 text rows (see blob_migration.py) are stored as bytes
+            raw = [tuple(base64.b64decode(v) if isinstance(v, str) else v for v in r[4:7]) for r in rows]
+            log.append([(r[1], r[2], r[3]) + blobs + (r[7] or "", r[8]) for r, blobs in zip(rows, raw)],
+                       ids=[r[0] for r in rows])
+            acked = {}
+            for r in rows:
+                if r[9] is not None:
+                    acked.setdefault((r[2], r[9]), []).append(r[0])
+            for (receiver, acked_at), ids in acked.items():
+                log.mark_delivered(receiver, ids, now=acked_at)
+            copied += len(rows)
+    finally:
+        conn.close()
+    log.checkpoint()
+    return copied
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) != 3 or args[0] != "import":
+        raise SystemExit("usage: python segmentlog.py import messages.db MESSAGE_LOG_DIR")
+    print(f"{import_sqlite(args[1], args[2])} messages imported")
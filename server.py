@@ -1,32 +1,52 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_socketio import SocketIO, emit, join_room, leave_room
-import sqlite3
 import os
-from decrypter import encrypt_bytes, decrypt_bytes
+import json
+from decrypter import encrypt_to_raw, decrypt_bytes, decrypt_from_raw, PRIMARY_KEY_ID
+import storage
+import migrations
+import blob_migration
+import key_rotation
+import metrics
+from offload import ThreadOffload
 
 app = Flask(__name__, static_folder="static")
 socketio = SocketIO(app, cors_allowed_origins="*")  # real-time support
+metrics.init_app(app)  # per-route timings + GET /metrics
 
 OWNER_TOKEN = os.environ.get("OWNER_TOKEN", "B25X25kfqAbC123")
-DB_PATH = "messages.db"
+DB_PATH = os.environ.get("DB_PATH", "messages.db")
+
+# Streaming owner fetch (?format=ndjson): rows are decrypted DECRYPT_BATCH at
+# a time, split across DECRYPT_WORKERS OS threads.
+DECRYPT_BATCH = int(os.environ.get("DECRYPT_BATCH", "1024"))
+DECRYPT_WORKERS = int(os.environ.get("DECRYPT_WORKERS", str(os.cpu_count() or 1)))
+decrypt_pool = ThreadOffload(socketio.async_mode, DECRYPT_WORKERS)
 
 # ----------------- DATABASE SETUP -----------------
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT,
-        receiver TEXT,
-        ciphertext TEXT,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-init_db()
+# a version check, or the pending migrations (see migrations.py)
+migrations.ensure(DB_PATH)
+# rows written as hex text before BLOB storage are converted in the background
+blob_migration.start(DB_PATH, socketio.start_background_task)
+# rows on an older FERNET_KEYS entry are re-encrypted under the primary key
+key_rotation.start(DB_PATH, socketio.start_background_task, sleep=socketio.sleep)
+
+# ----------------- METRICS -----------------
+stage_seconds = metrics.Histogram("send_stage_duration_seconds",
+                                  "Time per stage of send_message: encrypt, store, emit", ("stage",))
+db_seconds = metrics.Histogram("db_query_duration_seconds", "SQLite statement time by query", ("query",))
+decrypt_seconds = metrics.Histogram("owner_decrypt_duration_seconds", "Decrypting one batch of owner messages")
+pushes = metrics.Counter("message_pushes_total",
+                         "Messages emitted to a joined receiver, or not (no session in the room)",
+                         ("result",))
+sessions = metrics.Gauge("socketio_sessions", "Connected Socket.IO sessions on this worker")
+
+def _decrypt_row(ciphertext, key_id=None):
+    # key_id names the FERNET_KEYS entry; None (older rows) tries each key
+    if isinstance(ciphertext, str):
+        # legacy row not migrated yet: hex of the Fernet token
+        return decrypt_bytes(bytes.fromhex(ciphertext), key_id)
+    return decrypt_from_raw(ciphertext, key_id)
 
 # ----------------- DASHBOARD -----------------
 @app.route('/')
@@ -38,6 +58,7 @@ def dashboard():
 
 # ----------------- SOCKET EVENTS -----------------
 @socketio.on('send_message')
+@metrics.timed_event('send_message')
 def handle_send(data):
     sender = data.get('sender')
     receiver = data.get('receiver')
@@ -48,49 +69,124 @@ def handle_send(data):
         return
 
     # Encrypt message
-    encrypted = encrypt_bytes(message.encode()).hex()
+    with stage_seconds.time('encrypt'):
+        encrypted = encrypt_to_raw(message.encode())
 
     # Save to DB
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (sender, receiver, ciphertext) VALUES (?, ?, ?)",
-              (sender, receiver, encrypted))
-    conn.commit()
-    conn.close()
+    with stage_seconds.time('store'), storage.connect(DB_PATH) as conn:
+        # timestamp set here: tables made by database_setup.py have no default
+        conn.execute("INSERT INTO messages (sender, receiver, ciphertext, key_id, timestamp) "
+                     "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                     (sender, receiver, encrypted, PRIMARY_KEY_ID))
 
     # Emit message to receiver room
-    emit('receive_message', {'sender': sender, 'message': message}, room=receiver)
+    with stage_seconds.time('emit'):
+        online = next(socketio.server.manager.get_participants('/', receiver), None) is not None
+        emit('receive_message', {'sender': sender, 'message': message}, room=receiver)
+    pushes.inc('pushed' if online else 'offline')
+    metrics.emits.inc('receive_message')
 
 # Join room (username)
 @socketio.on('join')
+@metrics.timed_event('join')
 def handle_join(data):
     username = data.get('username')
     if username:
         join_room(username)
 
+@socketio.on('connect')
+def handle_connect():
+    sessions.inc()
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    sessions.dec()
+
 # Fetch messages
 @app.route('/api/messages/<username>', methods=['GET'])
 def fetch_messages(username):
+    """
+    Default: every message for username as one JSON document.
+    ?format=ndjson (or Accept: application/x-ndjson) streams one JSON object
+    per line instead, decrypted in parallel batches, with optional paging:
+      since_id - only ids > since_id;  limit - stop after this many messages
+    The last line is {"next_cursor": <id>, "has_more": bool}.
+    """
     token = request.args.get('token', '')
     if token != OWNER_TOKEN:
         return jsonify({"error": "Unauthorized"}), 403
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT sender, ciphertext, timestamp FROM messages WHERE receiver=?", (username,))
-    rows = c.fetchall()
-    conn.close()
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        try:
+            since_id = int(request.args.get('since_id', 0))
+            limit = int(request.args['limit']) if 'limit' in request.args else None
+        except ValueError:
+            return jsonify({"error": "since_id and limit must be integers"}), 400
+        return Response(_stream_decrypted(username, since_id, limit), mimetype='application/x-ndjson')
+
+    with db_seconds.time('owner_fetch'), storage.connect(DB_PATH) as conn:
+        rows = conn.execute("SELECT sender, ciphertext, timestamp, key_id FROM messages WHERE receiver=?", (username,)).fetchall()
 
     decrypted_messages = []
-    for sender, ciphertext_hex, timestamp in rows:
-        decrypted_messages.append({
-            "sender": sender,
-            "message": decrypt_bytes(bytes.fromhex(ciphertext_hex)).decode(),
-            "timestamp": timestamp
-        })
+    with decrypt_seconds.time():
+        for sender, ciphertext, timestamp, key_id in rows:
+            decrypted_messages.append({
+                "sender": sender,
+                "message": _decrypt_row(ciphertext, key_id).decode(),
+                "timestamp": timestamp
+            })
 
     return jsonify({"messages": decrypted_messages})
 
+def _decrypt_lines(rows):
+    return [json.dumps({"id": msg_id, "sender": sender,
+                        "message": _decrypt_row(ciphertext, key_id).decode(),
+                        "timestamp": timestamp}) + "\n"
+            for msg_id, sender, ciphertext, timestamp, key_id in rows]
+
+def _stream_decrypted(username, since_id, limit):
+    # keyset pages of DECRYPT_BATCH rows, each on a connection of its own, so
+    # a slow reader holds no pooled connection (or read snapshot) meanwhile
+    cursor = since_id
+    remaining = limit
+    has_more = False
+    while remaining is None or remaining > 0:
+        page = DECRYPT_BATCH if remaining is None else min(DECRYPT_BATCH, remaining)
+        with db_seconds.time('owner_fetch'), storage.connect(DB_PATH) as conn:
+            # one row past the page tells whether there are more
+            rows = conn.execute("SELECT id, sender, ciphertext, timestamp, key_id FROM messages "
+                                "WHERE receiver=? AND id>? ORDER BY id ASC LIMIT ?",
+                                (username, cursor, page + 1)).fetchall()
+        more = len(rows) > page
+        rows = rows[:page]
+        if rows:
+            step = -(-len(rows) // DECRYPT_WORKERS)
+            with decrypt_seconds.time():
+                chunks = decrypt_pool.map(_decrypt_lines, [rows[i:i + step] for i in range(0, len(rows), step)])
+            for lines in chunks:
+                yield "".join(lines)
+            cursor = rows[-1][0]
+        if not more:
+            break
+        if remaining is not None:
+            remaining -= len(rows)
+            has_more = remaining == 0
+    yield json.dumps({"next_cursor": cursor, "has_more": has_more}) + "\n"
+
+# ----------------- KEY ROTATION -----------------
+@app.route('/api/admin/key-rotation', methods=['GET'])
+def key_rotation_status():
+    """Progress of the background re-encryption onto the primary key."""
+    token = request.args.get('token', '')
+    if token != OWNER_TOKEN:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify(key_rotation.progress(DB_PATH) or {"primary_key_id": PRIMARY_KEY_ID, "status": "not started"})
+
+metrics.Gauge("key_rotation_rows", "Re-encryption progress for the primary key", ("state",),
+              fn=lambda: key_rotation.last_progress and {
+                  ("converted",): key_rotation.last_progress["converted"],
+                  ("failed",): key_rotation.last_progress["failed"]})
+
 # ----------------- RUN SERVER -----------------
 if __name__ == "__main__":
     socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
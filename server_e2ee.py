@@ -1,52 +1,641 @@
 # server_e2ee.py
 import os
-import sqlite3
 import json
+import hashlib
+import math
+import sqlite3
+import threading
 from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, Response, request, jsonify, send_from_directory, abort
+from werkzeug.wsgi import wrap_file
 from flask_socketio import SocketIO, emit, join_room, leave_room
 
+import storage
+import group_commit
+import fanout
+import wire
+import blob_migration
+import retention
+import attachments
+import conversations
+import migrations
+import prekeys
+import sharding
+import segmentlog
+import metrics
+from cache import LRUCache, RecentMessages
+from ratelimit import TokenBucketLimiter, OutboundLimiter
+
 APP_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(APP_DIR, "messages.db")
+DB_PATH = os.environ.get("DB_PATH", os.path.join(APP_DIR, "messages.db"))
 STATIC_DIR = os.path.join(APP_DIR, "static")
 
+# History paging (GET /api/messages/<username>?since_id=&limit=)
+HISTORY_DEFAULT_LIMIT = int(os.environ.get("HISTORY_DEFAULT_LIMIT", "200"))
+HISTORY_MAX_LIMIT = int(os.environ.get("HISTORY_MAX_LIMIT", "1000"))
+HISTORY_FETCH_BATCH = 100
+
+# Opt-in write-behind for /api/send: rows are committed in batches of up to
+# GROUP_COMMIT_MAX_BATCH, or every GROUP_COMMIT_MAX_DELAY_MS, by one writer
+# per database file.
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", "256"))
+GROUP_COMMIT_MAX_DELAY_MS = float(os.environ.get("GROUP_COMMIT_MAX_DELAY_MS", "5"))
+GROUP_COMMIT_QUEUE_SIZE = int(os.environ.get("GROUP_COMMIT_QUEUE_SIZE", "10000"))
+GROUP_COMMIT_WAIT = float(os.environ.get("GROUP_COMMIT_WAIT", "10"))
+
+# Public-key directory cache. Other workers see a re-registered key after at
+# most KEY_CACHE_TTL seconds. KEY_HTTP_MAX_AGE=0 makes clients revalidate
+# every time (cheap: If-None-Match -> 304).
+KEY_CACHE_SIZE = int(os.environ.get("KEY_CACHE_SIZE", "50000"))
+KEY_CACHE_TTL = float(os.environ.get("KEY_CACHE_TTL", "30"))
+KEY_HTTP_MAX_AGE = int(os.environ.get("KEY_HTTP_MAX_AGE", "0"))
+KEY_LOOKUP_MAX = 500
+
+# Socket "send" event: most messages accepted in one frame
+SOCKET_SEND_MAX_BATCH = int(os.environ.get("SOCKET_SEND_MAX_BATCH", "100"))
+
+# Backlog push after identify: chunks of BACKLOG_CHUNK messages, the next one
+# sent only after the client acks; give up if no ack within BACKLOG_ACK_TIMEOUT.
+BACKLOG_CHUNK = int(os.environ.get("BACKLOG_CHUNK", "100"))
+BACKLOG_ACK_TIMEOUT = float(os.environ.get("BACKLOG_ACK_TIMEOUT", "30"))
+
+# Delivery acks: most ids per ack call. Retention settings live in retention.py.
+ACK_MAX_IDS = 1000
+
+# Idempotent sends: a message may carry a "client_id" (at most
+# CLIENT_ID_MAX_LENGTH characters) unique per sender and receiver; a retry
+# with the same one gets the stored id back and nothing is stored or pushed
+# again. Recently stored client ids are remembered per worker.
+CLIENT_ID_MAX_LENGTH = 64
+CLIENT_ID_CACHE_SIZE = int(os.environ.get("CLIENT_ID_CACHE_SIZE", "100000"))
+CLIENT_ID_CACHE_TTL = float(os.environ.get("CLIENT_ID_CACHE_TTL", "600"))
+
+# Inbox listing (GET /api/conversations/<username>?before=&limit=)
+CONVERSATIONS_DEFAULT_LIMIT = int(os.environ.get("CONVERSATIONS_DEFAULT_LIMIT", "50"))
+CONVERSATIONS_MAX_LIMIT = int(os.environ.get("CONVERSATIONS_MAX_LIMIT", "200"))
+
+# Group conversations: members per group (and so copies per group send)
+GROUP_MAX_MEMBERS = int(os.environ.get("GROUP_MAX_MEMBERS", "256"))
+
+# Send rate limits, in stored messages per second (0 disables), per sender
+# name and per client IP. RATE_LIMIT_IP_HEADER (e.g. X-Forwarded-For) names
+# the header carrying the client address when behind a trusted proxy. The
+# per-IP limit is off by default without it: behind a proxy (Render, say)
+# every client would share the proxy's address and so one bucket.
+RATE_LIMIT_PER_SENDER = float(os.environ.get("RATE_LIMIT_PER_SENDER", "20"))
+RATE_LIMIT_SENDER_BURST = int(os.environ.get("RATE_LIMIT_SENDER_BURST", "60"))
+RATE_LIMIT_IP_HEADER = os.environ.get("RATE_LIMIT_IP_HEADER", "")
+RATE_LIMIT_PER_IP = float(os.environ.get("RATE_LIMIT_PER_IP", "100" if RATE_LIMIT_IP_HEADER else "0"))
+RATE_LIMIT_IP_BURST = int(os.environ.get("RATE_LIMIT_IP_BURST", "300"))
+
+# Outbound pushes: most Engine.IO packets buffered for one slow socket, and
+# what to do past that: "drop" the push or "disconnect" the session.
+OUTBOUND_QUEUE_MAX = int(os.environ.get("OUTBOUND_QUEUE_MAX", "1000"))
+OUTBOUND_POLICY = os.environ.get("OUTBOUND_POLICY", "drop")
+
+# Message storage split by receiver across MESSAGE_SHARDS SQLite files (see
+# sharding.py); 0 keeps every message in DB_PATH. MESSAGE_SHARD_SEGMENT
+# (month|week|day) also starts a new file per shard each period.
+MESSAGE_SHARDS = int(os.environ.get("MESSAGE_SHARDS", "0"))
+MESSAGE_SHARD_DIR = os.environ.get("MESSAGE_SHARD_DIR", os.path.join(os.path.dirname(DB_PATH), "shards"))
+MESSAGE_SHARD_SEGMENT = os.environ.get("MESSAGE_SHARD_SEGMENT", "")
+
+# Message store: "sqlite" (the messages table, optionally sharded as above)
+# or "log", an append-only segment log in MESSAGE_LOG_DIR (see
+# segmentlog.py). Users, groups and inbox summaries stay in DB_PATH.
+MESSAGE_STORE = os.environ.get("MESSAGE_STORE", "sqlite")
+MESSAGE_LOG_DIR = os.environ.get("MESSAGE_LOG_DIR", os.path.join(os.path.dirname(DB_PATH), "messagelog"))
+
+# Recent-message cache: the newest RECENT_CACHE_MESSAGES messages of each
+# recently active receiver, already serialized, within RECENT_CACHE_BYTES per
+# worker; history and backlog reads from inside that window skip SQLite.
+# Off by default (0): enable it only when a single worker process serves
+# every send, since sends stored by another worker would be missing from
+# this worker's cache. Ignored unless FANOUT_BACKEND=local.
+RECENT_CACHE_MESSAGES = int(os.environ.get("RECENT_CACHE_MESSAGES", "0"))
+RECENT_CACHE_BYTES = int(os.environ.get("RECENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# /api/admin/* endpoints need ?token=OWNER_TOKEN; unset disables them
+OWNER_TOKEN = os.environ.get("OWNER_TOKEN", "")
+
 app = Flask(__name__, static_folder=STATIC_DIR)
 app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET", "dev-secret")
 socketio = SocketIO(app, cors_allowed_origins="*")  # cors_allowed_origins restrict in prod
+metrics.init_app(app)  # per-route timings + GET /metrics
+
+# Presence + push delivery. "local" keeps the username -> sid map in this
+# process; FANOUT_BACKEND=unix fans out across gunicorn workers on one host.
+binary_sids = set()  # sessions that identified with {"binary": true}
+outbound = OutboundLimiter(socketio, OUTBOUND_QUEUE_MAX, OUTBOUND_POLICY)
+dropped = metrics.Counter("socketio_outbound_dropped_total",
+                          "Pushes skipped because the session's outbound queue was full", ("event", "policy"))
+
+def _emit_to_sid(sid, event, payload):
+    # payloads carry raw bytes; JSON-only sessions get them as base64
+    if not outbound.admit(sid):
+        dropped.inc(event, outbound.policy)
+        return
+    metrics.emits.inc(event)
+    if sid in binary_sids:
+        socketio.emit(event, wire.binary_payload(payload), to=sid)
+    else:
+        socketio.emit(event, wire.json_payload(payload), to=sid)
+
+presence = fanout.create(_emit_to_sid, spawn=socketio.start_background_task)
+
+# Schema: a version check, or the pending migrations (see migrations.py)
+migrations.ensure(DB_PATH)
+router = None
+if MESSAGE_SHARDS:
+    router = sharding.ShardRouter(MESSAGE_SHARD_DIR, MESSAGE_SHARDS, MESSAGE_SHARD_SEGMENT)
+    router.init()
+message_log = None
+if MESSAGE_STORE == "log":
+    if router is not None:
+        raise ValueError("MESSAGE_STORE=log does not combine with MESSAGE_SHARDS")
+    message_log = segmentlog.MessageLog(MESSAGE_LOG_DIR)
+    # checkpoints and compaction of retired segments, in one worker
+    message_log.start(socketio.start_background_task, sleep=socketio.sleep)
+elif MESSAGE_STORE != "sqlite":
+    raise ValueError(f"unknown MESSAGE_STORE {MESSAGE_STORE!r}")
+
+def _all_message_paths():
+    return [DB_PATH] + (router.all_paths() if router is not None else [])
+
+# existing base64/hex TEXT rows are rewritten as BLOBs in the background
+for _path in _all_message_paths():
+    blob_migration.start(_path, socketio.start_background_task)
+def _purge_stale_uploads():
+    removed = attachments.purge_stale_uploads(DB_PATH)
+    if removed:
+        print(f"attachments: removed {removed} stale uploads")
+
+# acked messages are purged after the grace period by one worker, which
+# also drops attachment uploads abandoned for ATTACHMENT_UPLOAD_TTL
+retention.start(DB_PATH, socketio.start_background_task, sleep=socketio.sleep, paths=_all_message_paths,
+                after=_purge_stale_uploads)
+
+# -------------------------
+# Metrics (see metrics.py; gauges are read when /metrics is scraped)
+# -------------------------
+stage_seconds = metrics.Histogram("send_stage_duration_seconds",
+                                  "Time per stage of accepting a message: decode, store, push", ("stage",))
+db_seconds = metrics.Histogram("db_query_duration_seconds", "SQLite statement time by query", ("query",))
+pushes = metrics.Counter("message_pushes_total",
+                         "Stored messages pushed to a session on this worker, or not (receiver offline here)",
+                         ("result",))
+metrics.Gauge("socketio_sessions", "Identified Socket.IO sessions on this worker",
+              fn=lambda: presence.connected.session_count())
+metrics.Gauge("socketio_users", "Distinct identified users on this worker",
+              fn=lambda: presence.connected.user_count())
+metrics.Gauge("socketio_binary_sessions", "Sessions receiving raw-bytes pushes", fn=lambda: len(binary_sids))
+metrics.Gauge("backlog_streams", "Backlog pushes in progress", fn=lambda: len(backlog_streams))
+metrics.Gauge("group_commit_queue_depth", "Rows waiting for the group-commit writers",
+              fn=lambda: sum(w.depth() for w in list(writers.values())) if GROUP_COMMIT else None)
+metrics.Gauge("recent_cache_receivers", "Receivers with a recent-message ring on this worker",
+              fn=lambda: None if recent is None else len(recent))
+metrics.Gauge("recent_cache_bytes", "Approximate memory held by the recent-message rings",
+              fn=lambda: None if recent is None else recent.bytes)
+metrics.Counter("recent_cache_hits_total", "History and backlog reads served from the recent-message rings",
+                fn=lambda: 0 if recent is None else recent.hits)
+metrics.Counter("recent_cache_misses_total", "History and backlog reads that went to the message store",
+                fn=lambda: 0 if recent is None else recent.misses)
+metrics.Gauge("key_cache_entries", "Public keys in this worker's cache", fn=lambda: len(key_cache))
+metrics.Counter("key_cache_hits_total", "Key lookups served from the cache", fn=lambda: key_cache.hits)
+metrics.Counter("key_cache_misses_total", "Key lookups that went to SQLite", fn=lambda: key_cache.misses)
+metrics.Gauge("socketio_outbound_queue_max", "Longest Engine.IO packet queue on this worker",
+              fn=lambda: max(outbound.depths(), default=0))
+metrics.Gauge("socketio_outbound_queue_total", "Engine.IO packets queued on this worker",
+              fn=lambda: sum(outbound.depths()))
+metrics.Gauge("rate_limit_tracked_keys", "Senders and IPs with a live token bucket", ("kind",),
+              fn=lambda: {("sender",): len(sender_limiter), ("ip",): len(ip_limiter)})
+metrics.Gauge("message_log", "Segment log size (MESSAGE_STORE=log)", ("field",),
+              fn=lambda: message_log and {(k,): v for k, v in message_log.stats().items()
+                                          if k in ("segments", "bytes", "messages")})
+metrics.Gauge("retention_last_run", "Result of this worker's last compaction pass", ("field",),
+              fn=lambda: retention.last_report and {(k,): v for k, v in retention.last_report.items()})
+
+# -------------------------
+# Message storage
+# -------------------------
+INSERT_MESSAGE_SQL = ("INSERT INTO messages (sender, receiver, group_id, ephemeral, iv, ciphertext, timestamp, "
+                      "attachment, client_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_SHARDED_MESSAGE_SQL = ("INSERT INTO messages (id, sender, receiver, group_id, ephemeral, iv, ciphertext, "
+                              "timestamp, attachment, client_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def _summary_rows(rows):
+    return [(r[0], r[1], r[2], r[6]) for r in rows]
+
+def _insert_messages(conn, rows, shard=None):
+    if shard is None:
+        # One executemany for the whole batch. We hold the write lock for the
+        # transaction, so AUTOINCREMENT hands out consecutive ids and they can
+        # be worked out from the last one.
+        conn.executemany(INSERT_MESSAGE_SQL, rows)
+        last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        ids = list(range(last - len(rows) + 1, last + 1))
+    else:
+        ids = sharding.allocate_ids(conn, shard, len(rows))
+        conn.executemany(INSERT_SHARDED_MESSAGE_SQL, [(i,) + row for i, row in zip(ids, rows)])
+    # inbox summaries commit (or roll back) with the messages; with shards,
+    # only those kept in this file (see _record_other_shards)
+    if router is None or not router.segment:
+        keep = None if shard is None else (lambda u: router.shard(u) == shard)
+        with db_seconds.time("conversation_update"):
+            conversations.record(conn, _summary_rows(rows), ids, keep)
+    return ids
+
+def _insert_message_lists(conn, lists, shard=None):
+    # group-commit apply(): each item is one caller's list of rows
+    ids = _insert_messages(conn, [row for rows in lists for row in rows], shard)
+    out = []
+    for rows in lists:
+        out.append(ids[:len(rows)])
+        ids = ids[len(rows):]
+    return out
+
+writers = {}  # write path -> GroupCommitWriter
+
+def _writer(path, shard=None):
+    w = writers.get(path)
+    if w is None:
+        w = writers[path] = group_commit.GroupCommitWriter(
+            path, lambda conn, lists: _insert_message_lists(conn, lists, shard),
+            max_batch=GROUP_COMMIT_MAX_BATCH,
+            max_delay=GROUP_COMMIT_MAX_DELAY_MS / 1000.0,
+            queue_size=GROUP_COMMIT_QUEUE_SIZE,
+        )
+    return w
+
+def _store_in(path, rows, shard=None):
+    if GROUP_COMMIT:
+        with db_seconds.time("group_commit_wait"):
+            return group_commit.wait(_writer(path, shard).submit(rows), GROUP_COMMIT_WAIT)
+    # "insert_transaction" covers connect + insert + commit; the gap to
+    # "insert_messages" is the commit (fsync)
+    with db_seconds.time("insert_transaction"):
+        with storage.connect(path) as conn:
+            with db_seconds.time("insert_messages"):
+                return _insert_messages(conn, rows, shard)
+
+recent = None
+if RECENT_CACHE_MESSAGES > 0 and fanout.FANOUT_BACKEND == "local":
+    recent = RecentMessages(RECENT_CACHE_MESSAGES, RECENT_CACHE_BYTES)
+RECENT_ENTRY_OVERHEAD = 400  # tuple, strings and ring bookkeeping per message, roughly
+
+def _recent_entry(msg_id, row):
+    # a history row (HISTORY_SQL columns) plus its JSON, as _stream_messages writes it
+    sender, receiver, group_id, ephemeral, iv, ciphertext, timestamp, attachment = row[:8]
+    r = (msg_id, sender, ephemeral, iv, ciphertext, timestamp, group_id, attachment)
+    text = _message_json(r)
+    size = len(text) + len(ephemeral) + len(iv) + len(ciphertext) + RECENT_ENTRY_OVERHEAD
+    return receiver, msg_id, group_id, r + (text,), size
+
+def store_messages(rows):
+    """
+    Persist (sender, receiver, group_id, ephemeral, iv, ciphertext, timestamp,
+    attachment, client_id) rows and return their ids once they are committed.
+    Without shards that is one transaction; with them, one per receiver shard.
+    """
+    if recent is None:
+        return _store_messages(rows)
+    receivers = {r[1] for r in rows}
+    recent.begin(receivers)
+    try:
+        ids = _store_messages(rows)
+    except sqlite3.IntegrityError:
+        recent.end(receivers, [])  # rolled back: nothing was stored
+        raise
+    except BaseException:
+        recent.end(receivers)
+        raise
+    recent.end(receivers, [_recent_entry(i, r) for i, r in zip(ids, rows)])
+    return ids
+
+def _store_messages(rows):
+    if message_log is not None:
+        return _store_in_log(rows)
+    if router is None:
+        return _store_in(DB_PATH, rows)
+    by_shard = {}
+    for i, row in enumerate(rows):
+        by_shard.setdefault(router.shard(row[1]), []).append(i)
+    ids = [None] * len(rows)
+    if GROUP_COMMIT:
+        # queue every shard's rows before waiting, so the shards commit together
+        futures = [(idx, _writer(router.write_path(shard), shard).submit([rows[i] for i in idx]))
+                   for shard, idx in by_shard.items()]
+        with db_seconds.time("group_commit_wait"):
+            for idx, fut in futures:
+                for i, msg_id in zip(idx, group_commit.wait(fut, GROUP_COMMIT_WAIT)):
+                    ids[i] = msg_id
+    else:
+        for shard, idx in by_shard.items():
+            for i, msg_id in zip(idx, _store_in(router.write_path(shard), [rows[i] for i in idx], shard)):
+                ids[i] = msg_id
+    _record_other_shards(rows, ids, set() if router.segment else set(by_shard))
+    return ids
+
+def _store_in_log(rows):
+    # one append per batch already, so GROUP_COMMIT does not apply; the inbox
+    # summaries follow in DB_PATH once the messages are in the log
+    with db_seconds.time("log_append"):
+        ids = message_log.append(rows)
+    with db_seconds.time("conversation_update"), storage.connect(DB_PATH) as conn:
+        conversations.record(conn, _summary_rows(rows), ids)
+    return ids
+
+def _record_other_shards(rows, ids, done):
+    # summary rows that could not go in an insert transaction: senders on
+    # other shards, or every row when the messages live in segments
+    pairs = sorted(zip(ids, _summary_rows(rows)))
+    summary = [r for _, r in pairs]
+    order = [i for i, _ in pairs]
+    users = {r[0] for r in rows} | {r[1] for r in rows}
+    with db_seconds.time("conversation_update"):
+        for shard in {router.shard(u) for u in users}:
+            keep = lambda u, shard=shard: router.shard(u) == shard
+            if shard not in done:
+                with storage.connect(router.conversation_path(shard)) as conn:
+                    conversations.record(conn, summary, order, keep)
+                continue
+            # this shard's insert transaction only saw rows to its own
+            # receivers: its senders' conversations that also had rows to
+            # other shards are recorded again from all of their rows
+            spilled = {(r[0], r[2] or r[1]) for r in summary if keep(r[0]) and not keep(r[1])}
+            part = [(r, i) for r, i in zip(summary, order) if keep(r[0]) and (r[0], r[2] or r[1]) in spilled]
+            if part:
+                with storage.connect(router.conversation_path(shard)) as conn:
+                    conversations.record(conn, [r for r, _ in part], [i for _, i in part], keep, receivers=False)
+
+def _message_paths(username):
+    """Files holding username's messages, oldest first."""
+    return [DB_PATH] if router is None else router.message_paths(router.shard(username))
+
+def _conversation_path(username):
+    return DB_PATH if router is None else router.conversation_path(router.shard(username))
+
+def _message_rows(username, sql, params, count, query, group_id=None):
+    """
+    Up to `count` rows of `sql` (a per-receiver query ending in
+    "id>? ORDER BY id ASC LIMIT ?"; params without those two) from every
+    file holding username's messages, in id order, fetched in keyset pages of
+    HISTORY_FETCH_BATCH, each on a connection of its own.
+    With the segment log, username's rows (in group_id, if given) instead.
+    Reads the recent-message cache can answer don't touch either.
+    """
+    since_id = params[-1]
+    params = params[:-1]
+    if recent is not None:
+        cached = recent.page(username, since_id, count, group_id)
+        if cached is not None:
+            yield from cached
+            return
+    if message_log is not None:
+        with db_seconds.time(query):
+            rows = message_log.rows(username, since_id, count, group_id)
+        yield from rows
+        return
+    for path in _message_paths(username):
+        while count:
+            # the connection goes back to the pool before the page is
+            # yielded, however slowly the caller consumes it
+            page = min(count, HISTORY_FETCH_BATCH)
+            with db_seconds.time(query), storage.connect(path) as conn:
+                rows = conn.execute(sql, params + (since_id, page)).fetchall()
+            yield from rows
+            count -= len(rows)
+            if len(rows) < page:
+                break
+            since_id = rows[-1][0]
+        if not count:
+            return
+
+def _mark_delivered(username, ids, up_to):
+    if message_log is not None:
+        with db_seconds.time("mark_delivered"):
+            return message_log.mark_delivered(username, ids, up_to)
+    acked = 0
+    for path in _message_paths(username):
+        with db_seconds.time("mark_delivered"), storage.connect(path) as conn:
+            acked += retention.mark_delivered(conn, username, ids, up_to)
+    return acked
+
+def store_message(row):
+    return store_messages([row])[0]
 
-# In-memory map username -> socket session id (works for single-process dev)
-connected = {}  # username -> sid
-
-# Initialize DB if needed
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        username TEXT PRIMARY KEY,
-        pubkey TEXT NOT NULL,
-        created_at TEXT DEFAULT (datetime('now'))
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT,
-        receiver TEXT,
-        ephemeral TEXT,
-        iv TEXT,
-        ciphertext TEXT,
-        timestamp TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-init_db()
+MESSAGE_FIELDS = ("sender","receiver","ephemeral","iv","ciphertext")
+
+def _validate_message(data):
+    """
+    Check one message from HTTP JSON or a socket frame and return a copy with
+    the binary fields as bytes. They may arrive as base64 strings or, from
+    socket clients, as raw binary attachments. An optional "attachment" is
+    the sha256 of an uploaded blob. Raises wire.DecodeError.
+    """
+    if not isinstance(data, dict) or not all(k in data for k in MESSAGE_FIELDS):
+        raise wire.DecodeError("missing fields")
+    msg = dict(data)
+    for k in wire.BINARY_FIELDS:
+        if not isinstance(msg[k], bytes):
+            msg[k] = wire.from_b64(msg[k])
+    msg["attachment"] = msg.get("attachment") or None
+    if msg["attachment"] is not None and not attachments.valid_hash(msg["attachment"]):
+        raise wire.DecodeError("attachment must be a sha256 hex digest")
+    msg["client_id"] = _validate_client_id(msg.get("client_id"))
+    return msg
+
+def _validate_client_id(client_id):
+    if client_id is None:
+        return None
+    if not isinstance(client_id, str) or not 0 < len(client_id) <= CLIENT_ID_MAX_LENGTH:
+        raise wire.DecodeError(f"client_id must be a string of 1 to {CLIENT_ID_MAX_LENGTH} characters")
+    return client_id
+
+def _check_attachments(messages):
+    """Raises wire.DecodeError unless every referenced blob has been fully uploaded."""
+    wanted = {m["attachment"] for m in messages if m.get("attachment")}
+    if not wanted:
+        return
+    with db_seconds.time("attachment_lookup"), storage.connect(DB_PATH) as conn:
+        found = {r[0] for r in conn.execute(
+            "SELECT sha256 FROM attachments WHERE sha256 IN (SELECT value FROM json_each(?))",
+            (json.dumps(sorted(wanted)),))}
+    if wanted - found:
+        raise wire.DecodeError("unknown attachment; finish the upload first")
+
+def accept_messages(messages, group_id=None):
+    """
+    Store validated messages in one transaction, then push them to their
+    receivers in one pass. Returns the stored ids in order. A message whose
+    client_id is already stored is neither stored nor pushed again; its
+    original id is returned.
+    """
+    timestamp = datetime.utcnow().isoformat()
+    rows = [(m["sender"], m["receiver"], group_id, m["ephemeral"], m["iv"], m["ciphertext"], timestamp,
+             m.get("attachment"), m.get("client_id")) for m in messages]
+    keys = [(r[0], r[1], r[8]) if r[8] is not None else None for r in rows]
+    ids, claimed = _claim_client_ids(keys)
+    try:
+        for attempt in range(2):
+            new = _unstored(keys, ids)
+            if not new:
+                stored = []  # every message is a replay: no transaction, no write lock
+                break
+            try:
+                with stage_seconds.time("store"):
+                    stored = store_messages([rows[i] for i in new])
+                break
+            except sqlite3.IntegrityError:
+                # another worker stored one of these client ids first (with
+                # group commit, possibly one of another request's in our batch)
+                if attempt:
+                    raise
+                found = _stored_client_ids({k for k in keys if k is not None})
+                for i, msg_id in _replayed(keys, found, "conflict").items():
+                    ids[i] = msg_id
+        for i, msg_id in zip(new, stored):
+            ids[i] = msg_id
+            if keys[i] is not None:
+                client_ids.set(keys[i], msg_id)
+    finally:
+        for k in claimed:
+            client_ids_inflight.pop(k).set()
+    # duplicates inside one batch share the first copy's id
+    first = {}
+    for i, k in enumerate(keys):
+        if k is not None:
+            ids[i] = first.setdefault(k, ids[i])
+    _push([rows[i] for i in new], stored)
+    return ids
+
+def _unstored(keys, ids):
+    # indexes to store: messages without a client_id, and the first copy of each one not yet stored
+    new, seen = [], set()
+    for i, (k, msg_id) in enumerate(zip(keys, ids)):
+        if k is None:
+            new.append(i)
+        elif msg_id is None and k not in seen:
+            seen.add(k)
+            new.append(i)
+    return new
+
+def _push(rows, ids):
+    # push only after commit
+    with stage_seconds.time("push"):
+        events = [(receiver, "message", {"id": msg_id, "sender": sender, "group_id": gid, "ephemeral": eph,
+                                         "iv": iv, "ciphertext": ct, "timestamp": ts, "attachment": att})
+                  for (sender, receiver, gid, eph, iv, ct, ts, att, _), msg_id in zip(rows, ids)]
+        for pushed in presence.publish_many(events):
+            pushes.inc("pushed" if pushed else "offline")
+
+# -------------------------
+# Idempotent sends (client_id)
+# -------------------------
+client_ids = LRUCache(maxsize=CLIENT_ID_CACHE_SIZE, ttl=CLIENT_ID_CACHE_TTL)  # (sender, receiver, client_id) -> id
+client_ids_inflight = {}  # key -> threading.Event, set once the send storing it returns
+replays = metrics.Counter("send_replays_total", "Retried sends answered with the stored id, by where it was found",
+                          ("source",))
+metrics.Gauge("client_id_cache_entries", "Client message ids in this worker's cache", fn=lambda: len(client_ids))
+
+CLIENT_ID_LOOKUP_SQL = (
+    "SELECT m.sender, m.receiver, m.client_id, m.id FROM json_each(?) AS k JOIN messages AS m "
+    "ON m.sender=json_extract(k.value, '$[0]') AND m.client_id=json_extract(k.value, '$[2]') "
+    "AND m.receiver=json_extract(k.value, '$[1]')"
+)
+
+def _stored_client_ids(keys):
+    """{key: id} for (sender, receiver, client_id) keys already stored."""
+    found = {}
+    missing = []
+    for k in keys:
+        msg_id = client_ids.get(k)
+        if msg_id is None:
+            missing.append(k)
+        else:
+            found[k] = msg_id
+    if missing and message_log is None:
+        # the segment log has no client_id index; only the cache catches retries there
+        by_path = {}
+        for k in missing:
+            for path in _message_paths(k[1]):
+                by_path.setdefault(path, []).append(k)
+        for path, part in by_path.items():
+            with db_seconds.time("client_id_lookup"), storage.connect(path) as conn:
+                for sender, receiver, client_id, msg_id in conn.execute(CLIENT_ID_LOOKUP_SQL, (json.dumps(part),)):
+                    found[(sender, receiver, client_id)] = msg_id
+                    client_ids.set((sender, receiver, client_id), msg_id)
+    return found
+
+def _replayed(keys, found, source):
+    # {index: stored id} for the messages whose key is in found
+    out = {i: found[k] for i, k in enumerate(keys) if k in found}
+    if out:
+        replays.inc(source, amount=len(out))
+    return out
+
+def _claim_client_ids(keys):
+    """
+    Returns (ids, claimed): ids has the stored id of every message already
+    stored (None for the rest); claimed are the keys this send now stores.
+    A key another send in this worker is storing right now is waited for.
+    """
+    ids = [None] * len(keys)
+    wanted = {k for k in keys if k is not None}
+    if not wanted:
+        return ids, wanted
+    for source in ("lookup", "inflight"):
+        for i, msg_id in _replayed(keys, _stored_client_ids(wanted), source).items():
+            ids[i] = msg_id
+            wanted.discard(keys[i])
+        busy = [client_ids_inflight[k] for k in wanted if k in client_ids_inflight]
+        if not busy:
+            break
+        for event in busy:
+            event.wait(GROUP_COMMIT_WAIT)
+    # a send still in flight after the wait is left to the unique index
+    claimed = {k for k in wanted if k not in client_ids_inflight}
+    for k in claimed:
+        client_ids_inflight[k] = threading.Event()
+    return ids, claimed
 
 # -------------------------
 # Key directory endpoints
 # -------------------------
+key_cache = LRUCache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL)  # username -> (pubkey, etag)
+
+def _key_entry(pubkey):
+    return pubkey, hashlib.sha256(pubkey.encode()).hexdigest()[:32]
+
+def _lookup_keys(usernames):
+    """Returns {username: (pubkey, etag)} for the usernames that exist."""
+    found = {}
+    misses = []
+    for u in usernames:
+        entry = key_cache.get(u)
+        if entry is None:
+            misses.append(u)
+        else:
+            found[u] = entry
+    if misses:
+        with db_seconds.time("key_lookup"), storage.connect(DB_PATH) as conn:
+            rows = conn.execute(
+                "SELECT username, pubkey FROM users WHERE username IN (SELECT value FROM json_each(?))",
+                (json.dumps(misses),)).fetchall()
+        for username, pubkey in rows:
+            entry = found[username] = _key_entry(pubkey)
+            key_cache.set(username, entry)
+    return found
+
+def _key_cache_headers(resp, etag):
+    resp.set_etag(etag)
+    if KEY_HTTP_MAX_AGE:
+        resp.headers["Cache-Control"] = f"private, max-age={KEY_HTTP_MAX_AGE}"
+    else:
+        resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
 @app.route("/api/keys", methods=["POST"])
 def register_key():
     """
@@ -58,23 +647,166 @@ def register_key():
     if not username or not pubkey:
         return jsonify({"error":"missing fields"}), 400
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO users (username, pubkey) VALUES (?, ?)", (username, pubkey))
-    conn.commit()
-    conn.close()
+    with db_seconds.time("register_key"), storage.connect(DB_PATH) as conn:
+        conn.execute("INSERT OR REPLACE INTO users (username, pubkey) VALUES (?, ?)", (username, pubkey))
+    key_cache.invalidate(username)
     return jsonify({"status":"ok"}), 201
 
 @app.route("/api/keys/<username>", methods=["GET"])
 def get_key(username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT pubkey FROM users WHERE username=?", (username,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    entry = _lookup_keys([username]).get(username)
+    if entry is None:
+        return jsonify({"error":"not found"}), 404
+    pubkey, etag = entry
+    if request.if_none_match.contains(etag):
+        return _key_cache_headers(app.response_class(status=304), etag)
+    return _key_cache_headers(jsonify({"username": username, "pubkey": pubkey}), etag)
+
+@app.route("/api/keys/lookup", methods=["POST"])
+def lookup_keys():
+    """
+    Request json: { "usernames": ["alice", "bob", ...] }  (at most KEY_LOOKUP_MAX)
+    Response: { "keys": { "alice": "<pubkey>", ... }, "missing": ["carol"] }
+    """
+    data = request.get_json(silent=True) or {}
+    usernames = data.get("usernames")
+    if not isinstance(usernames, list) or not all(isinstance(u, str) for u in usernames):
+        return jsonify({"error":"usernames must be a list of strings"}), 400
+    if len(usernames) > KEY_LOOKUP_MAX:
+        return jsonify({"error":f"at most {KEY_LOOKUP_MAX} usernames per lookup"}), 400
+
+    found = _lookup_keys(dict.fromkeys(usernames))
+    return jsonify({
+        "keys": {u: entry[0] for u, entry in found.items()},
+        "missing": [u for u in dict.fromkeys(usernames) if u not in found],
+    })
+
+# -------------------------
+# One-time prekeys (see prekeys.py)
+# -------------------------
+prekey_claims = metrics.Counter("prekey_claims_total", "Prekey claims by outcome", ("result",))
+prekeys_uploaded = metrics.Counter("prekeys_uploaded_total", "One-time prekeys stored")
+
+def _prekeys_low(username, available):
+    return username, "prekeys_low", {"available": available, "watermark": prekeys.PREKEY_LOW_WATERMARK}
+
+@app.route("/api/keys/<username>/prekeys", methods=["POST"])
+def upload_prekeys(username):
+    """
+    Request json: { "prekeys": [{"id": 1, "key": "<base64 raw public key>"}, ...] }
+    At most PREKEY_UPLOAD_MAX keys per request and PREKEY_MAX_PER_USER in the
+    pool (409 beyond that); the user needs a registered identity key. Ids
+    already in the pool, or at or below one already claimed, are skipped.
+    Response: { "stored": n, "skipped": n, "available": total }
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        keys = prekeys.parse(data.get("prekeys"))
+    except ValueError as e:
+        return jsonify({"error":str(e)}), 400
+    if username not in _lookup_keys([username]):
         return jsonify({"error":"not found"}), 404
-    return jsonify({"username": username, "pubkey": row[0]})
+    try:
+        with db_seconds.time("prekey_upload"), storage.connect(DB_PATH) as conn:
+            stored, skipped, available = prekeys.upload(conn, username, keys)
+    except ValueError as e:
+        return jsonify({"error":str(e)}), 409
+    prekeys_uploaded.inc(amount=stored)
+    return jsonify({"stored":stored,"skipped":skipped,"available":available}), 201
+
+@app.route("/api/keys/<username>/prekeys", methods=["GET"])
+def count_prekeys(username):
+    """Response: { "available": n }, the one-time prekeys left in username's pool."""
+    with db_seconds.time("prekey_count"), storage.connect(DB_PATH) as conn:
+        return jsonify({"available": prekeys.count(conn, username)})
+
+@app.route("/api/keys/claim", methods=["POST"])
+def claim_prekeys():
+    """
+    Request json: { "usernames": ["bob", "carol", ...] }  (at most KEY_LOOKUP_MAX)
+    Takes one one-time prekey from each user's pool, in one statement; a
+    claimed key is never handed out again. Response:
+    { "bundles": { "bob": {"pubkey": "<identity key>", "prekey": {"id": 7, "key": "<base64>"}}, ... },
+      "missing": ["dave"] }
+    prekey is null when the pool is empty. Owners whose pool drops below
+    PREKEY_LOW_WATERMARK get a "prekeys_low" socket event.
+    """
+    data = request.get_json(silent=True) or {}
+    usernames = data.get("usernames")
+    if not isinstance(usernames, list) or not all(isinstance(u, str) for u in usernames):
+        return jsonify({"error":"usernames must be a list of strings"}), 400
+    if len(usernames) > KEY_LOOKUP_MAX:
+        return jsonify({"error":f"at most {KEY_LOOKUP_MAX} usernames per claim"}), 400
+
+    found = _lookup_keys(dict.fromkeys(usernames))
+    claimed, low = {}, {}
+    if found:
+        with db_seconds.time("prekey_claim"), storage.connect(DB_PATH) as conn:
+            claimed, low = prekeys.claim(conn, list(found))
+    prekey_claims.inc("prekey", amount=len(claimed))
+    if len(found) > len(claimed):
+        prekey_claims.inc("empty", amount=len(found) - len(claimed))
+    if low:
+        presence.publish_many([_prekeys_low(u, left) for u, left in low.items()])
+    bundles = {}
+    for u, (pubkey, _) in found.items():
+        key = claimed.get(u)
+        bundles[u] = {"pubkey": pubkey, "prekey": key and {"id": key[0], "key": key[1]}}
+    return jsonify({
+        "bundles": bundles,
+        "missing": [u for u in dict.fromkeys(usernames) if u not in found],
+    })
+
+# -------------------------
+# Rate limiting
+# -------------------------
+sender_limiter = TokenBucketLimiter(RATE_LIMIT_PER_SENDER, RATE_LIMIT_SENDER_BURST)
+ip_limiter = TokenBucketLimiter(RATE_LIMIT_PER_IP, RATE_LIMIT_IP_BURST)
+throttled = metrics.Counter("rate_limited_total", "Sends rejected by the rate limiter", ("kind",))
+
+def _client_ip():
+    if RATE_LIMIT_IP_HEADER and request.headers.get(RATE_LIMIT_IP_HEADER):
+        return request.headers[RATE_LIMIT_IP_HEADER].split(",")[0].strip()
+    return request.remote_addr
+
+def _throttle(sender, count=1):
+    """
+    Charge `count` messages to `sender` and to the client IP. Returns 0 when
+    the send may go ahead, else the seconds to wait before retrying; a
+    rejected send is charged to neither.
+    """
+    return _throttle_senders({sender: count})
+
+def _throttle_senders(counts):
+    """
+    _throttle for a batch of {sender: messages}: every sender is charged for
+    their own messages and the client IP for all of them, or, when any one
+    of those is over its limit, nobody is charged at all.
+    """
+    charged = []
+    for sender, count in counts.items():
+        wait = sender_limiter.acquire(sender, count)
+        if wait:
+            throttled.inc("sender")
+            break
+        charged.append((sender, count))
+    else:
+        wait = ip_limiter.acquire(_client_ip(), sum(counts.values()))
+        if not wait:
+            return 0
+        throttled.inc("ip")
+    for sender, count in charged:
+        sender_limiter.refund(sender, count)
+    return wait
+
+# GROUP_COMMIT_WAIT ran out: the batch may still commit, but is not pushed
+STORE_TIMEOUT_ERROR = "store timed out; the message may still be stored, retry with the same client_id"
+
+def _too_many_requests(wait):
+    resp = jsonify({"error":"rate limited","retry_after":round(wait, 3)})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(max(1, math.ceil(wait)))
+    return resp
 
 # -------------------------
 # Message endpoints
@@ -90,59 +822,558 @@ def api_send():
       "iv": "<base64 iv>",
       "ciphertext": "<base64 ciphertext>"
     }
+    or the same fields as a binary frame with
+    Content-Type: application/x-e2ee-message (see wire.py).
+    An optional "client_id" (X-Client-Id header for binary frames) makes a
+    retry return the first send's id without storing or pushing it again.
+    429 with Retry-After when the sender or client IP is over its rate limit.
+    503 when the write queue is full, or when GROUP_COMMIT is on and the
+    batch does not commit within GROUP_COMMIT_WAIT. The message may then
+    still be stored (though never pushed); only a retry with the same
+    client_id is safe from storing it twice.
     """
-    data = request.get_json()
-    required = ("sender","receiver","ephemeral","iv","ciphertext")
-    if not data or not all(k in data for k in required):
-        return jsonify({"error":"missing fields"}), 400
+    try:
+        with stage_seconds.time("decode"):
+            if request.mimetype == wire.MESSAGE_CONTENT_TYPE:
+                msg = wire.decode_send(request.get_data())
+                msg["client_id"] = _validate_client_id(request.headers.get("X-Client-Id"))
+            else:
+                msg = _validate_message(request.get_json())
+            _check_attachments([msg])
+    except wire.DecodeError as e:
+        return jsonify({"error":str(e)}), 400
 
-    sender = data["sender"]
-    receiver = data["receiver"]
-    eph = data["ephemeral"]
-    iv = data["iv"]
-    ct = data["ciphertext"]
-    timestamp = datetime.utcnow().isoformat()
+    wait = _throttle(msg["sender"])
+    if wait:
+        return _too_many_requests(wait)
+    try:
+        msg_id = accept_messages([msg])[0]
+    except group_commit.QueueFull:
+        return jsonify({"error":"server busy"}), 503
+    except group_commit.CommitTimeout:
+        return jsonify({"error":STORE_TIMEOUT_ERROR}), 503
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (sender, receiver, ephemeral, iv, ciphertext, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-              (sender, receiver, eph, iv, ct, timestamp))
-    msg_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    return jsonify({"status":"stored","id":msg_id}), 201
+
+def _parse_ack(data):
+    """Returns (ids, up_to) from an ack body; raises ValueError if malformed."""
+    ids = data.get("ids") or []
+    up_to = data.get("up_to")
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+        raise ValueError("ids must be a list of integers")
+    if len(ids) > ACK_MAX_IDS:
+        raise ValueError(f"at most {ACK_MAX_IDS} ids per ack")
+    if up_to is not None and not isinstance(up_to, int):
+        raise ValueError("up_to must be an integer")
+    if not ids and up_to is None:
+        raise ValueError("nothing to ack")
+    return ids, up_to
+
+@app.route("/api/messages/ack", methods=["POST"])
+def api_ack_messages():
+    """
+    Mark messages as delivered so they can be purged after the grace period.
+    { "username": "bob", "ids": [12, 15], "up_to": 40 }
+    ids and up_to are both optional (at least one is required); up_to acks
+    every message with id <= up_to.
+    """
+    data = request.get_json(silent=True) or {}
+    username = data.get("username")
+    if not username:
+        return jsonify({"error":"missing fields"}), 400
+    try:
+        ids, up_to = _parse_ack(data)
+    except ValueError as e:
+        return jsonify({"error":str(e)}), 400
+    acked = _mark_delivered(username, ids, up_to)
+    return jsonify({"status":"ok","acked":acked})
 
 @app.route('/')
 def dashboard():
     return send_from_directory('static', 'dashboard.html')
 
+@app.route("/api/messages/<username>", methods=["GET"])
+def api_get_messages(username):
+    """
+    Returns stored messages for username (ciphertexts only), oldest first.
+    Query params:
+      since_id  - only messages with id > since_id (default 0)
+      limit     - page size (default HISTORY_DEFAULT_LIMIT, max HISTORY_MAX_LIMIT)
+    Response: { "messages": [...], "next_cursor": <id>, "has_more": bool }
+    next_cursor is the id to pass as since_id on the next call; it stays at
+    since_id when nothing new is available. Group messages carry their
+    "group_id" (null for direct messages).
+    With Accept: application/x-e2ee-history the same page is returned as
+    binary records (see wire.py).
+    """
+    return _history_response(username)
 
-    # If receiver is connected via websocket, push message
-    sid = connected.get(receiver)
-    payload = {"id": msg_id, "sender": sender, "ephemeral": eph, "iv": iv, "ciphertext": ct, "timestamp": timestamp}
-    if sid:
-        socketio.emit("message", payload, to=sid)
+def _history_response(username, group_id=None):
+    try:
+        since_id = int(request.args.get("since_id", 0))
+        limit = int(request.args.get("limit", HISTORY_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error":"since_id and limit must be integers"}), 400
+    if since_id < 0 or limit < 1:
+        return jsonify({"error":"invalid cursor"}), 400
+    limit = min(limit, HISTORY_MAX_LIMIT)
 
-    return jsonify({"status":"stored","id":msg_id}), 201
+    rows = _history_rows(username, since_id, limit, group_id)
+    if request.accept_mimetypes.best == wire.HISTORY_CONTENT_TYPE:
+        return Response(_stream_messages_binary(rows, since_id), mimetype=wire.HISTORY_CONTENT_TYPE)
+    return Response(_stream_messages(rows, since_id), mimetype="application/json")
 
-@app.route("/api/messages/<username>", methods=["GET"])
-def api_get_messages(username):
-    # Returns stored messages for username (ciphertexts only)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, sender, ephemeral, iv, ciphertext, timestamp FROM messages WHERE receiver=? ORDER BY id ASC", (username,))
-    rows = c.fetchall()
-    conn.close()
-    messages = []
-    for r in rows:
-        messages.append({
-            "id": r[0],
-            "sender": r[1],
-            "ephemeral": r[2],
-            "iv": r[3],
-            "ciphertext": r[4],
-            "timestamp": r[5]
-        })
-    return jsonify({"messages": messages})
+HISTORY_SQL = ("SELECT id, sender, ephemeral, iv, ciphertext, timestamp, group_id, attachment FROM messages "
+               "WHERE receiver=? AND id>? ORDER BY id ASC LIMIT ?")
+GROUP_HISTORY_SQL = ("SELECT id, sender, ephemeral, iv, ciphertext, timestamp, group_id, attachment FROM messages "
+                     "WHERE group_id=? AND receiver=? AND id>? ORDER BY id ASC LIMIT ?")
+
+def _history_rows(username, since_id, limit, group_id=None):
+    # Rows are pulled in small batches and written out as they are read, so
+    # a large page never sits in memory as a list of dicts. Yields up to
+    # `limit` rows, then a final (None, has_more) marker.
+    if group_id is None:
+        sql, params = HISTORY_SQL, (username, since_id)
+    else:
+        sql, params = GROUP_HISTORY_SQL, (group_id, username, since_id)
+    sent = 0
+    for r in _message_rows(username, sql, params, limit + 1, "history_fetch", group_id):
+        if sent == limit:
+            yield None, True
+            return
+        yield r, False
+        sent += 1
+    yield None, False
+
+def _message_json(r):
+    return json.dumps({
+        "id": r[0],
+        "sender": r[1],
+        "ephemeral": wire.to_b64(r[2]),
+        "iv": wire.to_b64(r[3]),
+        "ciphertext": wire.to_b64(r[4]),
+        "timestamp": r[5],
+        "group_id": r[6],
+        "attachment": r[7]
+    })
+
+def _stream_messages(rows, since_id):
+    cursor = since_id
+    first = True
+    yield '{"messages":['
+    for r, has_more in rows:
+        if r is None:
+            break
+        # rows from the recent-message cache carry their JSON already
+        yield ("" if first else ",") + (r[8] if len(r) > 8 else _message_json(r))
+        cursor = r[0]
+        first = False
+    yield '],"next_cursor":%d,"has_more":%s}' % (cursor, "true" if has_more else "false")
+
+def _stream_messages_binary(rows, since_id):
+    cursor = since_id
+    for r, has_more in rows:
+        if r is None:
+            break
+        yield wire.encode_history_record(*r[:8])
+        cursor = r[0]
+    yield wire.encode_history_trailer(cursor, has_more)
+
+# -------------------------
+# Conversations (inbox list, see conversations.py)
+# -------------------------
+@app.route("/api/conversations/<username>", methods=["GET"])
+def api_get_conversations(username):
+    """
+    Lists username's conversations, most recent first, from the summary
+    table only (no message rows are read).
+    Query params:
+      before  - only conversations whose last_id < before (the previous
+                page's next_cursor; omit for the first page)
+      limit   - page size (default CONVERSATIONS_DEFAULT_LIMIT, max CONVERSATIONS_MAX_LIMIT)
+    Response: { "conversations": [{ "peer", "group_id", "last_id",
+      "last_sender", "last_timestamp", "unread", "read_id" }, ...],
+      "next_cursor": <last_id or null>, "has_more": bool }
+    Direct conversations have a peer and group_id null; group ones the reverse.
+    """
+    try:
+        before = request.args.get("before")
+        before = None if before is None else int(before)
+        limit = int(request.args.get("limit", CONVERSATIONS_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error":"before and limit must be integers"}), 400
+    if limit < 1:
+        return jsonify({"error":"invalid limit"}), 400
+    limit = min(limit, CONVERSATIONS_MAX_LIMIT)
+    with db_seconds.time("conversation_list"), storage.connect(_conversation_path(username)) as conn:
+        page, has_more = conversations.list_page(conn, username, before, limit)
+    return jsonify({"conversations": page,
+                    "next_cursor": page[-1]["last_id"] if page else None,
+                    "has_more": has_more})
+
+@app.route("/api/conversations/<username>/read", methods=["POST"])
+def api_mark_conversation_read(username):
+    """
+    Moves username's read pointer in one conversation.
+    { "peer": "alice" } or { "group_id": 3 }, optional "up_to": <message id>
+    (default: the newest message). Returns the updated conversation.
+    """
+    data = request.get_json(silent=True) or {}
+    peer, group_id, up_to = data.get("peer"), data.get("group_id"), data.get("up_to")
+    if (peer is None) == (group_id is None):
+        return jsonify({"error":"give exactly one of peer or group_id"}), 400
+    if not all(v is None or isinstance(v, int) for v in (group_id, up_to)):
+        return jsonify({"error":"group_id and up_to must be integers"}), 400
+    count = None
+    if router is not None and router.segment:
+        def count(sql, params):
+            total = 0
+            for path in _message_paths(username):
+                with storage.connect(path) as conn:
+                    total += conn.execute(sql, params).fetchone()[0]
+            return total
+    elif message_log is not None:
+        def count(sql, params):
+            if sql == conversations.COUNT_GROUP_SQL:
+                group, receiver, after, last, _ = params
+                return message_log.count(receiver, after, last, group_id=group)
+            receiver, after, last, sender = params
+            return message_log.count(receiver, after, last, sender=sender)
+    with db_seconds.time("conversation_read"), storage.connect(_conversation_path(username)) as conn:
+        conversation = conversations.mark_read(conn, username, peer, group_id, up_to, count)
+    if conversation is None:
+        return jsonify({"error":"no such conversation"}), 404
+    return jsonify(conversation)
+
+# -------------------------
+# Groups
+# -------------------------
+# A group send carries one ciphertext per member, each encrypted to that
+# member's key (fetch them with POST /api/keys/lookup). The copies are
+# stored in one transaction and pushed in one pass.
+
+def _group_members(conn, group_id):
+    """Sorted member list, or None if the group does not exist."""
+    if conn.execute("SELECT 1 FROM chat_groups WHERE id=?", (group_id,)).fetchone() is None:
+        return None
+    return [r[0] for r in conn.execute(
+        "SELECT username FROM group_members WHERE group_id=? ORDER BY username", (group_id,))]
+
+def _usernames(value):
+    if not isinstance(value, list) or not all(isinstance(u, str) and u for u in value):
+        raise ValueError("usernames must be a list of strings")
+    return list(dict.fromkeys(value))
+
+def _add_members(conn, group_id, usernames):
+    conn.executemany("INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)",
+                     [(group_id, u) for u in usernames])
+    members = _group_members(conn, group_id)
+    if len(members) > GROUP_MAX_MEMBERS:
+        raise ValueError(f"at most {GROUP_MAX_MEMBERS} members per group")
+    return members
+
+def _group_messages(group_id, data):
+    """
+    Validate a group send body and return messages ready for accept_messages().
+    Raises ValueError/wire.DecodeError (bad body), LookupError (no such
+    group) or PermissionError (sender or a receiver is not a member).
+    """
+    if not isinstance(data, dict):
+        raise ValueError("missing fields")
+    sender = data.get("sender")
+    copies = data.get("messages")
+    if not sender or not isinstance(copies, list) or not copies:
+        raise ValueError("missing fields")
+    if len(copies) > GROUP_MAX_MEMBERS:
+        raise ValueError(f"at most {GROUP_MAX_MEMBERS} messages per group send")
+    with db_seconds.time("group_members"), storage.connect(DB_PATH) as conn:
+        members = _group_members(conn, group_id)
+    if members is None:
+        raise LookupError("group not found")
+    members = set(members)
+    if sender not in members:
+        raise PermissionError("sender is not a member of this group")
+    # a group-level client_id covers every copy (it is unique per receiver)
+    shared = {"client_id": data["client_id"]} if data.get("client_id") is not None else {}
+    messages = [_validate_message({**shared, **m, "sender": sender} if isinstance(m, dict) else m) for m in copies]
+    receivers = [m["receiver"] for m in messages]
+    if len(set(receivers)) != len(receivers):
+        raise ValueError("one message per receiver")
+    if not members.issuperset(receivers):
+        raise PermissionError("every receiver must be a member of this group")
+    _check_attachments(messages)
+    return messages
+
+def _group_send_status(e):
+    if isinstance(e, LookupError):
+        return 404
+    if isinstance(e, PermissionError):
+        return 403
+    return 400
+
+@app.route("/api/groups", methods=["POST"])
+def api_create_group():
+    """
+    Request json: { "name": "team", "creator": "alice", "members": ["bob", "carol"] }
+    The creator is always a member. Response: { "id": 1, "name": ..., "members": [...] }
+    """
+    data = request.get_json(silent=True) or {}
+    name = data.get("name")
+    creator = data.get("creator")
+    if not name or not creator:
+        return jsonify({"error":"missing fields"}), 400
+    try:
+        usernames = _usernames(data.get("members", []))
+        with db_seconds.time("group_update"), storage.connect(DB_PATH) as conn:
+            group_id = conn.execute("INSERT INTO chat_groups (name, created_by) VALUES (?, ?)",
+                                    (name, creator)).lastrowid
+            members = _add_members(conn, group_id, [creator] + usernames)
+    except ValueError as e:
+        return jsonify({"error":str(e)}), 400
+    return jsonify({"id": group_id, "name": name, "members": members}), 201
+
+@app.route("/api/groups", methods=["GET"])
+def api_list_groups():
+    """?member=alice -> { "groups": [ {"id": 1, "name": "team"}, ... ] }"""
+    member = request.args.get("member")
+    if not member:
+        return jsonify({"error":"member is required"}), 400
+    with db_seconds.time("group_members"), storage.connect(DB_PATH) as conn:
+        rows = conn.execute(
+            "SELECT g.id, g.name FROM group_members m JOIN chat_groups g ON g.id = m.group_id "
+            "WHERE m.username=? ORDER BY g.id", (member,)).fetchall()
+    return jsonify({"groups": [{"id": r[0], "name": r[1]} for r in rows]})
+
+@app.route("/api/groups/<int:group_id>", methods=["GET"])
+def api_get_group(group_id):
+    with db_seconds.time("group_members"), storage.connect(DB_PATH) as conn:
+        row = conn.execute("SELECT name, created_by FROM chat_groups WHERE id=?", (group_id,)).fetchone()
+        members = _group_members(conn, group_id) if row else None
+    if row is None:
+        return jsonify({"error":"not found"}), 404
+    return jsonify({"id": group_id, "name": row[0], "created_by": row[1], "members": members})
+
+@app.route("/api/groups/<int:group_id>/members", methods=["POST"])
+def api_add_group_members(group_id):
+    """Request json: { "usernames": ["dave"] } -> { "members": [...] }"""
+    data = request.get_json(silent=True) or {}
+    try:
+        usernames = _usernames(data.get("usernames"))
+        with db_seconds.time("group_update"), storage.connect(DB_PATH) as conn:
+            if _group_members(conn, group_id) is None:
+                return jsonify({"error":"not found"}), 404
+            members = _add_members(conn, group_id, usernames)
+    except ValueError as e:
+        return jsonify({"error":str(e)}), 400
+    return jsonify({"members": members})
+
+@app.route("/api/groups/<int:group_id>/members/<username>", methods=["DELETE"])
+def api_remove_group_member(group_id, username):
+    with db_seconds.time("group_update"), storage.connect(DB_PATH) as conn:
+        removed = conn.execute("DELETE FROM group_members WHERE group_id=? AND username=?",
+                               (group_id, username)).rowcount
+    if not removed:
+        return jsonify({"error":"not found"}), 404
+    return jsonify({"status":"ok"})
+
+@app.route("/api/groups/<int:group_id>/send", methods=["POST"])
+def api_group_send(group_id):
+    """
+    {
+      "sender": "alice",
+      "messages": [
+        {"receiver": "bob", "ephemeral": "<b64>", "iv": "<b64>", "ciphertext": "<b64>"},
+        {"receiver": "carol", ...}
+      ]
+    }
+    One entry per recipient (any subset of the members, the sender's own
+    devices included). Response: { "status": "stored", "ids": [...] } in
+    the order of "messages". A 503 store timeout (see /api/send) may leave
+    the copies stored: retry with the same "client_id".
+    """
+    try:
+        messages = _group_messages(group_id, request.get_json(silent=True))
+    except (ValueError, LookupError, PermissionError) as e:
+        return jsonify({"error":str(e)}), _group_send_status(e)
+    wait = _throttle(messages[0]["sender"], len(messages))
+    if wait:
+        return _too_many_requests(wait)
+    try:
+        ids = accept_messages(messages, group_id=group_id)
+    except group_commit.QueueFull:
+        return jsonify({"error":"server busy"}), 503
+    except group_commit.CommitTimeout:
+        return jsonify({"error":STORE_TIMEOUT_ERROR}), 503
+    return jsonify({"status":"stored","ids":ids}), 201
+
+@app.route("/api/groups/<int:group_id>/messages/<username>", methods=["GET"])
+def api_get_group_messages(group_id, username):
+    """Same paging and formats as /api/messages/<username>, limited to one group."""
+    with db_seconds.time("group_members"), storage.connect(DB_PATH) as conn:
+        members = _group_members(conn, group_id)
+    if members is None:
+        return jsonify({"error":"not found"}), 404
+    if username not in members:
+        return jsonify({"error":"not a member of this group"}), 403
+    return _history_response(username, group_id)
+
+# -------------------------
+# Attachments (see attachments.py)
+# -------------------------
+attachment_bytes = metrics.Counter("attachment_bytes_total", "Attachment bytes received and served", ("direction",))
+attachment_dedup = metrics.Counter("attachment_dedup_total", "Uploads skipped because the blob already existed")
+
+def _upload_error(e):
+    body = {"error": str(e)}
+    if e.offset is not None:
+        body["offset"] = e.offset
+    return jsonify(body), e.status
+
+@app.route("/api/attachments", methods=["POST"])
+def api_begin_attachment():
+    """
+    Start or resume an upload of an encrypted blob.
+    Request json: { "sha256": "<hex of the ciphertext>", "size": <bytes> }
+    Response: { "status": "complete"|"incomplete", "size": n, "offset": n }
+    "complete" means the blob is already stored (nothing to upload);
+    otherwise PATCH the bytes from "offset" onwards.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        info = attachments.begin(DB_PATH, data.get("sha256"), data.get("size"))
+    except attachments.UploadError as e:
+        return _upload_error(e)
+    if info["status"] == "complete" and info["offset"] == data.get("size"):
+        attachment_dedup.inc()
+    return jsonify(info)
+
+@app.route("/api/attachments/<sha256>/upload", methods=["GET"])
+def api_attachment_status(sha256):
+    """Current offset of an upload, to resume after a dropped connection."""
+    info = attachments.status(DB_PATH, sha256) if attachments.valid_hash(sha256) else None
+    if info is None:
+        return jsonify({"error":"not found"}), 404
+    return jsonify(info)
+
+@app.route("/api/attachments/<sha256>/upload", methods=["PATCH"])
+def api_upload_chunk(sha256):
+    """
+    Append one chunk. Headers: Upload-Offset (bytes already stored, from the
+    status) and Content-Length; body: raw ciphertext bytes. The body is
+    streamed to disk. Response: status as above; 409 with the server's
+    "offset" if the client is out of step.
+    """
+    if not attachments.valid_hash(sha256):
+        return jsonify({"error":"not found"}), 404
+    length = request.content_length
+    if length is None:
+        return jsonify({"error":"Content-Length required"}), 411
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return jsonify({"error":"Upload-Offset must be an integer"}), 400
+    try:
+        info = attachments.append(DB_PATH, sha256, offset, request.stream, length)
+    except attachments.UploadError as e:
+        return _upload_error(e)
+    attachment_bytes.inc("in", amount=length)
+    return jsonify(info)
+
+@app.route("/api/attachments/<sha256>", methods=["GET"])
+def api_get_attachment(sha256):
+    """
+    Download a finished blob. Supports a single byte Range (206) and
+    If-None-Match; the hash doubles as an immutable ETag.
+    """
+    if not attachments.valid_hash(sha256):
+        return jsonify({"error":"not found"}), 404
+    path = attachments.blob_path(sha256)
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return jsonify({"error":"not found"}), 404
+
+    headers = {"ETag": f'"{sha256}"', "Accept-Ranges": "bytes",
+               "Cache-Control": "private, max-age=31536000, immutable"}
+    if request.if_none_match.contains(sha256):
+        return Response(status=304, headers=headers)
+    start, stop, status = 0, size, 200
+    rng = request.range
+    if rng is not None and rng.units == "bytes" and len(rng.ranges) == 1:
+        bounds = rng.range_for_length(size)
+        if bounds is None:
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        start, stop = bounds
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    # multi-range requests get the whole file, which RFC 9110 allows
+
+    if attachments.ATTACHMENT_ACCEL_REDIRECT:
+        # nginx serves the file (and the Range) from its internal location
+        headers["X-Accel-Redirect"] = attachments.ATTACHMENT_ACCEL_REDIRECT + f"{sha256[:2]}/{sha256}"
+        return Response(status=200, headers=headers, mimetype="application/octet-stream")
+
+    if "wsgi.file_wrapper" in request.environ and (
+            stop == size or request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")):
+        # the server's file wrapper sends from the current position up to
+        # Content-Length with sendfile(); only gunicorn is known to stop at
+        # Content-Length, others read to EOF
+        f = open(path, "rb")
+        f.seek(start)
+        body = wrap_file(request.environ, f, attachments.COPY_BLOCK)
+    else:
+        body = attachments.iter_range(path, start, stop - start)
+    attachment_bytes.inc("out", amount=stop - start)
+    resp = Response(body, status=status, headers=headers, mimetype="application/octet-stream",
+                    direct_passthrough=True)
+    resp.content_length = stop - start
+    return resp
+
+# -------------------------
+# Admin endpoints (owner only; queries span every message shard)
+# -------------------------
+def _admin_denied():
+    if not OWNER_TOKEN or request.args.get("token", "") != OWNER_TOKEN:
+        return jsonify({"error":"Unauthorized"}), 403
+    return None
+
+@app.route("/api/admin/shards", methods=["GET"])
+def api_admin_shards():
+    """Per-file message counts, receivers, id range and bytes on disk."""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({"shards": MESSAGE_SHARDS, "segment": MESSAGE_SHARD_SEGMENT or None,
+                    "files": sharding.stats(_all_message_paths()),
+                    "log": message_log.stats() if message_log is not None else None})
+
+@app.route("/api/admin/messages", methods=["GET"])
+def api_admin_messages():
+    """
+    Newest messages across all shards, metadata only (no ciphertext).
+    Query params: sender, receiver (optional filters), before_id (the last
+    id of the previous page), limit (default 100, max HISTORY_MAX_LIMIT).
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    try:
+        before_id = request.args.get("before_id")
+        before_id = None if before_id is None else int(before_id)
+        limit = min(int(request.args.get("limit", 100)), HISTORY_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error":"before_id and limit must be integers"}), 400
+    if limit < 1:
+        return jsonify({"error":"invalid limit"}), 400
+    receiver = request.args.get("receiver")
+    # a receiver's messages are all on one shard
+    paths = _message_paths(receiver) if receiver is not None else _all_message_paths()
+    with db_seconds.time("admin_messages"):
+        if message_log is not None:
+            rows = message_log.recent(request.args.get("sender"), receiver, before_id, limit)
+        else:
+            rows = sharding.recent_messages(paths, request.args.get("sender"), receiver, before_id, limit)
+    return jsonify({"messages": rows, "next_cursor": rows[-1]["id"] if rows else None})
 
 # -------------------------
 # Static UI
@@ -151,6 +1382,62 @@ def api_get_messages(username):
 def index():
     return send_from_directory(STATIC_DIR, "send.html")
 
+# -------------------------
+# Backlog push
+# -------------------------
+class _BacklogStream:
+    """One session's backlog push; cancel() also wakes a wait for an ack."""
+
+    def __init__(self):
+        self.cancelled = False
+        self.wake = threading.Event()  # set by the client's ack or by cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        self.wake.set()
+
+backlog_streams = {}  # sid -> _BacklogStream, cancelled when the session goes away or re-identifies
+
+BACKLOG_SQL = ("SELECT id, sender, ephemeral, iv, ciphertext, timestamp, group_id, attachment FROM messages "
+               "WHERE receiver=? AND id>? ORDER BY id ASC LIMIT ?")
+
+def _push_backlog(sid, username, since_id, stream):
+    """
+    Stream messages with id > since_id to one session as "backlog" events:
+      { "messages": [...], "next_cursor": <id>, "has_more": bool }
+    Each chunk waits for the client's ack before the next is read, so only
+    one chunk per session is ever in memory or in the socket buffer.
+    """
+    cursor = since_id
+    while not stream.cancelled:
+        rows = list(_message_rows(username, BACKLOG_SQL, (username, cursor), BACKLOG_CHUNK + 1, "backlog"))
+        has_more = len(rows) > BACKLOG_CHUNK
+        rows = rows[:BACKLOG_CHUNK]
+        encode = wire.binary_payload if sid in binary_sids else wire.json_payload
+        messages = [encode({"id": r[0], "sender": r[1], "group_id": r[6], "ephemeral": r[2], "iv": r[3],
+                            "ciphertext": r[4], "timestamp": r[5], "attachment": r[7]}) for r in rows]
+        if rows:
+            cursor = rows[-1][0]
+        stream.wake.clear()
+        if stream.cancelled:
+            break
+        metrics.emits.inc("backlog")
+        socketio.emit("backlog", {"messages": messages, "next_cursor": cursor, "has_more": has_more},
+                      to=sid, callback=lambda *args: stream.wake.set())
+        if not has_more:
+            break
+        if not stream.wake.wait(BACKLOG_ACK_TIMEOUT) or stream.cancelled:
+            break  # client stalled or left; it can resume from its last ack
+    if backlog_streams.get(sid) is stream:
+        del backlog_streams[sid]  # not if a re-identify replaced it
+
+def _start_backlog(sid, username, since_id):
+    previous = backlog_streams.pop(sid, None)
+    if previous is not None:
+        previous.cancel()  # a re-identify restarts from the new cursor
+    stream = backlog_streams[sid] = _BacklogStream()
+    socketio.start_background_task(_push_backlog, sid, username, since_id, stream)
+
 # -------------------------
 # WebSocket handlers
 # -------------------------
@@ -160,24 +1447,139 @@ def on_connect():
     pass
 
 @socketio.on("identify")
+@metrics.timed_event("identify")
 def on_identify(data):
     """
-    data: { "username": "bob" }
+    data: { "username": "bob", "binary": false, "last_seen_id": 123, "prekeys": false }
+    binary=true asks for pushes with raw bytes (Socket.IO binary attachments)
+    instead of base64 strings.
+    prekeys=true asks for a "prekeys_low" event right away if fewer than
+    PREKEY_LOW_WATERMARK one-time prekeys are left (later ones follow claims).
+    last_seen_id (optional) starts a paced "backlog" stream of every stored
+    message newer than it; ack each backlog event to receive the next chunk.
+    Live "message" pushes may interleave with the backlog, so de-duplicate
+    by id.
     """
     username = data.get("username")
     if not username:
         return
-    connected[username] = request.sid
+    if data.get("binary"):
+        binary_sids.add(request.sid)
+    else:
+        binary_sids.discard(request.sid)
+    presence.identify(username, request.sid)
     join_room(request.sid)
     print(f"{username} connected, sid={request.sid}")
 
+    if data.get("prekeys"):
+        with db_seconds.time("prekey_count"), storage.connect(DB_PATH) as conn:
+            available = prekeys.count(conn, username)
+        if available < prekeys.PREKEY_LOW_WATERMARK:
+            _emit_to_sid(request.sid, *_prekeys_low(username, available)[1:])
+
+    last_seen_id = data.get("last_seen_id")
+    if last_seen_id is not None:
+        try:
+            since_id = max(int(last_seen_id), 0)
+        except (TypeError, ValueError):
+            return
+        _start_backlog(request.sid, username, since_id)
+
+@socketio.on("send")
+@metrics.timed_event("send")
+def on_send(data):
+    """
+    Socket equivalent of POST /api/send for clients that already hold a
+    connection. data is one message (same fields as /api/send; binary fields
+    as base64 or raw bytes) or a list of up to SOCKET_SEND_MAX_BATCH messages,
+    which are stored in one transaction.
+    Ack: {"status":"stored","id":N}, or {"status":"stored","ids":[...]} for a
+    list, or {"error":"..."} with nothing stored ({"error":"rate limited",
+    "retry_after":seconds} when throttled). The one exception is a store
+    timeout (STORE_TIMEOUT_ERROR), after which the messages may still be
+    stored: retry with the same client_id.
+    """
+    batch = isinstance(data, list)
+    messages = data if batch else [data]
+    if not messages or len(messages) > SOCKET_SEND_MAX_BATCH:
+        return {"error": f"send between 1 and {SOCKET_SEND_MAX_BATCH} messages per frame"}
+    try:
+        with stage_seconds.time("decode"):
+            messages = [_validate_message(m) for m in messages]
+            _check_attachments(messages)
+    except wire.DecodeError as e:
+        return {"error": str(e)}
+    # a batch may mix senders; charge each of them for their own messages
+    counts = {}
+    for m in messages:
+        counts[m["sender"]] = counts.get(m["sender"], 0) + 1
+    wait = _throttle_senders(counts)
+    if wait:
+        return {"error": "rate limited", "retry_after": round(wait, 3)}
+    try:
+        ids = accept_messages(messages)
+    except group_commit.QueueFull:
+        return {"error": "server busy"}
+    except group_commit.CommitTimeout:
+        return {"error": STORE_TIMEOUT_ERROR}
+    if batch:
+        return {"status": "stored", "ids": ids}
+    return {"status": "stored", "id": ids[0]}
+
+@socketio.on("group_send")
+@metrics.timed_event("group_send")
+def on_group_send(data):
+    """
+    Socket equivalent of POST /api/groups/<id>/send:
+    data: { "group_id": 1, "sender": "alice", "messages": [...] }
+    Ack: {"status":"stored","ids":[...]} or {"error":"..."}; after
+    STORE_TIMEOUT_ERROR the copies may still be stored (retry with the same
+    "client_id").
+    """
+    group_id = data.get("group_id") if isinstance(data, dict) else None
+    if not isinstance(group_id, int):
+        return {"error": "group_id must be an integer"}
+    try:
+        messages = _group_messages(group_id, data)
+    except (ValueError, LookupError, PermissionError) as e:
+        return {"error": str(e)}
+    wait = _throttle(messages[0]["sender"], len(messages))
+    if wait:
+        return {"error": "rate limited", "retry_after": round(wait, 3)}
+    try:
+        ids = accept_messages(messages, group_id=group_id)
+    except group_commit.QueueFull:
+        return {"error": "server busy"}
+    except group_commit.CommitTimeout:
+        return {"error": STORE_TIMEOUT_ERROR}
+    return {"status": "stored", "ids": ids}
+
+@socketio.on("ack")
+@metrics.timed_event("ack")
+def on_ack(data):
+    """
+    data: { "ids": [...], "up_to": N } for the identified user's messages.
+    Ack: {"status":"ok","acked":n} or {"error":"..."}.
+    """
+    username = presence.connected.user_for(request.sid)
+    if username is None:
+        return {"error": "identify first"}
+    try:
+        ids, up_to = _parse_ack(data or {})
+    except ValueError as e:
+        return {"error": str(e)}
+    acked = _mark_delivered(username, ids, up_to)
+    return {"status": "ok", "acked": acked}
+
 @socketio.on("disconnect")
+@metrics.timed_event("disconnect")
 def on_disconnect():
     # remove any mapping with this sid
-    sid = request.sid
-    to_remove = [u for u, s in connected.items() if s == sid]
-    for u in to_remove:
-        connected.pop(u, None)
+    binary_sids.discard(request.sid)
+    stream = backlog_streams.pop(request.sid, None)
+    if stream is not None:
+        stream.cancel()
+    for u in presence.disconnect(request.sid):
         print(f"{u} disconnected")
 
 if __name__ == "__main__":
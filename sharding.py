@@ -0,0 +1,295 @@
+# sharding.py
+"""
+Receiver-sharded message storage for server_e2ee.
+
+SQLite allows one writer per database file, so with a single messages.db
+every insert from every worker queues on the same lock. With
+MESSAGE_SHARDS=N the messages table (and the conversation summaries that
+go with it) is split across N files by a stable hash of the receiver:
+
+  MESSAGE_SHARD_DIR/messages-03.db           shard 3
+  MESSAGE_SHARD_DIR/messages-03-2026-10.db   shard 3, October segment
+
+Everything a request does with messages is keyed by one user (store for a
+receiver, read a receiver's history or backlog, ack, list an inbox), so it
+touches one shard, and sends to receivers on different shards commit in
+parallel. Users, keys, groups and attachments stay in DB_PATH, and so do
+server.py's owner-mode messages.
+
+Ids come from allocate_ids() instead of AUTOINCREMENT: milliseconds since
+2024 in the high bits, the shard in the low 4, so they are unique across
+shards, roughly time-ordered and increasing per receiver, which is all
+the since_id cursors need.
+
+With MESSAGE_SHARD_SEGMENT=month|week|day a shard's messages go to one
+file per period; the shard's base file then only holds the summaries.
+Readers walk a receiver's segments oldest first. Old segments stop
+receiving writes, so they can be backed up once and stay cold.
+
+A send to receivers on several shards commits shard by shard. Summary rows
+that belong to another shard (the sender's side, or every row when
+segmented) are written right after the messages commit rather than in the
+same transaction.
+
+Existing data: stop the servers, then
+  python sharding.py split messages.db shards/ 8 [month]
+and start them with MESSAGE_SHARDS=8 (and the same segment setting).
+"""
+import hashlib
+import heapq
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import storage
+import conversations
+import migrations
+
+MAX_SHARDS = 16
+ID_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+ID_TIME_SHIFT = 12  # low 12 bits: per-millisecond sequence (8) + shard (4)
+SEGMENTS = ("", "month", "week", "day")
+SPLIT_BATCH = 1000
+
+
+def shard_of(username, count):
+    # stable across processes and restarts, unlike hash()
+    digest = hashlib.blake2b(username.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def period(segment, when):
+    """Segment name for a datetime: "2026-10", "2026-W42", "2026-10-18"."""
+    if segment == "month":
+        return when.strftime("%Y-%m")
+    if segment == "week":
+        year, week, _ = when.isocalendar()
+        return f"{year}-W{week:02d}"
+    return when.strftime("%Y-%m-%d")
+
+
+def allocate_ids(conn, shard, n, now=None):
+    """
+    n new message ids for `shard`, taken inside the caller's write
+    transaction. Ids in a shard are strictly increasing; a burst of more
+    than 256 per millisecond borrows from the next millisecond. They stay
+    below 2**53 (exact in JavaScript) until 2093.
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")  # read the sequence under the write lock
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='messages'").fetchone()
+    last = row[0] if row else 0
+    now = time.time() if now is None else now
+    floor = (int(now * 1000) - ID_EPOCH_MS) << ID_TIME_SHIFT | shard
+    # smallest id above `last` that is still in this shard's residue class
+    start = max(last + 1 + (shard - last - 1) % MAX_SHARDS, floor)
+    return [start + i * MAX_SHARDS for i in range(n)]
+
+
+class ShardRouter:
+    def __init__(self, directory, count, segment=""):
+        if not 1 <= count <= MAX_SHARDS:
+            raise ValueError(f"shard count must be between 1 and {MAX_SHARDS}")
+        if segment not in SEGMENTS:
+            raise ValueError(f"unknown segment period {segment!r}")
+        self.directory = directory
+        self.count = count
+        self.segment = segment
+        self._ready = set()  # paths whose schema exists
+        self._segments = {}  # shard -> segment paths, oldest first
+        self._lock = threading.Lock()
+
+    def init(self):
+        """Create the directory and every shard's base file."""
+        os.makedirs(self.directory, exist_ok=True)
+        for shard in range(self.count):
+            self._ensure(self.base_path(shard))
+
+    def shard(self, username):
+        return shard_of(username, self.count)
+
+    def base_path(self, shard):
+        return os.path.join(self.directory, f"messages-{shard:02d}.db")
+
+    def _segment_path(self, shard, name):
+        return os.path.join(self.directory, f"messages-{shard:02d}-{name}.db")
+
+    def _ensure(self, path):
+        if path in self._ready:
+            return path
+        migrations.ensure(path, migrations.SHARD_MIGRATIONS)
+        self._ready.add(path)
+        return path
+
+    def write_path(self, shard):
+        """File new messages for `shard` go to right now."""
+        if not self.segment:
+            return self._ensure(self.base_path(shard))
+        path = self._ensure(self._segment_path(shard, period(self.segment, datetime.utcnow())))
+        if path not in self._segments.get(shard, ()):
+            self._segments.pop(shard, None)  # new segment: re-list
+        return path
+
+    def conversation_path(self, shard):
+        return self._ensure(self.base_path(shard))
+
+    def message_paths(self, shard):
+        """Files holding `shard`'s messages, oldest segment first."""
+        if not self.segment:
+            return [self.write_path(shard)]
+        paths = self._segments.get(shard)
+        current = self._segment_path(shard, period(self.segment, datetime.utcnow()))
+        # another worker may have opened this period's segment; one stat() tells
+        if paths is None or (current not in paths and os.path.exists(current)):
+            prefix = f"messages-{shard:02d}-"
+            with self._lock:
+                paths = self._segments[shard] = [
+                    self._ensure(os.path.join(self.directory, name))
+                    for name in sorted(os.listdir(self.directory))
+                    if name.startswith(prefix) and name.endswith(".db")]
+        return paths
+
+    def all_paths(self):
+        """Every file with a messages table, for maintenance and admin queries."""
+        paths = []
+        for shard in range(self.count):
+            paths.append(self.base_path(shard))
+            if self.segment:
+                paths.extend(self.message_paths(shard))
+        return paths
+
+
+# -------------------------
+# Cross-shard admin queries
+# -------------------------
+def stats(paths):
+    """Per-file message counts, receivers, id range and size on disk."""
+    out = []
+    for path in paths:
+        with storage.connect(path) as conn:
+            count, receivers, min_id, max_id = conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT receiver), MIN(id), MAX(id) FROM messages").fetchone()
+            pending = conn.execute("SELECT COUNT(*) FROM messages WHERE delivered_at IS NULL").fetchone()[0]
+        size = sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+        out.append({"file": os.path.basename(path), "messages": count, "undelivered": pending,
+                    "receivers": receivers, "min_id": min_id, "max_id": max_id, "bytes": size})
+    return out
+
+
+ADMIN_MESSAGES_SQL = ("SELECT id, sender, receiver, group_id, timestamp, attachment, delivered_at, "
+                      "length(ciphertext) FROM messages WHERE id<?{filters} ORDER BY id DESC LIMIT ?")
+
+
+def recent_messages(paths, sender=None, receiver=None, before_id=None, limit=100):
+    """
+    Newest message metadata (never ciphertext) across `paths`, optionally
+    for one sender and/or receiver, merged by id. Pass the last id as
+    before_id for the next page.
+    """
+    filters, params = "", []
+    if sender is not None:
+        filters += " AND sender=?"
+        params.append(sender)
+    if receiver is not None:
+        filters += " AND receiver=?"
+        params.append(receiver)
+    sql = ADMIN_MESSAGES_SQL.format(filters=filters)
+    before_id = conversations.NO_CURSOR if before_id is None else before_id
+    per_file = []
+    for path in paths:
+        with storage.connect(path) as conn:
+            per_file.append(conn.execute(sql, [before_id] + params + [limit]).fetchall())
+    merged = heapq.merge(*per_file, key=lambda r: r[0], reverse=True)
+    return [{"id": r[0], "sender": r[1], "receiver": r[2], "group_id": r[3], "timestamp": r[4],
+             "attachment": r[5], "delivered_at": r[6], "size": r[7]}
+            for _, r in zip(range(limit), merged)]
+
+
+# -------------------------
+# Splitting an existing database
+# -------------------------
+def _timestamp_period(segment, timestamp, previous):
+    # segments must not go back in id order, so unparseable or older
+    # timestamps stay in the previous row's segment
+    try:
+        name = period(segment, datetime.strptime((timestamp or "")[:10], "%Y-%m-%d"))
+    except ValueError:
+        return previous or period(segment, datetime.utcnow() - timedelta(days=366 * 100))
+    return max(name, previous) if previous else name
+
+
+def split(src_path, directory, count, segment=""):
+    """
+    Copy every message of `src_path` into a fresh shard directory, keeping
+    ids, and carry the conversation summaries over to their users' shards.
+    The servers must be stopped. Returns {file name: rows copied}.
+    """
+    router = ShardRouter(directory, count, segment)
+    if os.path.isdir(directory) and any(n.startswith("messages-") for n in os.listdir(directory)):
+        raise SystemExit(f"{directory} already has shard files")
+    router.init()
+    src = storage.open_connection(src_path)
+    copied = {}
+    try:
+        with storage.connect(router.base_path(0)) as conn:
+            target = storage.table_columns(conn, "messages")
+        columns = [c for c in ("id", "sender", "receiver", "ephemeral", "iv", "ciphertext", "timestamp",
+                               "group_id", "attachment", "delivered_at", "client_id")
+                   if c in target and c in storage.table_columns(src, "messages")]
+        insert_sql = (f"INSERT INTO messages ({', '.join(columns)}) "
+                      f"VALUES ({', '.join('?' * len(columns))})")
+        receiver_at = columns.index("receiver")
+        timestamp_at = columns.index("timestamp")
+        cursor = src.execute(f"SELECT {', '.join(columns)} FROM messages ORDER BY id")
+        last_period = None
+        while True:
+            rows = cursor.fetchmany(SPLIT_BATCH)
+            if not rows:
+                break
+            by_path = {}
+            for row in rows:
+                shard = router.shard(row[receiver_at] or "")
+                if segment:
+                    last_period = _timestamp_period(segment, row[timestamp_at], last_period)
+                    path = router._ensure(router._segment_path(shard, last_period))
+                else:
+                    path = router.base_path(shard)
+                by_path.setdefault(path, []).append(row)
+            for path, part in by_path.items():
+                with storage.connect(path) as conn:
+                    conn.executemany(insert_sql, part)
+                copied[os.path.basename(path)] = copied.get(os.path.basename(path), 0) + len(part)
+
+        if "username" in storage.table_columns(src, "conversations"):
+            by_shard = {}
+            for row in src.execute("SELECT username, peer, group_id, last_id, last_sender, last_timestamp, "
+                                   "unread, read_id FROM conversations"):
+                by_shard.setdefault(router.shard(row[0]), []).append(row)
+            for shard, part in by_shard.items():
+                with storage.connect(router.base_path(shard)) as conn:
+                    conn.executemany(conversations.UPSERT_SQL, part)
+        else:
+            # summaries were never built for this database: derive them
+            c = src.execute("SELECT sender, receiver, group_id, timestamp, id FROM messages ORDER BY id")
+            while True:
+                rows = c.fetchmany(SPLIT_BATCH)
+                if not rows:
+                    break
+                for shard in range(count):
+                    with storage.connect(router.base_path(shard)) as conn:
+                        conversations.record(conn, [r[:4] for r in rows], [r[4] for r in rows],
+                                             keep=lambda u, shard=shard: router.shard(u) == shard)
+    finally:
+        src.close()
+    return copied
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) < 4 or args[0] != "split":
+        raise SystemExit("usage: python sharding.py split messages.db SHARD_DIR COUNT [month|week|day]")
+    result = split(args[1], args[2], int(args[3]), args[4] if len(args) > 4 else "")
+    for name, n in sorted(result.items()):
+        print(f"{name}: {n} messages")
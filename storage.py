@@ -0,0 +1,176 @@
+# storage.py
+"""
+Shared SQLite access for the chat servers.
+
+Each worker keeps a small pool of connections per database file. A
+connection is opened once (WAL journal, tuned pragmas, statement cache)
+and then reused, so handlers no longer pay connect/teardown per query.
+
+The pool is built on queue.LifoQueue and threading primitives, which the
+gevent/eventlet gunicorn workers monkey-patch, so checkout yields to other
+greenlets instead of blocking the whole worker.
+"""
+import fcntl
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+
+# sqlite3 keeps compiled statements per connection keyed by SQL text, so
+# handlers that use constant query strings reuse prepared statements.
+STATEMENT_CACHE = 256
+
+
+def open_connection(path):
+    """Open and configure one connection. Callers normally go through a pool."""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+        # BEGIN IMMEDIATE on the first write so two writers never deadlock
+        # upgrading a shared lock; plain SELECTs stay outside transactions.
+        isolation_level="IMMEDIATE",
+        check_same_thread=False,  # greenlets/threads share the pool
+        cached_statements=STATEMENT_CACHE,
+    )
+    # Must precede journal_mode, which writes the header of a new file. No-op
+    # for existing files created without it (see retention.py).
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def table_columns(conn, table):
+    """Column names of `table` (empty set if it doesn't exist)."""
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def try_process_lock(path, name):
+    """
+    Non-blocking exclusive lock on `<path>.<name>.lock`, for background jobs
+    that should run in only one worker. Returns the open lock file (keep it
+    open while working, close it to release) or None if another process
+    holds it.
+    """
+    lock = open(f"{path}.{name}.lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+class ConnectionPool:
+    """Bounded, lazily filled pool of connections to a single database file."""
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                grow = True
+            else:
+                grow = False
+        if grow:
+            try:
+                return open_connection(self.path)
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(f"no database connection available for {self.path}")
+
+    def _release(self, conn):
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._opened -= 1
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of the block.
+        Commits on success, rolls back on error, and returns it to the pool.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                # connection is unusable; drop it instead of poisoning the pool
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path):
+    """
+    Return the pool for `path` in this process. Pools are keyed by pid so a
+    gunicorn worker forked from a preloaded master never reuses the parent's
+    SQLite handles.
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(path)
+    return pool
+
+
+def connect(path):
+    """Shorthand for `get_pool(path).connection()`."""
+    return get_pool(path).connection()
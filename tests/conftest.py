@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def server_env(tmp_path):
+    """Environment for a server process whose files all live in tmp_path."""
+    def make(**env):
+        return dict(os.environ, DB_PATH=str(tmp_path / "messages.db"), PYTHONPATH=ROOT,
+                    ATTACHMENT_DIR=str(tmp_path / "attachments"), FANOUT_DIR=str(tmp_path / "fanout"),
+                    **{k: str(v) for k, v in env.items()})
+    return make
+
+
+@pytest.fixture
+def run_server(server_env):
+    """
+    run_server(script, **env): run `script` in a fresh interpreter (the
+    servers read their configuration at import time) and return the JSON
+    it prints last.
+    """
+    def run(script, **env):
+        out = subprocess.run([sys.executable, "-c", textwrap.dedent(script)], env=server_env(**env), cwd=ROOT,
+                             capture_output=True, text=True, timeout=120)
+        assert out.returncode == 0, out.stderr
+        return json.loads(out.stdout.strip().splitlines()[-1])
+    return run
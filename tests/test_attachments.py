@@ -0,0 +1,21 @@
+SCRIPT = """
+    from gevent import monkey; monkey.patch_all()  # the retention loop is a greenlet
+    import json, os, time
+    import attachments
+    import server_e2ee as s
+    c = s.app.test_client()
+    sha = "ab" * 32
+    c.post("/api/attachments", json={"sha256": sha, "size": 10})
+    c.patch(f"/api/attachments/{sha}/upload", data=b"12345", headers={"Upload-Offset": "0"})
+    part = attachments._part_path(sha)
+    before = [os.path.exists(part), c.get(f"/api/attachments/{sha}/upload").status_code]
+    time.sleep(1)
+    after = [os.path.exists(part), c.get(f"/api/attachments/{sha}/upload").status_code]
+    print(json.dumps({"before": before, "after": after}))
+"""
+
+
+def test_retention_loop_drops_abandoned_upload(run_server):
+    out = run_server(SCRIPT, RETENTION_INTERVAL_SECONDS=0.2, ATTACHMENT_UPLOAD_TTL=0.1)
+    assert out["before"] == [True, 200]
+    assert out["after"] == [False, 404]
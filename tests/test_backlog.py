@@ -0,0 +1,30 @@
+def test_reidentify_and_disconnect_cancel_streams(run_server):
+    out = run_server("""
+        from gevent import monkey; monkey.patch_all()
+        import json, time
+        import server_e2ee as s
+        msg = {"sender": "alice", "receiver": "bob", "ephemeral": b"e", "iv": b"i", "ciphertext": b"c",
+               "attachment": None}
+        s.accept_messages([dict(msg) for _ in range(10)])
+        finished = []
+        real = s._push_backlog
+        def push(*args):
+            real(*args)
+            finished.append(time.monotonic())
+        s._push_backlog = push
+        sc = s.socketio.test_client(s.app)
+        start = time.monotonic()
+        sc.emit("identify", {"username": "bob", "last_seen_id": 0})
+        s.socketio.sleep(0.3)  # first stream waits for an ack it never gets
+        sc.emit("identify", {"username": "bob", "last_seen_id": 0})
+        s.socketio.sleep(0.3)
+        after_reidentify = (len(finished), len(s.backlog_streams))
+        sc.disconnect()
+        s.socketio.sleep(0.3)
+        after_disconnect = (len(finished), len(s.backlog_streams))
+        print(json.dumps({"after_reidentify": after_reidentify, "after_disconnect": after_disconnect,
+                          "seconds": max(finished) - start if finished else None}))
+    """, BACKLOG_CHUNK=2, BACKLOG_ACK_TIMEOUT=30, RATE_LIMIT_PER_SENDER=0, RATE_LIMIT_PER_IP=0)
+    assert out["after_reidentify"] == [1, 1]  # old stream gone, new one still tracked
+    assert out["after_disconnect"] == [2, 0]
+    assert out["seconds"] < 5  # neither sat out the ack timeout
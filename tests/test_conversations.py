@@ -0,0 +1,23 @@
+import sharding
+
+
+def test_cross_shard_batch_records_sender_side(run_server):
+    # alice and u1 on one shard, u0 on the other
+    alice = "alice"
+    names = [f"user{i}" for i in range(100)]
+    same = next(n for n in names if sharding.shard_of(n, 2) == sharding.shard_of(alice, 2))
+    other = next(n for n in names if sharding.shard_of(n, 2) != sharding.shard_of(alice, 2))
+    inbox = run_server(f"""
+        import json
+        import server_e2ee as s
+        msg = lambda to: {{"sender": "alice", "receiver": to, "ephemeral": b"e", "iv": b"i",
+                           "ciphertext": b"c", "attachment": None}}
+        s.accept_messages([msg({same!r}), msg({other!r})])
+        c = s.app.test_client()
+        print(json.dumps({{u: c.get(f"/api/conversations/{{u}}").json["conversations"]
+                          for u in ("alice", {same!r}, {other!r})}}))
+    """, MESSAGE_SHARDS=2, RATE_LIMIT_PER_SENDER=0, RATE_LIMIT_PER_IP=0)
+    assert sorted(c["peer"] for c in inbox["alice"]) == sorted([same, other])
+    assert all(c["unread"] == 0 for c in inbox["alice"])
+    assert [(c["peer"], c["unread"]) for c in inbox[same]] == [("alice", 1)]
+    assert [(c["peer"], c["unread"]) for c in inbox[other]] == [("alice", 1)]
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+os.environ.setdefault("FERNET_KEY", Fernet.generate_key().decode())
+
+import decrypter  # noqa: E402
+
+
+def new_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def test_envelope_round_trip():
+    key = new_key()
+    data = os.urandom(3 * decrypter.ENVELOPE_CHUNK + 5)
+    assert decrypter.decrypt_envelope(decrypter.encrypt_envelope(data, key.public_key()), key) == data
+
+
+def test_wrong_key_fails_after_successful_decrypt():
+    key, other = new_key(), new_key()
+    env = decrypter.encrypt_envelope(b"secret", key.public_key())
+    assert decrypter.decrypt_envelope(env, key) == b"secret"
+    with pytest.raises(decrypter.EnvelopeError):
+        decrypter.decrypt_envelope(env, other)
@@ -0,0 +1,60 @@
+import json
+import subprocess
+import sys
+import textwrap
+
+from conftest import ROOT
+
+RECEIVER = """
+    from gevent import monkey; monkey.patch_all()
+    import json, sys, time
+    import server_e2ee as s
+    bob = s.socketio.test_client(s.app)
+    bob.emit("identify", {"username": "bob"})
+    s.socketio.sleep(0.2)
+    print("ready", flush=True)
+    deadline = time.monotonic() + 10
+    received = []
+    while not received and time.monotonic() < deadline:
+        s.socketio.sleep(0.05)
+        received += [p["args"] for p in bob.get_received() if p["name"] == "message"]
+    print(json.dumps(received), flush=True)
+"""
+
+SENDER = """
+    from gevent import monkey; monkey.patch_all()
+    import json, sys
+    import server_e2ee as s
+    sys.stdin.readline()  # the receiver worker is listening
+    r = s.app.test_client().post("/api/send", json={"sender": "alice", "receiver": "bob", "ephemeral": "ZQ==",
+                                                    "iv": "aQ==", "ciphertext": "aGk="})
+    print(json.dumps(r.json), flush=True)
+"""
+
+
+def _start(script, env):
+    return subprocess.Popen([sys.executable, "-c", textwrap.dedent(script)], env=env, cwd=ROOT,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def test_message_reaches_user_on_another_worker(server_env):
+    env = server_env(FANOUT_BACKEND="unix", RATE_LIMIT_PER_SENDER=0, RATE_LIMIT_PER_IP=0)
+    receiver = _start(RECEIVER, env)
+    sender = _start(SENDER, env)
+    try:
+        for line in receiver.stdout:
+            if line.strip() == "ready":
+                break
+        else:
+            raise AssertionError(receiver.stderr.read())
+        out, err = sender.communicate("go\n", timeout=30)
+        assert sender.returncode == 0, err
+        stored = json.loads(out.strip().splitlines()[-1])
+        out, err = receiver.communicate(timeout=30)
+        assert receiver.returncode == 0, err
+    finally:
+        for p in (receiver, sender):
+            if p.poll() is None:
+                p.kill()
+    pushed = json.loads(out.strip().splitlines()[-1])
+    assert [(m["id"], m["sender"], m["ciphertext"]) for m in pushed] == [(stored["id"], "alice", "aGk=")]
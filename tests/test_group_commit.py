@@ -0,0 +1,27 @@
+SCRIPT = """
+    import json, time
+    import server_e2ee as s
+    real = s._insert_message_lists
+    def slow(conn, lists, shard=None):
+        time.sleep(0.5)
+        return real(conn, lists, shard)
+    s._insert_message_lists = slow
+    c = s.app.test_client()
+    body = {"sender": "alice", "receiver": "bob", "ephemeral": "ZQ==", "iv": "aQ==", "ciphertext": "Yw==",
+            "client_id": "m1"}
+    first = c.post("/api/send", json=body)
+    time.sleep(1)  # the timed-out batch commits meanwhile
+    s._insert_message_lists = real
+    retry = c.post("/api/send", json=body)
+    history = [m["id"] for m in c.get("/api/messages/bob").json["messages"]]
+    print(json.dumps({"first": [first.status_code, first.json["error"]], "retry": [retry.status_code, retry.json["id"]],
+                      "history": history}))
+"""
+
+
+def test_commit_timeout_is_503_and_retry_is_safe(run_server):
+    out = run_server(SCRIPT, GROUP_COMMIT=1, GROUP_COMMIT_WAIT=0.1, RATE_LIMIT_PER_SENDER=0)
+    assert out["first"][0] == 503
+    assert "client_id" in out["first"][1]
+    assert out["history"] == [out["retry"][1]]
+    assert out["retry"][0] == 201
@@ -0,0 +1,25 @@
+import pytest
+
+SCRIPT = """
+    import json
+    import server_e2ee as s
+    c = s.app.test_client()
+    s.store_messages([("alice", "bob", None, b"e", b"i", b"c", "2026-01-01 00:00:00", None, None)] * 250)
+    # two readers that take the first chunk of a history page and stall
+    stalled = [iter(c.get("/api/messages/bob?limit=1000", buffered=False).response) for _ in range(2)]
+    heads = [next(body) + next(body) for body in stalled]
+    keys = c.get("/api/keys/alice").status_code
+    pages = [json.loads(head + b"".join(body)) for head, body in zip(heads, stalled)]
+    print(json.dumps({"keys": keys, "counts": [len(p["messages"]) for p in pages],
+                      "ids": [m["id"] for m in pages[0]["messages"]] == sorted({m["id"] for m in pages[0]["messages"]}),
+                      "end": [pages[0]["next_cursor"], pages[0]["has_more"]]}))
+"""
+
+
+@pytest.mark.parametrize("env", [{}, {"MESSAGE_SHARDS": 2}])
+def test_stalled_history_readers_leave_pool_free(run_server, env):
+    out = run_server(SCRIPT, DB_POOL_SIZE=2, DB_POOL_TIMEOUT=0.5, **env)
+    assert out["keys"] != 500
+    assert out["counts"] == [250, 250]
+    assert out["ids"]
+    assert out["end"][1] is False
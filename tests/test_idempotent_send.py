@@ -0,0 +1,26 @@
+import pytest
+
+SCRIPT = """
+    import json
+    import server_e2ee as s
+    c = s.app.test_client()
+    send = lambda cid: c.post("/api/send", json={"sender": "alice", "receiver": "bob", "ephemeral": "ZQ==",
+                                                 "iv": "aQ==", "ciphertext": "Yw==", "client_id": cid}).json["id"]
+    first = send("m1")
+    writes = []
+    real = s._store_messages
+    s._store_messages = lambda rows: writes.append(len(rows)) or real(rows)
+    s.client_ids.clear()  # answered from the database, not the cache
+    again = send("m1")
+    other = send("m2")
+    history = [m["id"] for m in c.get("/api/messages/bob").json["messages"]]
+    print(json.dumps({"first": first, "again": again, "other": other, "writes": writes, "history": history}))
+"""
+
+
+@pytest.mark.parametrize("env", [{}, {"GROUP_COMMIT": 1}, {"MESSAGE_SHARDS": 2}])
+def test_retry_returns_stored_id_without_writing(run_server, env):
+    out = run_server(SCRIPT, RATE_LIMIT_PER_SENDER=0, RATE_LIMIT_PER_IP=0, **env)
+    assert out["again"] == out["first"]
+    assert out["writes"] == [1]  # only m2
+    assert out["history"] == [out["first"], out["other"]]
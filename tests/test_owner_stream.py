@@ -0,0 +1,47 @@
+import pytest
+from cryptography.fernet import Fernet
+
+SCRIPT = """
+    import contextlib, json
+    import server as s
+    for i in range(7):
+        with s.storage.connect(s.DB_PATH) as conn:
+            conn.execute("INSERT INTO messages (sender, receiver, ciphertext, key_id, timestamp) "
+                         "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)", ("alice", "bob", s.encrypt_to_raw(b"m%d" % i), s.PRIMARY_KEY_ID))
+    held = [0]
+    real = s.storage.connect
+    @contextlib.contextmanager
+    def counting(path):
+        held[0] += 1
+        try:
+            with real(path) as conn:
+                yield conn
+        finally:
+            held[0] -= 1
+    s.storage.connect = counting
+    def stream(since_id, limit):
+        lines, busy = [], []
+        for chunk in s._stream_decrypted("bob", since_id, limit):
+            busy.append(held[0])  # connections checked out while the reader has the chunk
+            lines += [json.loads(l) for l in chunk.splitlines()]
+        return {"messages": [m["message"] for m in lines[:-1]], "end": lines[-1], "busy": max(busy)}
+    print(json.dumps({"all": stream(0, None), "limited": stream(0, 5), "exact": stream(0, 7), "rest": stream(5, None)}))
+"""
+
+
+@pytest.fixture
+def out(run_server):
+    return run_server(SCRIPT, FERNET_KEY=Fernet.generate_key().decode(), DECRYPT_BATCH=2, DECRYPT_WORKERS=2)
+
+
+def test_stream_pages_release_connection(out):
+    assert out["all"]["messages"] == ["m%d" % i for i in range(7)]
+    assert out["all"]["end"] == {"next_cursor": 7, "has_more": False}
+    assert all(r["busy"] == 0 for r in out.values())
+
+
+def test_stream_limit_and_cursor(out):
+    assert out["limited"]["messages"] == ["m%d" % i for i in range(5)]
+    assert out["limited"]["end"] == {"next_cursor": 5, "has_more": True}
+    assert out["exact"]["end"] == {"next_cursor": 7, "has_more": False}
+    assert out["rest"]["messages"] == ["m5", "m6"]
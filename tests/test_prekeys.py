@@ -0,0 +1,49 @@
+import pytest
+
+import migrations
+import prekeys
+import storage
+
+
+def make_db(tmp_path):
+    path = str(tmp_path / "m.db")
+    migrations.migrate(path, report=None)
+    return path
+
+
+def upload(path, username, ids):
+    with storage.connect(path) as conn:
+        return prekeys.upload(conn, username, [(i, f"k{i}") for i in ids])
+
+
+def claim(path, *usernames):
+    with storage.connect(path) as conn:
+        return prekeys.claim(conn, list(usernames))[0]
+
+
+def test_claims_lowest_key_once(tmp_path):
+    path = make_db(tmp_path)
+    assert upload(path, "bob", [5, 2, 9]) == (3, 0, 3)
+    assert upload(path, "carol", [1]) == (1, 0, 1)
+    assert claim(path, "bob", "carol", "dave") == {"bob": (2, "k2"), "carol": (1, "k1")}
+    assert claim(path, "bob", "carol") == {"bob": (5, "k5")}
+
+
+def test_retried_upload_does_not_return_claimed_keys(tmp_path):
+    path = make_db(tmp_path)
+    upload(path, "bob", [0, 1, 2])
+    assert claim(path, "bob") == {"bob": (0, "k0")}
+    assert upload(path, "bob", [0, 1, 2]) == (0, 3, 2)
+    handed_out = [claim(path, "bob").get("bob") for _ in range(3)]
+    assert handed_out == [(1, "k1"), (2, "k2"), None]
+    assert upload(path, "bob", [2, 3]) == (1, 1, 1)
+
+
+def test_pool_cap(tmp_path, monkeypatch):
+    path = make_db(tmp_path)
+    monkeypatch.setattr(prekeys, "PREKEY_MAX_PER_USER", 3)
+    upload(path, "bob", [1, 2])
+    with pytest.raises(ValueError):
+        upload(path, "bob", [3, 4])
+    with storage.connect(path) as conn:
+        assert prekeys.count(conn, "bob") == 2
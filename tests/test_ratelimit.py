@@ -0,0 +1,54 @@
+from ratelimit import TokenBucketLimiter
+
+SCRIPT = """
+    import json
+    import server_e2ee as s
+    c = s.app.test_client()
+    def send(sender):
+        return c.post("/api/send", json={"sender": sender, "receiver": "bob", "ephemeral": "ZQ==", "iv": "aQ==",
+                                         "ciphertext": "Yw=="}, headers={"X-Forwarded-For": "1.2.3.4"}).status_code
+    print(json.dumps({"ip_rate": s.ip_limiter.rate, "codes": [send("alice") for _ in range(4)] + [send("carol")]}))
+"""
+
+
+def test_refund():
+    limiter = TokenBucketLimiter(rate=1, burst=2)
+    assert limiter.acquire("a", now=0) == 0
+    assert limiter.acquire("a", now=0) == 0
+    assert limiter.acquire("a", now=0) > 0
+    limiter.refund("a")
+    assert limiter.acquire("a", now=0) == 0
+
+
+def test_ip_limit_off_without_header(run_server):
+    out = run_server(SCRIPT, RATE_LIMIT_PER_SENDER=0)
+    assert out["ip_rate"] == 0
+    assert out["codes"] == [201] * 5
+
+
+def test_rejected_sender_does_not_spend_ip_tokens(run_server):
+    # alice's own limit turns away her last two sends; carol still fits the IP's three
+    out = run_server(SCRIPT, RATE_LIMIT_IP_HEADER="X-Forwarded-For", RATE_LIMIT_PER_IP=0.001,
+                     RATE_LIMIT_IP_BURST=3, RATE_LIMIT_PER_SENDER=0.001, RATE_LIMIT_SENDER_BURST=2)
+    assert out["codes"] == [201, 201, 429, 429, 201]
+
+
+BATCH_SCRIPT = """
+    import json
+    import server_e2ee as s
+    c = s.app.test_client()
+    sio = s.socketio.test_client(s.app, flask_test_client=c)
+    msg = lambda sender: {"sender": sender, "receiver": "bob", "ephemeral": "ZQ==", "iv": "aQ==", "ciphertext": "Yw=="}
+    send = lambda sender: c.post("/api/send", json=msg(sender)).status_code
+    spent = [send("carol"), send("carol")]
+    batch = sio.emit("send", [msg("alice"), msg("carol")], callback=True)
+    print(json.dumps({"spent": spent, "batch": batch, "alice": [send("alice"), send("alice"), send("alice")]}))
+"""
+
+
+def test_throttled_batch_charges_no_sender(run_server):
+    # carol is out of tokens, so the batch is refused and alice keeps her two
+    out = run_server(BATCH_SCRIPT, RATE_LIMIT_PER_SENDER=0.001, RATE_LIMIT_SENDER_BURST=2)
+    assert out["spent"] == [201, 201]
+    assert out["batch"]["error"] == "rate limited"
+    assert out["alice"] == [201, 201, 429]
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import segmentlog
+
+
+def row(receiver, body):
+    return ("alice", receiver, None, b"e", b"i", body, "2024-01-01T00:00:00", None)
+
+
+def bodies(log, receiver="bob"):
+    return [(r[0], bytes(r[4])) for r in log.rows(receiver, 0, 100)]
+
+
+def test_failed_batch_stores_nothing(tmp_path):
+    log = segmentlog.MessageLog(str(tmp_path), segment_bytes=4096)
+    assert log.append([row("bob", b"a")]) == [1]
+    with pytest.raises(ValueError):
+        log.append([row("bob", b"b"), row("bob", b"x" * 5000)])
+    assert log.append([row("bob", b"c")]) == [2]
+    assert bodies(log) == [(1, b"a"), (2, b"c")]
+    # another worker, and one starting from scratch, read the same log
+    assert bodies(segmentlog.MessageLog(str(tmp_path), segment_bytes=4096)) == [(1, b"a"), (2, b"c")]
+
+
+def test_failed_write_is_rolled_back(tmp_path, monkeypatch):
+    log = segmentlog.MessageLog(str(tmp_path), segment_bytes=4096)
+    log.append([row("bob", b"a")])
+    reader = segmentlog.MessageLog(str(tmp_path), segment_bytes=4096)
+    assert bodies(reader) == [(1, b"a")]
+
+    real_pwrite = os.pwrite
+    calls = []
+
+    def failing_pwrite(fd, data, offset):
+        calls.append(offset)
+        if len(calls) == 2:  # the batch's first header
+            raise OSError("disk full")
+        return real_pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, "pwrite", failing_pwrite)
+    with pytest.raises(OSError):
+        log.append([row("bob", b"b"), row("carol", b"b2")])
+    monkeypatch.setattr(os, "pwrite", real_pwrite)
+
+    assert log.append([row("bob", b"c")]) == [2]
+    assert bodies(log) == [(1, b"a"), (2, b"c")]
+    assert bodies(log, "carol") == []
+    assert bodies(reader) == [(1, b"a"), (2, b"c")]
+
+
+def test_batch_spanning_segments(tmp_path):
+    log = segmentlog.MessageLog(str(tmp_path), segment_bytes=4096)
+    ids = log.append([row("bob", bytes([i]) * 1000) for i in range(10)])
+    assert ids == list(range(1, 11))
+    fresh = segmentlog.MessageLog(str(tmp_path), segment_bytes=4096)
+    assert [i for i, _ in bodies(fresh)] == ids
@@ -0,0 +1,45 @@
+import pytest
+
+import wire
+
+HISTORY_SCRIPT = """
+    import json
+    import server_e2ee as s
+    gid = s.app.test_client().post("/api/groups", json={"name": "g", "creator": "alice", "members": ["bob"]}).json["id"]
+    msg = lambda **kw: dict({"sender": "alice", "receiver": "bob", "ephemeral": b"e", "iv": b"i",
+                             "ciphertext": b"c", "attachment": None}, **kw)
+    s.accept_messages([msg(), msg(attachment="ab" * 32)])
+    s.accept_messages([msg(ciphertext=b"g")], group_id=gid)
+    c = s.app.test_client()
+    binary = {"Accept": s.wire.HISTORY_CONTENT_TYPE}
+    out = {}
+    for name, url in (("all", "/api/messages/bob?limit=2"), ("group", f"/api/groups/{gid}/messages/bob")):
+        page = c.get(url).json
+        messages, cursor, more = s.wire.decode_history(c.get(url, headers=binary).data)
+        for m in messages:
+            for k in s.wire.BINARY_FIELDS:
+                m[k] = s.wire.to_b64(m[k])
+        out[name] = [page, {"messages": messages, "next_cursor": cursor, "has_more": more}]
+    print(json.dumps(out))
+"""
+
+
+def test_history_record_round_trip():
+    body = (wire.encode_history_record(7, "alice", b"e", b"i", b"c", "2024-01-01", 3, "ab" * 32)
+            + wire.encode_history_record(8, "bob", b"", b"", b"x", "2024-01-02")
+            + wire.encode_history_trailer(8, True))
+    messages, cursor, more = wire.decode_history(body)
+    assert (cursor, more) == (8, True)
+    assert messages[0] == {"id": 7, "sender": "alice", "ephemeral": b"e", "iv": b"i", "ciphertext": b"c",
+                           "timestamp": "2024-01-01", "group_id": 3, "attachment": "ab" * 32}
+    assert (messages[1]["group_id"], messages[1]["attachment"]) == (None, None)
+    with pytest.raises(wire.DecodeError):
+        wire.decode_history(body[:-3])
+
+
+def test_binary_history_matches_json(run_server):
+    out = run_server(HISTORY_SCRIPT, RATE_LIMIT_PER_SENDER=0, RATE_LIMIT_PER_IP=0)
+    for json_page, binary_page in out.values():
+        assert binary_page == json_page
+    assert out["group"][0]["messages"][0]["group_id"] is not None
+    assert out["all"][0]["messages"][1]["attachment"] == "ab" * 32
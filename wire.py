@@ -0,0 +1,178 @@
+# wire.py
+"""
+Binary encodings for ciphertext fields.
+
+Messages are stored as raw bytes (BLOB) and only turned into base64 at the
+edge for JSON clients. Binary clients skip base64 entirely:
+
+  POST /api/send with Content-Type: application/x-e2ee-message
+      body = field(sender) field(receiver) field(ephemeral) field(iv) field(ciphertext)
+
+  GET /api/messages/<username> with Accept: application/x-e2ee-history
+      body = record* trailer
+      record  = 0x02 u64(id) field(sender) field(ephemeral) field(iv)
+                field(ciphertext) field(timestamp) u64(group_id)
+                field(attachment)
+      trailer = 0x00 u64(next_cursor) u8(has_more)
+
+  group_id is 0 for a direct message, attachment empty when there is none.
+  (0x01 was the first record format, without those two fields.)
+
+  field = u32(length) bytes; strings are UTF-8; all integers big-endian.
+
+Socket.IO clients that identify with {"binary": true} get bytes values in
+pushes, which python-socketio/socket.io send as binary attachments.
+"""
+import base64
+import binascii
+import struct
+
+MESSAGE_CONTENT_TYPE = "application/x-e2ee-message"
+HISTORY_CONTENT_TYPE = "application/x-e2ee-history"
+
+BINARY_FIELDS = ("ephemeral", "iv", "ciphertext")
+
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+_RECORD = b"\x02"
+_TRAILER = b"\x00"
+
+
+class DecodeError(ValueError):
+    pass
+
+
+# -------------------------
+# base64 <-> bytes
+# -------------------------
+def from_b64(value):
+    """Decode a base64 field from a JSON client; raises DecodeError if invalid."""
+    if not isinstance(value, str):
+        raise DecodeError("expected a base64 string")
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise DecodeError("invalid base64")
+
+
+def to_b64(value):
+    """bytes -> base64 text. Rows not yet migrated are already base64 text."""
+    if isinstance(value, (bytes, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    return value
+
+
+def to_raw(value):
+    """Inverse of to_b64 for values read from the DB."""
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return bytes(value) if value is not None else b""
+
+
+def json_payload(payload):
+    """Copy of a message payload with every binary field as base64."""
+    return {k: (to_b64(v) if k in BINARY_FIELDS else v) for k, v in payload.items()}
+
+
+def binary_payload(payload):
+    """Copy of a message payload with every binary field as bytes."""
+    return {k: (to_raw(v) if k in BINARY_FIELDS else v) for k, v in payload.items()}
+
+
+# -------------------------
+# Length-prefixed frames
+# -------------------------
+def _field(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    elif value is None:
+        value = b""
+    return _U32.pack(len(value)) + bytes(value)
+
+
+def decode_fields(data, count):
+    """Split `data` into exactly `count` length-prefixed fields (bytes)."""
+    view = memoryview(data)
+    fields = []
+    pos = 0
+    for _ in range(count):
+        if pos + 4 > len(view):
+            raise DecodeError("truncated frame")
+        (n,) = _U32.unpack_from(view, pos)
+        pos += 4
+        if pos + n > len(view):
+            raise DecodeError("truncated field")
+        fields.append(view[pos:pos + n].tobytes())
+        pos += n
+    if pos != len(view):
+        raise DecodeError("trailing bytes after frame")
+    return fields
+
+
+def decode_send(data):
+    """Binary /api/send body -> dict shaped like the JSON request."""
+    sender, receiver, eph, iv, ct = decode_fields(data, 5)
+    try:
+        sender = sender.decode("utf-8")
+        receiver = receiver.decode("utf-8")
+    except UnicodeDecodeError:
+        raise DecodeError("sender/receiver must be UTF-8")
+    return {"sender": sender, "receiver": receiver, "ephemeral": eph, "iv": iv, "ciphertext": ct}
+
+
+def encode_send(sender, receiver, ephemeral, iv, ciphertext):
+    return b"".join(_field(v) for v in (sender, receiver, ephemeral, iv, ciphertext))
+
+
+def encode_history_record(msg_id, sender, ephemeral, iv, ciphertext, timestamp, group_id=None, attachment=None):
+    return b"".join((
+        _RECORD, _U64.pack(msg_id),
+        _field(sender), _field(to_raw(ephemeral)), _field(to_raw(iv)),
+        _field(to_raw(ciphertext)), _field(timestamp),
+        _U64.pack(group_id or 0), _field(attachment),
+    ))
+
+
+def _take(view, pos):
+    # one field at pos -> (bytes, next pos)
+    if pos + 4 > len(view):
+        raise DecodeError("truncated frame")
+    (n,) = _U32.unpack_from(view, pos)
+    if pos + 4 + n > len(view):
+        raise DecodeError("truncated field")
+    return view[pos + 4:pos + 4 + n].tobytes(), pos + 4 + n
+
+
+def decode_history(data):
+    """
+    Binary history body -> (messages, next_cursor, has_more); messages are
+    dicts shaped like the JSON ones, with bytes for the binary fields.
+    """
+    view = memoryview(data)
+    messages = []
+    pos = 0
+    while pos < len(view) and view[pos:pos + 1] == _RECORD:
+        if pos + 9 > len(view):
+            raise DecodeError("truncated record")
+        (msg_id,) = _U64.unpack_from(view, pos + 1)
+        pos += 9
+        fields = []
+        for _ in range(5):
+            value, pos = _take(view, pos)
+            fields.append(value)
+        if pos + 8 > len(view):
+            raise DecodeError("truncated record")
+        (group_id,) = _U64.unpack_from(view, pos)
+        attachment, pos = _take(view, pos + 8)
+        sender, ephemeral, iv, ciphertext, timestamp = fields
+        messages.append({"id": msg_id, "sender": sender.decode("utf-8"), "ephemeral": ephemeral, "iv": iv,
+                         "ciphertext": ciphertext, "timestamp": timestamp.decode("utf-8"),
+                         "group_id": group_id or None, "attachment": attachment.decode("ascii") or None})
+    if len(view) - pos != 10 or view[pos:pos + 1] != _TRAILER:
+        raise DecodeError("missing trailer")
+    (next_cursor,) = _U64.unpack_from(view, pos + 1)
+    return messages, next_cursor, view[pos + 9] == 1
+
+
+def encode_history_trailer(next_cursor, has_more):
+    return _TRAILER + _U64.pack(next_cursor) + (b"\x01" if has_more else b"\x00")